@@ -0,0 +1,164 @@
+from typing import Any, Optional
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = "PYCODEGEN_CACHE_DIR"
+
+
+def default_cache_dir() -> Path:
+    """Returns the root directory for pycodegen's on-disk caches."""
+    if os.getenv(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+    xdg_cache = os.getenv("XDG_CACHE_HOME")
+    base = Path(xdg_cache) if xdg_cache else Path.home().joinpath(".cache")
+    return base.joinpath("pycodegen")
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Returns a stable content hash for a set of JSON serializable parts
+    Args:
+        parts: Values that together identify a cache entry
+
+    Returns:
+        Hex digest to use as a cache key
+    """
+    payload = json.dumps(
+        parts, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    Content-addressed cache of JSON values stored one file per key.
+
+    Entries older than ttl seconds are treated as missing. When max_bytes is
+    set, the least recently used entries (by file modification time, which is
+    bumped on every hit) are evicted after each write.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        ttl: Optional[float] = None,
+        max_bytes: Optional[int] = None,
+        root: Optional[Path] = None,
+    ):
+        """
+        Initializes a cache in a namespace directory under root
+        Args:
+            namespace: Subdirectory name for this cache
+            ttl: Seconds before an entry expires (None to never expire)
+            max_bytes: Total size to evict down to (None for unbounded)
+            root: Cache root directory (defaults to default_cache_dir())
+        """
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.root = root
+
+    @property
+    def path(self) -> Path:
+        root = self.root if self.root is not None else default_cache_dir()
+        return root.joinpath(self.namespace)
+
+    def path_for(self, key: str) -> Path:
+        return self.path.joinpath(key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the cached value for key or None if missing or expired
+        Args:
+            key
+
+        Returns:
+            Cached value
+        """
+        entry_path = self.path_for(key)
+        try:
+            with open(entry_path, "r", encoding="utf-8") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if self.ttl is not None and time.time() - entry["created"] > self.ttl:
+            self.delete(key)
+            return None
+        try:
+            # Mark as recently used for eviction
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return entry["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        Stores value under key, replacing any existing entry
+        Args:
+            key
+            value: JSON serializable value
+
+        Returns:
+            None
+        """
+        entry_path = self.path_for(key)
+        try:
+            entry_path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(
+                dir=entry_path.parent, suffix=".tmp"
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                json.dump({"created": time.time(), "value": value}, fp)
+            os.replace(tmp_name, entry_path)
+        except OSError as oe:
+            logger.warning(f"Unable to write cache entry {entry_path}: {oe}")
+            return
+        self.evict()
+
+    def delete(self, key: str) -> None:
+        try:
+            self.path_for(key).unlink()
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def evict(self) -> None:
+        """Removes least recently used entries until under max_bytes"""
+        if self.max_bytes is None:
+            return
+        entries = []
+        total = 0
+        for entry_path in self.path.glob("*/*.json"):
+            try:
+                stat = entry_path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, entry_path in entries:
+            try:
+                entry_path.unlink()
+            except OSError:
+                continue
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,394 @@
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+from pycodegen import llm, todo
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+CHAIN_MODE_ENV = "PYCODEGEN_CHAIN_MODE"
+# Separate plan, critique, revise and write requests
+CHAIN_FULL = "full"
+# Plan, critique, revise and write in one structured request
+CHAIN_COMPACT = "compact"
+# Compact for small issue types or when the full chain would cost too much
+CHAIN_AUTO = "auto"
+CHAIN_MODES = (CHAIN_AUTO, CHAIN_FULL, CHAIN_COMPACT)
+# Issue types simple enough to plan and write in one request
+COMPACT_ISSUE_TYPES = frozenset({todo.chore_type, todo.docs_type})
+# Requests the full chain makes, each re-sending the issue context
+FULL_CHAIN_CALLS = 4
+# Most context tokens to spend on the full chain's requests
+FULL_CHAIN_TOKEN_BUDGET = 8_000
+
+COMPACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "plan": {"type": "array", "items": {"type": "string"}},
+        "critique": {"type": "string"},
+        "revised_plan": {"type": "array", "items": {"type": "string"}},
+        "code": {"type": "string"},
+    },
+    "required": ["plan", "critique", "revised_plan", "code"],
+}
+
+# Tokens the API adds to every message for its role and delimiters
+MESSAGE_OVERHEAD_TOKENS = 4
+# Most prompt tokens a conversation request can send, leaving room for the
+# reply in the model's context
+CONVERSATION_TOKEN_BUDGET = llm.CH_MAX_TOKENS - llm.RESPONSE_TOKEN_ESTIMATE
+
+chain_mode: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class Turn:
+    """
+    A follow-up request of a conversation. prompt is formatted with the
+    conversation's inputs and earlier replies; the reply is stored under
+    output_key. separate_prompt is the prompt this stage sent as a separate
+    request before chains were conversations (formatted with the same
+    values plus role and context), which usage reports compare against.
+    """
+
+    output_key: str
+    prompt: str
+    stop_when: Optional[llm.StopPredicate] = None
+    separate_prompt: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class ConversationUsage:
+    name: str
+    requests: int
+    # Tokens sent over all requests
+    prompt_tokens: int
+    # Tokens of each request repeating the previous request exactly, which
+    # providers with prompt caching don't process again
+    prefix_tokens: int
+    # Tokens of the shared context, sent once as the first message
+    context_tokens: int
+    # Tokens the turns would have sent as separate requests, each with the
+    # role, context and the earlier replies it needs interpolated in
+    separate_tokens: int
+
+    @property
+    def saved_tokens(self) -> int:
+        """Prompt tokens saved compared with separate requests (negative
+        when resending the earlier replies cost more than the context)"""
+        return self.separate_tokens - self.prompt_tokens
+
+
+UsageHook = Callable[[ConversationUsage], None]
+# Prompt and reply messages of an earlier turn with their tokens
+Exchange = Tuple[List[Dict[str, str]], int]
+
+usage_hooks: List[UsageHook] = []
+
+
+def set_chain_mode(mode: Optional[str]) -> None:
+    """Overrides the chain mode (auto, full or compact) for this process.
+    None falls back to the PYCODEGEN_CHAIN_MODE environment variable."""
+    global chain_mode
+    if mode is not None and mode not in CHAIN_MODES:
+        raise ValueError(
+            f"Unknown chain mode {mode}. Use one of {CHAIN_MODES}"
+        )
+    chain_mode = mode
+
+
+def get_chain_mode() -> str:
+    """Returns the configured chain mode."""
+    mode = chain_mode or os.getenv(CHAIN_MODE_ENV, CHAIN_AUTO).lower()
+    if mode not in CHAIN_MODES:
+        logger.warning(f"Unknown {CHAIN_MODE_ENV}={mode}. Using {CHAIN_AUTO}.")
+        return CHAIN_AUTO
+    return mode
+
+
+def choose_chain_mode(issue_type: Optional[str], context: str) -> str:
+    """
+    Picks the full or compact chain for an issue
+    Args:
+        issue_type: Issue type (None if the issue has no type labels)
+        context: Issue text that every request of the chain includes
+
+    Returns:
+        CHAIN_FULL or CHAIN_COMPACT
+    """
+    mode = get_chain_mode()
+    if mode != CHAIN_AUTO:
+        return mode
+    if issue_type is None or issue_type in COMPACT_ISSUE_TYPES:
+        return CHAIN_COMPACT
+    full_chain_tokens = llm.count_tokens(context) * FULL_CHAIN_CALLS
+    if full_chain_tokens > FULL_CHAIN_TOKEN_BUDGET:
+        logger.info(
+            f"Full chain would send ~{full_chain_tokens} context tokens. "
+            "Using the compact chain."
+        )
+        return CHAIN_COMPACT
+    return CHAIN_FULL
+
+
+def compact_prompt(role: str, task: str, context: str, plan_of: str) -> str:
+    """
+    Returns one prompt that asks for a plan, its critique, the revised plan
+    and the result as a JSON object
+    Args:
+        role: Who the LLM should act as
+        task: What to write (e.g. python code for the issue)
+        context: Issue and anything else the result depends on
+        plan_of: What the plan lists (e.g. steps, test cases)
+
+    Returns:
+        Prompt
+    """
+    return (
+        f"{role} {context}\n\n"
+        f"First list the {plan_of} for this. Then critique them: which are "
+        f"redundant, incorrect, or can be simplified? Then write the "
+        f"revised {plan_of}. Finally write {task} for the revised "
+        f"{plan_of}.\n"
+        f"Respond with just a JSON object matching this JSON schema, with "
+        f"the {plan_of} in plan, the critique in critique, the revised "
+        f"{plan_of} in revised_plan and just the python code in code:\n"
+        f"{json.dumps(COMPACT_SCHEMA)}"
+    )
+
+
+def parse_json_object(response: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads a JSON object from a response, ignoring any text around it
+    Args:
+        response
+
+    Returns:
+        JSON object (None if the response doesn't have one)
+    """
+    start = response.find("{")
+    end = response.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        result = json.loads(response[start : end + 1])
+    except json.JSONDecodeError as jde:
+        logger.warning(f"Can't load response as JSON. {jde}")
+        return None
+    if not isinstance(result, dict):
+        return None
+    return result
+
+
+def parse_compact_response(response: str) -> Optional[Dict[str, Any]]:
+    """
+    Reads the JSON object from a compact chain response
+    Args:
+        response
+
+    Returns:
+        Fields of the response (None if it isn't a JSON object with code)
+    """
+    result = parse_json_object(response)
+    if result is None or not isinstance(result.get("code"), str):
+        return None
+    return result
+
+
+def run_compact_chain(
+    role: str, task: str, context: str, plan_of: str
+) -> Dict[str, Any]:
+    """
+    Plans, critiques, revises and writes code with one request
+    Args:
+        role: Who the LLM should act as
+        task: What to write
+        context: Issue and anything else the result depends on
+        plan_of: What the plan lists
+
+    Returns:
+        plan, critique, revised_plan and code. If the response isn't JSON,
+        code holds the whole response.
+    """
+    response = llm.complete_prompt(
+        compact_prompt(role, task, context, plan_of)
+    )
+    result = parse_compact_response(response)
+    if result is None:
+        return {
+            "plan": [],
+            "critique": "",
+            "revised_plan": [],
+            "code": response,
+        }
+    logger.debug(f"Compact chain plan: {result.get('revised_plan')}")
+    return result
+
+
+def add_usage_hook(hook: UsageHook) -> None:
+    """Calls hook with the token usage of every conversation run"""
+    usage_hooks.append(hook)
+
+
+def remove_usage_hook(hook: UsageHook) -> None:
+    usage_hooks.remove(hook)
+
+
+def message_tokens(message: Dict[str, str]) -> int:
+    return llm.count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def separate_request_tokens(
+    turn: Turn,
+    role: str,
+    context: str,
+    values: Dict[str, str],
+    default: int,
+) -> int:
+    """
+    Returns the tokens a turn would have sent as a separate request
+    Args:
+        turn
+        role: System message of the conversation
+        context: Shared context of the conversation
+        values: Inputs and earlier replies
+        default: Tokens to use if the turn has no separate_prompt
+
+    Returns:
+        Tokens of the separate_prompt message
+    """
+    if turn.separate_prompt is None:
+        return default
+    prompt = turn.separate_prompt.format(
+        **{**values, "role": role, "context": context}
+    )
+    return message_tokens({"role": "user", "content": prompt})
+
+
+def trim_history(
+    name: str, history: List[Exchange], fixed_tokens: int
+) -> bool:
+    """
+    Drops the oldest earlier turns until a request fits in
+    CONVERSATION_TOKEN_BUDGET. The latest turn is always kept, since the
+    next prompt builds on its reply.
+    Args:
+        name: Chain name for the log
+        history: Earlier turns still sent, oldest first
+        fixed_tokens: Tokens of the role, context and next prompt
+
+    Returns:
+        True if turns were dropped
+    """
+    total = fixed_tokens + sum(tokens for _, tokens in history)
+    dropped = 0
+    while total > CONVERSATION_TOKEN_BUDGET and len(history) > 1:
+        _, tokens = history.pop(0)
+        total -= tokens
+        dropped += 1
+    if dropped:
+        logger.warning(
+            f"{name} dropped {dropped} earlier turns to fit in "
+            f"{CONVERSATION_TOKEN_BUDGET} prompt tokens"
+        )
+    if total > CONVERSATION_TOKEN_BUDGET:
+        logger.warning(
+            f"{name} request has {total} prompt tokens, over the "
+            f"{CONVERSATION_TOKEN_BUDGET} token budget"
+        )
+    return dropped > 0
+
+
+def run_conversation(
+    name: str,
+    role: str,
+    context: str,
+    turns: Sequence[Turn],
+    inputs: Dict[str, str],
+) -> Dict[str, str]:
+    """
+    Runs the stages of a chain as turns of one conversation. The role and
+    the shared context are sent once, as the first messages, and each
+    request only appends the previous reply and the next turn's prompt.
+    Every request therefore starts with the whole previous request, which
+    providers with prompt caching reuse. When a request would go over
+    CONVERSATION_TOKEN_BUDGET, the oldest turns are left out of it.
+    Args:
+        name: Chain name for the usage report
+        role: System message
+        context: Issue and anything else every turn depends on
+        turns: Prompts to send one after another
+        inputs: Values for the turn prompts
+
+    Returns:
+        inputs and the reply to each turn by output_key
+    """
+    values = dict(inputs)
+    header = [
+        {"role": "system", "content": role},
+        {"role": "user", "content": context},
+    ]
+    context_tokens = message_tokens(header[1])
+    header_tokens = message_tokens(header[0]) + context_tokens
+    history: List[Exchange] = []
+    previous_tokens = 0
+    prompt_tokens = 0
+    prefix_tokens = 0
+    separate_tokens = 0
+    for turn in turns:
+        prompt = {"role": "user", "content": turn.prompt.format(**values)}
+        turn_tokens = message_tokens(prompt)
+        trimmed = trim_history(name, history, header_tokens + turn_tokens)
+        if previous_tokens:
+            # Only the role and context are shared after dropping turns
+            prefix_tokens += header_tokens if trimmed else previous_tokens
+        messages = list(header)
+        for exchange, _ in history:
+            messages.extend(exchange)
+        messages.append(prompt)
+        sent_tokens = (
+            header_tokens + sum(tokens for _, tokens in history) + turn_tokens
+        )
+        prompt_tokens += sent_tokens
+        separate_tokens += separate_request_tokens(
+            turn, role, context, values, header_tokens + turn_tokens
+        )
+        reply = llm.respond(messages, stop_when=turn.stop_when)
+        if not reply:
+            logger.warning(f"{name} got no reply for {turn.output_key}")
+        logger.debug(f"{name} {turn.output_key}: {reply}")
+        values[turn.output_key] = reply
+        reply_message = {"role": "assistant", "content": reply}
+        history.append(
+            (
+                [prompt, reply_message],
+                turn_tokens + message_tokens(reply_message),
+            )
+        )
+        previous_tokens = sent_tokens
+
+    usage = ConversationUsage(
+        name,
+        len(turns),
+        prompt_tokens,
+        prefix_tokens,
+        context_tokens,
+        separate_tokens,
+    )
+    logger.info(
+        f"{name} sent {usage.prompt_tokens} prompt tokens in "
+        f"{usage.requests} requests, {usage.prefix_tokens} of them a "
+        f"reusable prefix. Separate requests would have sent "
+        f"{usage.separate_tokens}."
+    )
+    for hook in usage_hooks:
+        hook(usage)
+    return values
@@ -1,27 +1,44 @@
-from typing import Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+import io
 import json
 import logging
 import os
-import re
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from dataclasses import dataclass
 from json import JSONDecodeError
 from pathlib import Path
 
 import click
 import tomli
-from github.Issue import Issue
-from langchain.chains import LLMChain, SequentialChain
-from langchain.chat_models import ChatOpenAI
-from langchain.memory import SimpleMemory
-from langchain.prompts import PromptTemplate
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-)
 from pathvalidate import sanitize_filename
 
-from pycodegen import llm, sc, tester, todo
+from pycodegen import (
+    chains,
+    envs,
+    llm,
+    merge,
+    pipeline,
+    sc,
+    session,
+    tester,
+    todo,
+)
+
+if TYPE_CHECKING:
+    from github.Issue import Issue
 
 logging.basicConfig(
     level=logging.INFO,
@@ -43,40 +60,83 @@ LOGGER_CODE = (
 )
 AI_COMMENT_TAG = "AI: "
 NO_QUESTIONS = "No questions."
+DEVELOPER_ROLE = "You are a thoughtful python software developer."
+ISSUE_READY = "ready"
+ISSUE_WAITING = "waiting"
+ISSUE_UNREVIEWED = "unreviewed"
+TRIAGE_ISSUES_PER_REPO = 3
+GITHUB_WORKERS = 8
+CODER_COMMANDS = ("start", "code", "finish", "gen-tests")
 
+# Warm Coder instances and the lock serializing their commands (coder serve)
+coders: Dict[Tuple[str, str], "Coder"] = {}
+command_lock = threading.Lock()
 
-def review_comments(issue: Issue) -> int:
-    """Review issue comments and take appropriate action"""
-    comments = todo.get_issue_comments(issue)
-    # Check if AI has already commented and gotten a response
+
+def comments_status(comments: List[str]) -> Optional[str]:
+    """
+    Returns whether the AI's questions about an issue have been answered
+    Args:
+        comments: Issue comments, oldest first
+
+    Returns:
+        ISSUE_READY, ISSUE_WAITING or None if AI has not commented yet
+    """
     for idx, comment in enumerate(comments):
         if comment.startswith(AI_COMMENT_TAG):
-            if len(comments) == idx + 1:  # Last comment
-                if comment.find("?") == -1:
-                    # AI has commented and has no questions
-                    click.echo(f"No questions for issue #{issue.number}")
-                    click.echo(f"Last comment: {comment}")
-                    return 0
+            if len(comments) == idx + 1 and comment.find("?") != -1:
                 # AI has commented, but needs a response
-                click.echo(
-                    "AI: Waiting for response from user in "
-                    f"comments on issue #{issue.number}"
-                )
-                return 1
-            else:
-                # AI has commented and gotten a response
-                return 0
+                return ISSUE_WAITING
+            # AI has no questions or has gotten a response
+            return ISSUE_READY
+    return None
+
+
+def questions_prompt(title: str, body: str, comments: List[str]) -> str:
+    """Returns the prompt asking for questions about an issue"""
+    all_comments = "\n".join(comments)
+    return (
+        f"What are the top questions that should be asked about the "
+        f"following issue in order to develop an effective solution?\n"
+        f"{title}\n{body}\n{all_comments}\n"
+    )
+
+
+def review_comments(
+    issue: "Issue", snapshot: Optional[todo.IssueSnapshot] = None
+) -> int:
+    """
+    Review issue comments and take appropriate action
+    Args:
+        issue
+        snapshot: Already fetched copy of the issue and its comments
+
+    Returns:
+        response code
+    """
+    issue_details = snapshot or issue
+    comments = todo.get_issue_comments(issue_details)
+    # Check if AI has already commented and gotten a response
+    status = comments_status(comments)
+    if status == ISSUE_READY:
+        if comments[-1].startswith(AI_COMMENT_TAG):
+            click.echo(f"No questions for issue #{issue.number}")
+            click.echo(f"Last comment: {comments[-1]}")
+        return 0
+    if status == ISSUE_WAITING:
+        click.echo(
+            "AI: Waiting for response from user in "
+            f"comments on issue #{issue.number}"
+        )
+        return 1
     # AI has not commented yet
     for comment in comments:
         if comment.find("http://") != -1 or comment.find("https://") != -1:
             # TODO: Read linked page and act accordingly
             pass
     # AI ask questions about issue body and comments
-    all_comments = "\n".join(comments)
-    prompt = (
-        f"What are the top questions that should be asked about the "
-        f"following issue in order to develop an effective solution?\n"
-        f"{issue.title}\n{issue.body}\n{all_comments}\n"
+    prompt = questions_prompt(
+        issue_details.title, issue_details.body, comments
     )
     response = llm.complete_prompt(prompt)
     if response:
@@ -89,6 +149,186 @@ def review_comments(issue: Issue) -> int:
         return 0
 
 
+@dataclass(frozen=True)
+class TriageResult:
+    repo: str
+    number: int
+    title: str
+    status: str
+
+
+def candidate_issues(
+    full_name: str, per_repo: int = TRIAGE_ISSUES_PER_REPO
+) -> List[todo.IssueSnapshot]:
+    """
+    Fetches the highest priority open issues of a repo
+    Args:
+        full_name: owner/repo
+        per_repo: Number of issues to fetch
+
+    Returns:
+        Snapshots of the issues with their comments
+    """
+    from github.GithubException import GithubException
+
+    repo_owner, repo_name = full_name.split("/", 1)
+    snapshots = []
+    try:
+        # Triaged repos may belong to an organization, which never creates
+        # issues itself
+        for issue_num in todo.get_issue_queue(
+            repo_owner, repo_name, k=per_repo, owner_only=False
+        ):
+            snapshot = todo.fetch_issue_snapshot(
+                repo_owner, repo_name, issue_num
+            )
+            if snapshot and snapshot.state == "open":
+                snapshots.append(snapshot)
+    except GithubException as ge:
+        logger.error(f"Unable to get issues for {full_name}: {ge}")
+    return snapshots
+
+
+def post_questions(
+    full_name: str, snapshot: todo.IssueSnapshot, questions: str
+) -> TriageResult:
+    """
+    Writes AI questions as a comment on an issue
+    Args:
+        full_name: owner/repo
+        snapshot: Issue the questions are about
+        questions: LLM response (empty if there was none)
+
+    Returns:
+        Triage status of the issue once the questions are posted
+    """
+    from github.GithubException import GithubException
+
+    status = ISSUE_UNREVIEWED
+    repo_owner, repo_name = full_name.split("/", 1)
+    if questions:
+        comment = AI_COMMENT_TAG + questions
+        issue = todo.get_issue(
+            todo.get_repo(repo_owner, repo_name), snapshot.number
+        )
+        try:
+            if issue and todo.write_issue_comment(issue, comment):
+                status = comments_status(list(snapshot.comments) + [comment])
+        except GithubException as ge:
+            logger.error(
+                f"Unable to comment on {full_name}#{snapshot.number}: {ge}"
+            )
+    return TriageResult(full_name, snapshot.number, snapshot.title, status)
+
+
+def triage_repos(
+    repo_names: List[str],
+    per_repo: int = TRIAGE_ISSUES_PER_REPO,
+    max_workers: int = GITHUB_WORKERS,
+) -> List[TriageResult]:
+    """
+    Reviews the comments on the top issues of many repos at once. Issues
+    are fetched on a pool of threads, questions for issues the AI has not
+    commented on are generated concurrently (sharing the LLM rate limit),
+    and the questions are posted back to the issues.
+    Args:
+        repo_names: Full repo names (owner/repo)
+        per_repo: Number of issues to triage per repo
+        max_workers: Concurrent GitHub requests
+
+    Returns:
+        Triage status of every issue, ordered by repo and issue number
+    """
+    results = []
+    unreviewed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        repo_issues = executor.map(
+            lambda full_name: candidate_issues(full_name, per_repo),
+            repo_names,
+        )
+        for full_name, snapshots in zip(repo_names, repo_issues):
+            for snapshot in snapshots:
+                status = comments_status(list(snapshot.comments))
+                if status is None:
+                    unreviewed.append((full_name, snapshot))
+                else:
+                    results.append(
+                        TriageResult(
+                            full_name, snapshot.number, snapshot.title, status
+                        )
+                    )
+        responses = llm.gather_prompts(
+            [
+                questions_prompt(
+                    snapshot.title, snapshot.body, list(snapshot.comments)
+                )
+                for _, snapshot in unreviewed
+            ]
+        )
+        results.extend(
+            executor.map(
+                lambda item: post_questions(*item[0], item[1]),
+                zip(unreviewed, responses),
+            )
+        )
+    results.sort(key=lambda result: (result.repo, result.number))
+    return results
+
+
+def format_table(headers: Sequence[str], rows: Sequence[Sequence[str]]) -> str:
+    """
+    Returns rows as a plain text table with aligned columns
+    Args:
+        headers: Column names
+        rows: Cells of each row
+
+    Returns:
+        Table text, the last column left unpadded
+    """
+    table_rows = [tuple(headers)] + [tuple(row) for row in rows]
+    widths = [
+        max(len(row[col]) for row in table_rows)
+        for col in range(len(headers) - 1)
+    ]
+    return "\n".join(
+        "  ".join(
+            [cell.ljust(width) for cell, width in zip(row, widths)] + [row[-1]]
+        )
+        for row in table_rows
+    )
+
+
+def format_triage_table(results: List[TriageResult]) -> str:
+    """Returns triage results as a plain text table"""
+    return format_table(
+        ("REPO", "ISSUE", "STATUS", "TITLE"),
+        [
+            (result.repo, f"#{result.number}", result.status, result.title)
+            for result in results
+        ],
+    )
+
+
+def format_generated_table(results: List[tester.GeneratedTests]) -> str:
+    """Returns generated tests as a plain text table"""
+    return format_table(
+        ("ISSUE", "SECONDS", "STEP DEFS", "TITLE"),
+        [
+            (
+                f"#{result.number}",
+                f"{result.seconds:.2f}",
+                (
+                    result.step_def_path.name
+                    if result.step_def_path
+                    else f"error: {result.error}"
+                ),
+                result.title,
+            )
+            for result in results
+        ],
+    )
+
+
 def bump_version(issue_type: str) -> None:
     """
     Bumps the version in pyproject.toml based on issue type
@@ -154,7 +394,9 @@ def just_the_code(llm_text: str) -> Optional[str]:
 
 def add_text_to_module(module_text: str, text_to_add: str) -> str:
     """
-    Adds function text to module text in an organized way
+    Adds function text to module text in an organized way: imports are
+    hoisted and deduplicated, existing functions are replaced and new code
+    goes before the main guard (see merge.merge_snippets)
     Args:
         module_text
         text_to_add
@@ -162,60 +404,20 @@ def add_text_to_module(module_text: str, text_to_add: str) -> str:
     Returns:
         Updated module text
     """
-    # TODO: Add any imports to the top of the module
-    class_loc = module_text.find("class ")
-    main_loc = module_text.find('if __name__ == "__main__":')
-    if class_loc != -1:
-        end_of_class = module_text.find("\n\n\n", class_loc)
-        if end_of_class == -1:
-            # Nothing after last class function
-            module_text += "\n\n" + text_to_add + "\n"
-        else:
-            # Adding text to end of class
-            module_text = (
-                f"{module_text[:end_of_class + 2]}"
-                f"{text_to_add}"
-                f"{module_text[end_of_class + 2:]}"
-            )
-    elif main_loc != -1:
-        # No class, but main function needs to stay at end
-        module_text = (
-            f"{module_text[:main_loc]}"
-            f"{text_to_add}\n\n\n"
-            f"{module_text[main_loc:]}"
-        )
-    else:
-        # No class or main function, just add to end
-        module_text += "\n\n" + text_to_add + "\n"
-    return module_text
+    return merge.merge_snippets(module_text, [text_to_add])
 
 
 def add_logging(script_content: str) -> str:
-    """Adds code for a logger to a python script"""
-    if script_content.find("import logging") != -1:
+    """Adds code for a logger to a python script, after its last import"""
+    imports = merge.analyze_imports(script_content)
+    if imports.has_logging:
         logger.info("Logging already included")
         return script_content
-    import_re = re.compile(r"^\s*import\s.*$", re.MULTILINE)
-    from_import_re = re.compile(r"^\s*from\s.*$", re.MULTILINE)
-    last_import_match = None
-    for match in reversed(list(import_re.finditer(script_content))):
-        if (
-            last_import_match is None
-            or match.start() > last_import_match.start()
-        ):
-            last_import_match = match
-    for match in reversed(list(from_import_re.finditer(script_content))):
-        if (
-            last_import_match is None
-            or match.start() > last_import_match.start()
-        ):
-            last_import_match = match
-    if last_import_match is not None:
-        last_import_line = last_import_match.end()
+    if imports.last_line:
         return (
-            script_content[:last_import_line]
+            script_content[: imports.end]
             + LOGGER_CODE
-            + script_content[last_import_line:]
+            + script_content[imports.end :]
         )
     else:
         return LOGGER_CODE + script_content
@@ -225,17 +427,52 @@ CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 
 @click.group(context_settings=CONTEXT_SETTINGS)
-def cli():
-    pass
+@click.option(
+    "--llm-cache",
+    type=click.Choice(llm.CACHE_MODES),
+    default=None,
+    help="Use (on), bypass (off) or refresh (refresh) cached LLM responses.",
+)
+@click.option(
+    "--local",
+    is_flag=True,
+    help="Run in this process even if coder serve is running.",
+)
+@click.option(
+    "--chain-mode",
+    type=click.Choice(chains.CHAIN_MODES),
+    default=None,
+    help="Plan and write code with one request per step (full), one "
+    "request in all (compact) or pick by issue (auto).",
+)
+@click.pass_context
+def cli(
+    ctx: click.Context,
+    llm_cache: Optional[str],
+    local: bool,
+    chain_mode: Optional[str],
+) -> None:
+    llm.set_cache_mode(llm_cache)
+    chains.set_chain_mode(chain_mode)
+    ctx.obj = {
+        "llm_cache": llm_cache,
+        "local": local,
+        "chain_mode": chain_mode,
+    }
 
 
 @cli.command()
 @click.argument("repo_owner")
 @click.argument("repo_name")
 @click.option("-i", "--issue_num", type=int)
-def start(repo_owner: str, repo_name: str, issue_num: Optional[int]) -> None:
-    coder = Coder(repo_owner, repo_name)
-    response = coder.open_issue(issue_num)
+@click.pass_obj
+def start(
+    options: Dict[str, Any],
+    repo_owner: str,
+    repo_name: str,
+    issue_num: Optional[int],
+) -> None:
+    response = dispatch(options, "start", repo_owner, repo_name, issue_num)
     if response == 0:
         click.echo("Successfully started issue")
 
@@ -243,9 +480,9 @@ def start(repo_owner: str, repo_name: str, issue_num: Optional[int]) -> None:
 @cli.command()
 @click.argument("repo_owner")
 @click.argument("repo_name")
-def code(repo_owner: str, repo_name: str) -> None:
-    coder = Coder(repo_owner, repo_name)
-    response = coder.start_coding()
+@click.pass_obj
+def code(options: Dict[str, Any], repo_owner: str, repo_name: str) -> None:
+    response = dispatch(options, "code", repo_owner, repo_name)
     if response == 0:
         click.echo("Successfully started coding")
 
@@ -259,13 +496,270 @@ def code(repo_owner: str, repo_name: str) -> None:
     default="",
     help="Commit message. " "Generated automatically" " if not provided",
 )
-def finish(repo_owner: str, repo_name: str, commit_msg="") -> None:
-    coder = Coder(repo_owner, repo_name)
-    response = coder.finish_issue(commit_msg)
+@click.pass_obj
+def finish(
+    options: Dict[str, Any], repo_owner: str, repo_name: str, commit_msg=""
+) -> None:
+    response = dispatch(options, "finish", repo_owner, repo_name, commit_msg)
     if response == 0:
         click.echo("Successfully completed issue")
 
 
+@cli.command("gen-tests")
+@click.argument("repo_owner")
+@click.argument("repo_name")
+@click.argument("issue_nums", nargs=-1, type=int)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Processes to write step defs on (defaults to the number of CPUs).",
+)
+@click.pass_obj
+def gen_tests(
+    options: Dict[str, Any],
+    repo_owner: str,
+    repo_name: str,
+    issue_nums: List[int],
+    workers: Optional[int],
+) -> None:
+    """Create feature files and step defs for issues (defaults to every
+    open enhancement issue)"""
+    response = dispatch(
+        options,
+        "gen-tests",
+        repo_owner,
+        repo_name,
+        {"issue_nums": list(issue_nums), "workers": workers},
+    )
+    if response == 0:
+        click.echo("Successfully generated tests")
+
+
+@cli.command()
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Unix socket to listen on (defaults to the pycodegen cache dir).",
+)
+def serve(socket_path: Optional[Path]) -> None:
+    """Keep repos, clients and tokenizers warm for start, code and finish"""
+    try:
+        server = session.SessionServer(handle_session_request, socket_path)
+    except RuntimeError as rte:
+        raise click.ClickException(str(rte))
+    click.echo(f"Serving coder commands on {server.path}")
+    with server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def dispatch(
+    options: Dict[str, Any],
+    command: str,
+    repo_owner: str,
+    repo_name: str,
+    argument: Any = None,
+) -> int:
+    """
+    Runs a command on the coder serve process if one is running, otherwise
+    in this process. Commands the server accepted are never rerun here, even
+    if the connection drops.
+    Args:
+        options: Global CLI options
+        command: start, code, finish or gen-tests
+        repo_owner
+        repo_name
+        argument: Issue number for start, commit message for finish,
+            issue_nums and workers for gen-tests
+
+    Returns:
+        Command response code
+    """
+    if not options.get("local"):
+        response = session.send_request(
+            {
+                "command": command,
+                "repo_owner": repo_owner,
+                "repo_name": repo_name,
+                "argument": argument,
+                "llm_cache": options.get("llm_cache"),
+                "chain_mode": options.get("chain_mode"),
+            }
+        )
+        if response is not None:
+            click.echo(response.get("output", ""), nl=False)
+            if response.get("error"):
+                logger.error(f"coder serve: {response['error']}")
+            return response["rc"]
+    return run_coder_command(command, repo_owner, repo_name, argument)
+
+
+def get_coder(repo_owner: str, repo_name: str) -> "Coder":
+    """Returns the Coder for a repo, creating it on first use"""
+    key = (repo_owner, repo_name)
+    if key not in coders:
+        coders[key] = Coder(repo_owner, repo_name)
+    return coders[key]
+
+
+def run_coder_command(
+    command: str, repo_owner: str, repo_name: str, argument: Any = None
+) -> int:
+    """Runs a start, code, finish or gen-tests command on a repo's Coder"""
+    if command not in CODER_COMMANDS:
+        raise ValueError(f"Unknown command {command}")
+    coder = get_coder(repo_owner, repo_name)
+    if command == "start":
+        return coder.open_issue(argument)
+    if command == "code":
+        return coder.start_coding()
+    if command == "gen-tests":
+        argument = argument or {}
+        return coder.generate_tests(
+            argument.get("issue_nums"), argument.get("workers")
+        )
+    return coder.finish_issue(argument or "")
+
+
+def handle_session_request(request: session.Request) -> session.Response:
+    """
+    Runs a command for coder serve. Commands run one at a time since they
+    change the working directory and capture stdout.
+    Args:
+        request: command, repo_owner, repo_name, argument, llm_cache and
+            chain_mode
+
+    Returns:
+        Response with the command's response code and output
+    """
+    if request.get("command") == "ping":
+        return {"rc": 0, "output": ""}
+    output = io.StringIO()
+    with command_lock, redirect_stdout(output):
+        cache_mode = llm.cache_mode
+        chain_mode = chains.chain_mode
+        try:
+            llm.set_cache_mode(request.get("llm_cache"))
+            chains.set_chain_mode(request.get("chain_mode"))
+            rc = run_coder_command(
+                request.get("command"),
+                request.get("repo_owner"),
+                request.get("repo_name"),
+                request.get("argument"),
+            )
+        except Exception as e:
+            logger.exception(f"coder serve request failed: {request}")
+            return {"rc": 1, "output": output.getvalue(), "error": str(e)}
+        finally:
+            llm.set_cache_mode(cache_mode)
+            chains.set_chain_mode(chain_mode)
+    return {"rc": rc, "output": output.getvalue()}
+
+
+@cli.command()
+@click.argument("repos", nargs=-1)
+@click.option("--org", help="Triage every repo of a GitHub organization.")
+@click.option(
+    "-n",
+    "--per-repo",
+    type=int,
+    default=TRIAGE_ISSUES_PER_REPO,
+    show_default=True,
+    help="Issues to triage per repo.",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=GITHUB_WORKERS,
+    show_default=True,
+    help="Concurrent GitHub requests.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Also write the summary table to a file.",
+)
+def triage(
+    repos: List[str],
+    org: Optional[str],
+    per_repo: int,
+    workers: int,
+    output: Optional[Path],
+) -> None:
+    """Review the top issues of many repos (owner/repo) at once"""
+    repo_names = list(repos)
+    if org:
+        repo_names.extend(todo.get_org_repo_names(org))
+    invalid = [name for name in repo_names if "/" not in name]
+    if invalid:
+        raise click.BadParameter(
+            f"Expected owner/repo, got: {', '.join(invalid)}"
+        )
+    if not repo_names:
+        raise click.UsageError("Provide owner/repo names or --org")
+    results = triage_repos(repo_names, per_repo, workers)
+    table = format_triage_table(results)
+    click.echo(table)
+    if output:
+        output.write_text(table + "\n", encoding="utf-8")
+
+
+# Plan steps for the issue, critique and revise them, then write the code
+# TODO: Consider adding project description for context in prompt
+SOURCE_TURNS = (
+    chains.Turn(
+        "solution_steps",
+        "Evaluate the {issue_type} and comments above. Return a list of "
+        "just the steps you would take to solve it.",
+        separate_prompt="{role} Evaluate the following {issue_type} and "
+        "comments. Return a list of just the steps you would take to solve "
+        "it.\n{context}",
+    ),
+    chains.Turn(
+        "critique",
+        "Compare your list of steps with the {issue_type} and comments. "
+        "Which steps are redundant, incorrect, or can be simplified?",
+        separate_prompt="{role} Compare the following list of steps with "
+        "the {issue_type} and comments. Which steps are redundant, "
+        "incorrect, or can be simplified?\n{context}\n"
+        "Steps:\n{solution_steps}",
+    ),
+    chains.Turn(
+        "updated_steps",
+        "Write what the steps should be (if there are no changes needed, "
+        "please repeat the steps).",
+        separate_prompt="{role}\nFor a solution to this {context}\n"
+        "You wrote steps:\n{solution_steps}"
+        "You critiqued the steps:\n{critique}\n\n"
+        "Write what the steps should be (if there are no changes needed, "
+        "please repeat the steps).",
+    ),
+    chains.Turn(
+        "source_code",
+        "Write python code for the updated steps.\n"
+        "You can use the following libraries:\n{use_libs}\n"
+        "The code produced should pass the following unit tests.\n"
+        "{unit_tests}\n"
+        "Respond with just the python code.\n",
+        # Stop once the code block is done
+        stop_when=llm.closing_code_fence,
+        separate_prompt="{role} Write python code for the following "
+        "steps:\n{updated_steps}\n"
+        "You can use the following libraries:\n{use_libs}\n"
+        "The code produced should pass the following unit tests.\n"
+        "{unit_tests}\n"
+        "Respond with just the python code.\n",
+    ),
+)
+
+
 class Coder:
     """
     Coder Class
@@ -287,61 +781,8 @@ class Coder:
         self.repo_path = self.work_dir.joinpath(self.repo_name)
         tester.create_test_dirs(self.repo_path)
 
-        venv_path = self.repo_path.joinpath(".venv")
-        # Get python version from pyproject.toml
-        pyproject_path = self.repo_path.joinpath("pyproject.toml")
-        if pyproject_path.exists():
-            with open(pyproject_path, "rb") as pyproject:
-                project_conf = tomli.load(pyproject)
-                requires = project_conf["project"]["requires-python"]
-                python_version = requires.replace(">", "").replace("=", "")
-        else:
-            python_version = "3.9"
-        if not venv_path.exists():
-            os.chdir(self.repo_path)
-            cp_setup = subprocess.run(
-                [
-                    "pdm",
-                    "venv",
-                    "create",
-                    f"{python_version}",
-                    "-v",
-                ],
-                capture_output=True,
-            )
-            cp_setup2 = subprocess.run(
-                [
-                    "pdm",
-                    "venv",
-                    "activate",
-                    "in-project",
-                ],
-                capture_output=True,
-                shell=True,
-            )  # nosec B602
-            subprocess.run(
-                [
-                    "pdm",
-                    "use",
-                    f"{python_version}",
-                    "-i",
-                    "-f",
-                    "-vv",
-                ],
-                capture_output=True,
-            )
-            subprocess.run(
-                [
-                    "make",
-                    "install",
-                ],
-                capture_output=True,
-            )
-            if cp_setup2.returncode == 0:
-                # May be too much to push to logs
-                logger.info(cp_setup.stdout)
-            else:
-                logger.error(cp_setup.stderr)
+        if not envs.provision_venv(self.repo_path):
+            logger.error(f"Unable to set up the venv for {self.repo_name}")
 
     def open_issue(self, issue_num: Optional[int]) -> int:
         """
@@ -361,8 +802,12 @@ class Coder:
             return 1
         logger.info(f"Working on issue {issue.number}: {issue.title}")
 
+        snapshot = todo.fetch_issue_snapshot(
+            self.repo_owner, self.repo_name, issue.number
+        )
+
         # Review issue comments
-        rc = review_comments(issue)
+        rc = review_comments(issue, snapshot)
         if rc != 0:
             return rc
 
@@ -374,7 +819,10 @@ class Coder:
         logger.info("Pulled repo")
 
         # Checkout git branch
-        branch_name = todo.issue_title_to_branch_name(github_repo, issue)
+        issue_type = snapshot.issue_type if snapshot else None
+        branch_name = todo.issue_title_to_branch_name(
+            github_repo, issue, issue_type
+        )
         sc.use_branch(self.repo, branch_name)
         logger.info(f"Created branch {branch_name}")
 
@@ -387,7 +835,6 @@ class Coder:
         if branch_name == "main":
             logger.error("Cannot code on main branch. Start an issue first")
             return 1
-        github_repo = todo.get_repo(self.repo_owner, self.repo_name)
         issue_num = int(todo.issue_num_from_branch_name(branch_name))
         if not issue_num:
             logger.error(
@@ -395,57 +842,145 @@ class Coder:
                 "Start an issue first"
             )
             return 1
-        issue = todo.get_issue(github_repo, issue_num)
-        issue_type = todo.get_issue_type(github_repo, issue)
-
-        # Create functional test if new feature
-        if issue_type == todo.feature_type:
-            feature_path = tester.create_feature(self.repo_path, issue)
-            logger.info(f"Created feature file {feature_path}")
-            func_test_path = tester.create_step_defs(feature_path)
-            if func_test_path:
-                logger.info(f"Created functional test file {func_test_path}")
+        # Issue, labels and comments in one request, shared by every step
+        issue = todo.fetch_issue_snapshot(
+            self.repo_owner, self.repo_name, issue_num
+        )
+        if not issue:
+            logger.error(f"Could not fetch issue #{issue_num}")
+            return 1
+        issue_type = issue.issue_type
 
         # TODO: Account for multiple packages, no package, or package name
         #  different from repo name
         package_name = self.repo_name.replace("-", "_")
 
-        # Recommend module to work with
-        src_file_name = self.recommend_filename(issue, package_name)
-        logger.info(f"Recommended source file {src_file_name}")
+        def create_feature() -> Path:
+            feature_path = tester.create_feature(self.repo_path, issue)
+            logger.info(f"Created feature file {feature_path}")
+            return feature_path
 
-        # Create unit tests if bug or feature
-        if issue_type == "bug" or issue_type == "feature":
+        def create_step_defs(feature: Path) -> Optional[Path]:
+            func_test_path = tester.create_step_defs(feature)
+            if func_test_path:
+                logger.info(f"Created functional test file {func_test_path}")
+            return func_test_path
+
+        def recommend_filename() -> str:
+            # Recommend module to work with
+            src_file_name = self.recommend_filename(issue, package_name)
+            logger.info(f"Recommended source file {src_file_name}")
+            return src_file_name
+
+        def create_unit_tests(filename: str) -> str:
+            # Create unit tests if bug or feature
+            if issue_type != "bug" and issue_type != "feature":
+                logger.info(
+                    f"No unit tests created for issue_type={issue_type}"
+                )
+                return ""
             unit_tests = tester.create_unit_tests(
-                src_file_name,
+                filename,
                 issue.body,
                 issue_type,
                 package_name,
             )
             unit_test_path = tester.write_unit_tests_to_file(
                 self.repo_path,
-                src_file_name,
+                filename,
                 just_the_code(unit_tests),
             )
             logger.info(f"Created/updated test file {unit_test_path}")
-        else:
-            unit_tests = ""
-            logger.info(f"No unit tests created for issue_type={issue_type}")
-
-        # Recommended libraries
-        libs = self.recommend_libraries(issue)
-        recommended_libs = list(libs.keys())
-
-        # Start writing code for the issue
-        self.write_src_code(
-            issue,
-            issue_type,
-            src_file_name,
-            recommended_libs,
-            package_name,
-            unit_tests,
-        )
+            return unit_tests
+
+        def recommend_libraries() -> List[str]:
+            libs = self.recommend_libraries(issue)
+            return list(libs.keys()) if libs else []
+
+        def write_src_code(
+            filename: str, unit_tests: str, libraries: List[str]
+        ) -> None:
+            # Start writing code for the issue
+            self.write_src_code(
+                issue,
+                issue_type,
+                filename,
+                libraries,
+                package_name,
+                unit_tests,
+            )
 
+        stages = [
+            pipeline.Stage("filename", recommend_filename),
+            pipeline.Stage("libraries", recommend_libraries),
+            pipeline.Stage("unit_tests", create_unit_tests, ("filename",)),
+            pipeline.Stage(
+                "source",
+                write_src_code,
+                ("filename", "unit_tests", "libraries"),
+            ),
+        ]
+        # Create functional test if new feature
+        if issue_type == todo.feature_type:
+            stages += [
+                pipeline.Stage("feature", create_feature),
+                pipeline.Stage("step_defs", create_step_defs, ("feature",)),
+            ]
+        pipeline.run_pipeline(stages)
+
+        return 0
+
+    def generate_tests(
+        self,
+        issue_nums: Optional[List[int]] = None,
+        max_workers: Optional[int] = None,
+    ) -> int:
+        """
+        Creates feature files and step defs for many issues at once
+        Args:
+            issue_nums: Issues to generate tests for (defaults to every open
+                feature issue)
+            max_workers: Processes to write step defs on
+
+        Returns:
+            Completion response code
+        """
+        if not issue_nums:
+            issue_nums = todo.get_open_issue_numbers(
+                self.repo_owner, self.repo_name, todo.feature_type
+            )
+        if not issue_nums:
+            logger.info("No issues to generate tests for")
+            return 0
+        with ThreadPoolExecutor(max_workers=GITHUB_WORKERS) as executor:
+            snapshots = list(
+                executor.map(
+                    lambda issue_num: todo.fetch_issue_snapshot(
+                        self.repo_owner, self.repo_name, issue_num
+                    ),
+                    issue_nums,
+                )
+            )
+        missing = [
+            issue_num
+            for issue_num, snapshot in zip(issue_nums, snapshots)
+            if snapshot is None
+        ]
+        if missing:
+            logger.error(f"Unable to fetch issues {missing}")
+        started = time.perf_counter()
+        results = tester.generate_tests(
+            self.repo_path,
+            [snapshot for snapshot in snapshots if snapshot is not None],
+            max_workers,
+        )
+        click.echo(format_generated_table(results))
+        logger.info(
+            f"Generated tests for {len(results)} issue(s) in "
+            f"{time.perf_counter() - started:.2f}s"
+        )
+        if missing or any(result.error for result in results):
+            return 1
         return 0
 
     def finish_issue(self, commit_msg: str) -> int:
@@ -510,7 +1045,9 @@ class Coder:
         logger.info(f"Deleted branch {branch_name}")
         return 0
 
-    def recommend_libraries(self, issue: Issue) -> Optional[Dict[str, str]]:
+    def recommend_libraries(
+        self, issue: todo.IssueLike
+    ) -> Optional[Dict[str, str]]:
         """
         Recommends a library based on an issue
         Args:
@@ -607,10 +1144,12 @@ class Coder:
         )
         if cp_add_lib.returncode == 0:
             logger.info(cp_add_lib.stdout)
+            # pdm updated the venv along with pyproject.toml and pdm.lock
+            envs.mark_ready(self.repo_path)
         else:
             logger.error(cp_add_lib.stderr)
 
-    def recommend_filename(self, issue: Issue, pkg_name="") -> str:
+    def recommend_filename(self, issue: todo.IssueLike, pkg_name="") -> str:
         """
         Recommend a filename to create or add to for the issue
         Args:
@@ -668,7 +1207,7 @@ class Coder:
 
     def write_src_code(
         self,
-        issue: Issue,
+        issue: todo.IssueLike,
         issue_type: str,
         src_file_name: str,
         recommended_libs: List[str],
@@ -688,101 +1227,6 @@ class Coder:
         Returns:
             None
         """
-        chat = ChatOpenAI(model_name=llm.CHAT_MODEL)
-        role_template = "You are a thoughtful python software developer."
-        # Plan steps for issue solution
-        # TODO: Consider adding project description for context in prompt
-        steps_template = (
-            "{role} Evaluate the following {issue_type} and comments. "
-            "Return a list of just the steps you would take to solve it.\n"
-            "{issue_type}: {issue_body}\n\nComments:\n{comments}"
-        )
-        steps_prompt = HumanMessagePromptTemplate(
-            prompt=PromptTemplate.from_template(steps_template)
-        )
-        steps_chat = ChatPromptTemplate.from_messages([steps_prompt])
-        steps_chain = LLMChain(
-            llm=chat,
-            prompt=steps_chat,
-            output_key="solution_steps",
-        )
-        # Critique steps
-        critique_template = (
-            "{role} Compare the following list of steps with the "
-            "{issue_type} and comments. Which steps are redundant, incorrect, "
-            "or can be simplified?\n{issue_type}: {issue_body}\n\n"
-            "Comments:\n{comments}\n"
-            "Steps:\n{solution_steps}"
-        )
-        critique_prompt = HumanMessagePromptTemplate(
-            prompt=PromptTemplate.from_template(critique_template)
-        )
-        critique_chat = ChatPromptTemplate.from_messages([critique_prompt])
-        critique_chain = LLMChain(
-            llm=chat,
-            prompt=critique_chat,
-            output_key="critique",
-        )
-        # Write updated steps
-        update_template = (
-            "{role}\n"
-            "For a solution to this {issue_type}:\n{issue_body}\n"
-            "With comments:\n{comments}\n"
-            "You wrote steps:\n{solution_steps}"
-            "You critiqued the steps:\n{critique}\n\n"
-            "Write what the steps should be (if there are no "
-            "changes needed, please repeat the steps)."
-        )
-        update_prompt = HumanMessagePromptTemplate(
-            prompt=PromptTemplate.from_template(update_template)
-        )
-        update_chat = ChatPromptTemplate.from_messages([update_prompt])
-        update_chain = LLMChain(
-            llm=chat,
-            prompt=update_chat,
-            output_key="updated_steps",
-        )
-        # Write source code
-        source_template = (
-            "{role} Write python code for the "
-            "following steps:\n{updated_steps}\n"
-            "You can use the following libraries:\n{use_libs}\n"
-            "The code produced should pass the following unit tests.\n"
-            "{unit_tests}\n"
-            "Respond with just the python code.\n"
-        )
-        source_prompt = HumanMessagePromptTemplate(
-            prompt=PromptTemplate.from_template(source_template)
-        )
-        source_chat = ChatPromptTemplate.from_messages([source_prompt])
-        source_chain = LLMChain(
-            llm=chat,
-            prompt=source_chat,
-            output_key="source_code",
-        )
-        create_source_chain = SequentialChain(
-            memory=SimpleMemory(memories={"role": role_template}),
-            chains=[
-                steps_chain,
-                critique_chain,
-                update_chain,
-                source_chain,
-            ],
-            input_variables=[
-                "issue_type",
-                "issue_body",
-                "comments",
-                "use_libs",
-                "unit_tests",
-            ],
-            output_variables=[
-                "solution_steps",
-                "critique",
-                "updated_steps",
-                "source_code",
-            ],
-            verbose=True,
-        )
         # Get comments
         comments = "\n".join(todo.get_issue_comments(issue))
         # Get existing imports
@@ -793,32 +1237,47 @@ class Coder:
         if src_file_path.exists():
             with open(src_file_path, "r") as fp:
                 src_file_contents = fp.read()
-        imports = []
-        if src_file_contents:
-            # Get existing imports in file
-            imports = [
-                line
-                for line in src_file_contents.split("\n")
-                if line.startswith("import") or line.startswith("from")
-            ]
+        # Get existing imports in file
+        existing = merge.analyze_imports(src_file_contents)
+        imports = list(existing.statements)
+        imported = {name for module, _, name, _ in existing.keys if not module}
         # Add recommended libraries to imports
         for lib in recommended_libs:
             import_lib = f"import {lib}"
-            if import_lib not in imports:
+            if lib not in imported and import_lib not in imports:
                 imports.append(import_lib)
         use_libs = "\n".join(imports)
 
-        result = create_source_chain(
-            {
-                "issue_type": issue_type,
-                "issue_body": issue.body,
-                "comments": comments,
-                "use_libs": use_libs,
-                "unit_tests": unit_tests,
-            }
-        )
+        context = f"{issue_type}: {issue.body}\n\nComments:\n{comments}"
+        mode = chains.choose_chain_mode(issue_type, context)
+        if mode == chains.CHAIN_COMPACT:
+            task = "python code"
+            if use_libs:
+                task += f" that can use these libraries:\n{use_libs}\n"
+            if unit_tests:
+                task += f" that passes these unit tests:\n{unit_tests}\n"
+            result = chains.run_compact_chain(
+                DEVELOPER_ROLE,
+                task,
+                f"Evaluate the following {issue_type} and comments.\n"
+                + context,
+                "steps",
+            )
+            response = result["code"]
+        else:
+            result = chains.run_conversation(
+                "Source code",
+                DEVELOPER_ROLE,
+                context,
+                SOURCE_TURNS,
+                {
+                    "issue_type": issue_type,
+                    "use_libs": use_libs,
+                    "unit_tests": unit_tests,
+                },
+            )
+            response = result["source_code"]
         # Write source code to file
-        response = result["source_code"]
         if response:
             if src_file_contents:
                 src_file_contents = add_text_to_module(
@@ -0,0 +1,380 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from pathlib import Path
+
+import tomli
+
+from pycodegen import cache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+VENV_DIR = ".venv"
+VENV_CACHE_NAMESPACE = "venvs"
+DEFAULT_PYTHON_VERSION = "3.9"
+# Written into a venv only once every provisioning step has succeeded
+READY_MARKER = ".pycodegen-ready"
+# Fields of pyproject.toml's project table that change what gets installed
+DEPENDENCY_FIELDS = (
+    "dependencies",
+    "optional-dependencies",
+    "requires-python",
+)
+LOCK_FILE = "pdm.lock"
+
+
+def python_version_from_pyproject(repo_path: Path) -> str:
+    """
+    Gets the Python version to create the venv with from requires-python
+    Args:
+        repo_path
+
+    Returns:
+        Python version (e.g. 3.9)
+    """
+    pyproject_path = repo_path.joinpath("pyproject.toml")
+    if not pyproject_path.exists():
+        return DEFAULT_PYTHON_VERSION
+    with open(pyproject_path, "rb") as pyproject:
+        project_conf = tomli.load(pyproject)
+    requires = project_conf.get("project", {}).get("requires-python")
+    if not requires:
+        return DEFAULT_PYTHON_VERSION
+    return requires.replace(">", "").replace("=", "")
+
+
+def file_digest(path: Path) -> str:
+    """Returns the sha256 of a file's contents ("" if it doesn't exist)"""
+    try:
+        return hashlib.sha256(path.read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return ""
+
+
+def dependency_fields(repo_path: Path) -> Dict[str, Any]:
+    """
+    Gets the dependency fields of a repo's pyproject.toml, so that changes
+    to anything else (like the version pdm bump writes) keep the venv
+    Args:
+        repo_path
+
+    Returns:
+        Dependency fields by name ({} without a valid pyproject.toml)
+    """
+    try:
+        with open(repo_path.joinpath("pyproject.toml"), "rb") as pyproject:
+            project_conf = tomli.load(pyproject)
+    except (OSError, tomli.TOMLDecodeError):
+        return {}
+    project = project_conf.get("project", {})
+    return {
+        field: project[field]
+        for field in DEPENDENCY_FIELDS
+        if field in project
+    }
+
+
+def venv_key(repo_path: Path, python_version: str) -> str:
+    """
+    Returns the cache key of the venv for a repo's dependencies
+    Args:
+        repo_path
+        python_version
+
+    Returns:
+        Hash of the dependency fields of pyproject.toml, pdm.lock and the
+        Python version
+    """
+    return cache.hash_key(
+        "venv",
+        python_version,
+        dependency_fields(repo_path),
+        file_digest(repo_path.joinpath(LOCK_FILE)),
+    )
+
+
+def venv_cache_dir() -> Path:
+    return cache.default_cache_dir().joinpath(VENV_CACHE_NAMESPACE)
+
+
+def read_marker(venv_path: Path) -> Optional[dict]:
+    try:
+        with open(venv_path.joinpath(READY_MARKER), "r") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def write_marker(
+    venv_path: Path,
+    key: str,
+    repo_path: Path,
+    location: Optional[Path] = None,
+) -> None:
+    """
+    Marks a venv ready, recording the paths its files refer to
+    Args:
+        venv_path
+        key: Cache key the venv was built for
+        repo_path: Repo the venv's editable install points at
+        location: Venv path its scripts refer to (defaults to venv_path)
+
+    Returns:
+        None
+    """
+    if location is None:
+        location = venv_path
+    marker_path = venv_path.joinpath(READY_MARKER)
+    # Replace rather than truncate, the marker may be hardlinked to a cache
+    tmp_path = marker_path.with_name(READY_MARKER + ".tmp")
+    with open(tmp_path, "w") as fp:
+        json.dump(
+            {"key": key, "repo": str(repo_path), "venv": str(location)}, fp
+        )
+    os.replace(tmp_path, marker_path)
+
+
+def is_ready(venv_path: Path, key: str) -> bool:
+    """Returns True if venv_path was fully provisioned for key"""
+    marker = read_marker(venv_path)
+    return marker is not None and marker.get("key") == key
+
+
+def run_commands(repo_path: Path, commands: List[List[str]]) -> bool:
+    """
+    Runs commands in a repo one after another, stopping at the first failure
+    Args:
+        repo_path
+        commands
+
+    Returns:
+        True if every command succeeded
+    """
+    for command in commands:
+        cp_command = subprocess.run(
+            command, cwd=repo_path, capture_output=True
+        )
+        if cp_command.returncode != 0:
+            logger.error(f"{' '.join(command)} failed: {cp_command.stderr}")
+            return False
+        # May be too much to push to logs
+        logger.debug(cp_command.stdout)
+    return True
+
+
+def run_steps(repo_path: Path, python_version: str) -> bool:
+    """
+    Creates the in-project venv with pdm and installs the project into it
+    Args:
+        repo_path
+        python_version
+
+    Returns:
+        True if every step succeeded
+    """
+    return run_commands(
+        repo_path,
+        [
+            ["pdm", "venv", "create", python_version, "-v"],
+            ["pdm", "use", python_version, "-i", "-f", "-vv"],
+            ["make", "install"],
+        ],
+    )
+
+
+def sync_venv(repo_path: Path) -> bool:
+    """
+    Installs a repo's current dependencies into its existing venv in place
+    Args:
+        repo_path
+
+    Returns:
+        True if pdm install succeeded
+    """
+    return run_commands(repo_path, [["pdm", "install"]])
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """Hardlinks a file, copying it when linking isn't possible"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def relocatable_files(venv_path: Path) -> List[Path]:
+    """
+    Returns the venv files that record absolute paths: scripts (shebangs
+    and activate), pyvenv.cfg and site-packages path hooks (.pth files and
+    editable install finders pointing at the repo)
+    """
+    files = [venv_path.joinpath("pyvenv.cfg")]
+    for bin_dir in ("bin", "Scripts"):
+        files.extend(venv_path.joinpath(bin_dir).glob("*"))
+    for site_packages in list(
+        venv_path.glob("lib/python*/site-packages")
+    ) + list(venv_path.glob("Lib/site-packages")):
+        files.extend(site_packages.glob("*.pth"))
+        files.extend(site_packages.glob("*.py"))
+    return [path for path in files if path.is_file() and not path.is_symlink()]
+
+
+def relocate(venv_path: Path, replacements: List[Tuple[str, str]]) -> None:
+    """
+    Rewrites absolute paths in a copied venv. Files are replaced rather
+    than edited in place so hardlinks into the shared cache aren't changed.
+    Args:
+        venv_path: Copied venv
+        replacements: (old path, new path) pairs
+
+    Returns:
+        None
+    """
+    paths = {
+        os.fsencode(old): os.fsencode(new)
+        for old, new in replacements
+        if old != new
+    }
+    if not paths:
+        return
+    # One pass, longest path first, so a venv inside the repo is replaced
+    # as a whole and replaced text isn't matched again
+    pattern = re.compile(
+        b"|".join(re.escape(old) for old in sorted(paths, key=len)[::-1])
+    )
+    for path in relocatable_files(venv_path):
+        try:
+            content = path.read_bytes()
+        except OSError:
+            continue
+        # Leave binaries (like Windows script launchers) alone
+        if b"\0" in content:
+            continue
+        updated = pattern.sub(lambda match: paths[match.group(0)], content)
+        if updated == content:
+            continue
+        tmp_path = path.with_name(path.name + ".relocate")
+        tmp_path.write_bytes(updated)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+
+
+def copy_venv(
+    src_path: Path,
+    dst_path: Path,
+    repo_path: Optional[Path] = None,
+    location: Optional[Path] = None,
+) -> None:
+    """
+    Copies a venv with hardlinks and points its paths at the new location
+    Args:
+        src_path: Ready venv
+        dst_path: Venv to create
+        repo_path: Repo the new venv belongs to (None to keep pointing at
+            the source repo)
+        location: Venv path the copy's scripts should refer to (defaults to
+            dst_path)
+
+    Returns:
+        None
+    """
+    if location is None:
+        location = dst_path
+    marker = read_marker(src_path) or {}
+    shutil.copytree(
+        src_path, dst_path, symlinks=True, copy_function=link_or_copy
+    )
+    replacements = [(marker.get("venv", str(src_path)), str(location))]
+    if repo_path is not None and marker.get("repo"):
+        replacements.append((marker["repo"], str(repo_path)))
+    relocate(dst_path, replacements)
+
+
+def store_venv(venv_path: Path, key: str) -> None:
+    """Adds a ready venv to the shared cache if it isn't there already"""
+    cached_path = venv_cache_dir().joinpath(key)
+    if cached_path.exists():
+        return
+    tmp_path = cached_path.with_name(f"{key}.{os.getpid()}.tmp")
+    try:
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        copy_venv(venv_path, tmp_path, location=cached_path)
+        marker = read_marker(venv_path)
+        write_marker(tmp_path, key, Path(marker["repo"]), cached_path)
+        # Rename is atomic. If another process got there first, keep theirs
+        os.rename(tmp_path, cached_path)
+    except OSError as oe:
+        logger.warning(f"Unable to cache venv {key}: {oe}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def mark_ready(repo_path: Path) -> None:
+    """
+    Marks a repo's venv ready for its current dependencies, after changing
+    them with pdm in place (so the venv isn't rebuilt next time)
+    """
+    venv_path = repo_path.joinpath(VENV_DIR)
+    if not venv_path.exists():
+        return
+    key = venv_key(repo_path, python_version_from_pyproject(repo_path))
+    write_marker(venv_path, key, repo_path)
+    store_venv(venv_path, key)
+
+
+def provision_venv(repo_path: Path) -> bool:
+    """
+    Makes sure a repo has a ready in-project venv for its current
+    dependencies. Reuses the existing venv if it's ready and updates it in
+    place with pdm install if it isn't (existing venvs are never deleted).
+    Without a venv, copies a ready venv from the shared cache, otherwise
+    builds one with pdm and adds it to the cache.
+    Args:
+        repo_path
+
+    Returns:
+        True if the venv is ready
+    """
+    venv_path = repo_path.joinpath(VENV_DIR)
+    python_version = python_version_from_pyproject(repo_path)
+    key = venv_key(repo_path, python_version)
+    if is_ready(venv_path, key):
+        return True
+    if venv_path.exists():
+        # Made outside pycodegen, or built for other dependencies
+        logger.info(f"Updating venv {venv_path}")
+        if not sync_venv(repo_path):
+            return False
+        write_marker(venv_path, key, repo_path)
+        store_venv(venv_path, key)
+        return True
+
+    cached_path = venv_cache_dir().joinpath(key)
+    if is_ready(cached_path, key):
+        logger.info(f"Using cached venv {key[:12]}")
+        try:
+            copy_venv(cached_path, venv_path, repo_path)
+            write_marker(venv_path, key, repo_path)
+            return True
+        except OSError as oe:
+            logger.warning(f"Unable to copy cached venv: {oe}")
+            shutil.rmtree(venv_path, ignore_errors=True)
+
+    logger.info(f"Creating venv for Python {python_version}")
+    if not run_steps(repo_path, python_version):
+        shutil.rmtree(venv_path, ignore_errors=True)
+        return False
+    write_marker(venv_path, key, repo_path)
+    store_venv(venv_path, key)
+    return True
@@ -0,0 +1,175 @@
+from typing import Callable, Optional
+
+import asyncio
+import logging
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+from pycodegen import cache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+LIMITER_DB_NAME = "ratelimit.sqlite3"
+# Seconds to wait for another process holding the database lock
+DB_TIMEOUT = 30
+
+
+class TokenBucketLimiter:
+    """
+    Requests per minute and tokens per minute budgets for an API, shared by
+    every process on the host through a SQLite database.
+
+    Each budget is a token bucket that refills continuously up to its per
+    minute limit. A request takes one request and its estimated tokens from
+    the buckets, waiting until both have enough.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_minute: int,
+        tokens_per_minute: int,
+        db_path: Optional[Path] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        Initializes a limiter
+        Args:
+            name: Budget name (processes using the same name share limits)
+            requests_per_minute: Maximum requests per minute
+            tokens_per_minute: Maximum tokens per minute
+            db_path: Shared database (defaults to the pycodegen cache dir)
+            clock: Wall clock time function shared by all processes
+        """
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.db_path = db_path
+        self.clock = clock
+
+    @property
+    def path(self) -> Path:
+        if self.db_path is not None:
+            return self.db_path
+        return cache.default_cache_dir().joinpath(LIMITER_DB_NAME)
+
+    def connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.path, timeout=DB_TIMEOUT, isolation_level=None
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            "name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated REAL)"
+        )
+        return conn
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Takes one request and tokens from the budget if both are available
+        Args:
+            tokens: Estimated tokens for the request
+
+        Returns:
+            0 if acquired, otherwise seconds to wait before trying again
+        """
+        # A request bigger than the whole bucket waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        try:
+            with closing(self.connect()) as conn:
+                # Lock out other processes until the budget is updated
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    wait = self.take(conn, tokens)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as se:
+            logger.warning(f"Rate limit database unavailable: {se}")
+            return 0
+        return wait
+
+    def take(self, conn: sqlite3.Connection, tokens: int) -> float:
+        now = self.clock()
+        row = conn.execute(
+            "SELECT requests, tokens, updated FROM buckets WHERE name = ?",
+            (self.name,),
+        ).fetchone()
+        if row is None:
+            requests_left = float(self.requests_per_minute)
+            tokens_left = float(self.tokens_per_minute)
+        else:
+            elapsed = max(0.0, now - row[2])
+            requests_left = min(
+                float(self.requests_per_minute),
+                row[0] + elapsed * self.requests_per_minute / MINUTE,
+            )
+            tokens_left = min(
+                float(self.tokens_per_minute),
+                row[1] + elapsed * self.tokens_per_minute / MINUTE,
+            )
+        if requests_left >= 1 and tokens_left >= tokens:
+            requests_left -= 1
+            tokens_left -= tokens
+            wait = 0.0
+        else:
+            wait = max(
+                (1 - requests_left) * MINUTE / self.requests_per_minute,
+                (tokens - tokens_left) * MINUTE / self.tokens_per_minute,
+            )
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (name, requests, tokens, updated) "
+            "VALUES (?, ?, ?, ?)",
+            (self.name, requests_left, tokens_left, now),
+        )
+        return wait
+
+    def acquire(self, tokens: int) -> None:
+        """Waits until the request fits in the budget and takes it"""
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            logger.debug(f"Rate limit reached. Waiting {wait:.1f}s.")
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int) -> None:
+        """Async version of acquire"""
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if wait <= 0:
+                return
+            logger.debug(f"Rate limit reached. Waiting {wait:.1f}s.")
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, used_tokens: int) -> None:
+        """
+        Corrects the token budget once the actual usage of a request is known
+        Args:
+            estimated_tokens: Tokens taken when the request was acquired
+            used_tokens: Tokens the API reported using
+
+        Returns:
+            None
+        """
+        difference = estimated_tokens - used_tokens
+        if not difference:
+            return
+        try:
+            with closing(self.connect()) as conn:
+                conn.execute(
+                    "UPDATE buckets SET tokens = MIN(?, tokens + ?) "
+                    "WHERE name = ?",
+                    (self.tokens_per_minute, difference, self.name),
+                )
+        except sqlite3.Error as se:
+            logger.warning(f"Rate limit database unavailable: {se}")
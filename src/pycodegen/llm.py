@@ -1,23 +1,62 @@
-from typing import Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
 
+import asyncio
 import logging
 import os
+from contextlib import asynccontextmanager
+
+from reretry import retry_call
+
+from pycodegen import cache, limiter
+
+if TYPE_CHECKING:
+    import aiohttp
+    import tiktoken
 
-import openai
-import tiktoken
-from backoff import expo, on_exception
-from openai import APIError
-from ratelimit import RateLimitException, limits
-from reretry import retry
+StopPredicate = Callable[[str], bool]
 
 CODER_ROLE = {
     "role": "system",
     "content": "You are a helpful and efficient developer.",
 }
 MINUTE = 60
+RATE_LIMIT_CALLS = 20
+RATE_LIMIT_TOKENS = 40_000
+# Reply tokens to reserve when a request doesn't set max_tokens
+RESPONSE_TOKEN_ESTIMATE = 512
+RETRY_TRIES = 8
+MAX_CONCURRENCY = 4
+MAX_CONNECTIONS = 8
 CHAT_MODEL = "gpt-3.5-turbo"
 CH_MAX_TOKENS = 4096
 
+LLM_CACHE_ENV = "PYCODEGEN_LLM_CACHE"
+CACHE_ON = "on"
+CACHE_OFF = "off"
+CACHE_REFRESH = "refresh"
+CACHE_MODES = (CACHE_ON, CACHE_OFF, CACHE_REFRESH)
+LLM_CACHE_TTL = 7 * 24 * 60 * 60
+LLM_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+response_cache = cache.DiskCache(
+    "llm", ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES
+)
+cache_mode: Optional[str] = None
+encodings: Dict[str, "tiktoken.Encoding"] = {}
+rate_limiter = limiter.TokenBucketLimiter(
+    "openai", RATE_LIMIT_CALLS, RATE_LIMIT_TOKENS
+)
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -52,48 +91,466 @@ def prompt_to_messages(
     ]
 
 
-def complete_prompt(prompt: str) -> str:
+def complete_prompt(prompt: str, **kwargs: Any) -> str:
     """Converts prompt to messages and sends to respond function and returns
     response."""
     messages = prompt_to_messages(prompt)
-    return respond(messages)
+    return respond(messages, **kwargs)
+
+
+def set_cache_mode(mode: Optional[str]) -> None:
+    """Overrides the response cache mode (on, off or refresh) for this
+    process. None falls back to the PYCODEGEN_LLM_CACHE environment
+    variable."""
+    global cache_mode
+    if mode is not None and mode not in CACHE_MODES:
+        raise ValueError(
+            f"Unknown cache mode {mode}. Use one of {CACHE_MODES}"
+        )
+    cache_mode = mode
+
+
+def get_cache_mode() -> str:
+    """Returns the active response cache mode."""
+    mode = cache_mode or os.getenv(LLM_CACHE_ENV, CACHE_ON).lower()
+    if mode not in CACHE_MODES:
+        logger.warning(f"Unknown {LLM_CACHE_ENV}={mode}. Using {CACHE_ON}.")
+        return CACHE_ON
+    return mode
+
+
+def response_cache_key(
+    messages: List[Dict[str, str]], model=CHAT_MODEL, **params: Any
+) -> str:
+    """Returns the cache key for a request to model with sampling params."""
+    return cache.hash_key(model, messages, params)
+
+
+def resolve_cache_settings(
+    use_cache: Optional[bool], refresh: Optional[bool]
+) -> Tuple[bool, bool]:
+    """Fills in unset use_cache/refresh flags from the cache mode."""
+    mode = get_cache_mode()
+    if use_cache is None:
+        use_cache = mode != CACHE_OFF
+    if refresh is None:
+        refresh = mode == CACHE_REFRESH
+    return use_cache, refresh
 
 
-@retry(APIError, tries=8, delay=1, backoff=2)
-@on_exception(expo, RateLimitException, max_tries=8)
-@limits(calls=20, period=MINUTE)
 def respond(
     messages: List[Dict[str, str]],
+    use_cache: Optional[bool] = None,
+    refresh: Optional[bool] = None,
+    stop_when: Optional[StopPredicate] = None,
+    **params: Any,
+) -> str:
+    """
+    Returns the response to messages, from the on-disk response cache when
+    the same request was made before. Cache hits don't count against the
+    rate limit.
+    Args:
+        messages: Chat messages to send
+        use_cache: Read and write the cache (defaults to the cache mode)
+        refresh: Skip reading the cache but store the new response
+        stop_when: Stream the response and stop once this returns True
+            for the text so far (e.g. closing_code_fence)
+        params: Sampling parameters passed through to the API
+
+    Returns:
+        Response content ("" on failure)
+    """
+    use_cache, refresh = resolve_cache_settings(use_cache, refresh)
+    if stop_when is not None:
+        # A truncated response is only valid for the same predicate
+        key = response_cache_key(
+            messages, CHAT_MODEL, stop_when=stop_key(stop_when), **params
+        )
+    else:
+        key = response_cache_key(messages, CHAT_MODEL, **params)
+    if use_cache and not refresh:
+        cached = response_cache.get(key)
+        if cached is not None:
+            logger.debug(f"Using cached response {key}")
+            return str(cached)
+    if stop_when is not None:
+        response = stream_response(messages, stop_when, **params)
+    else:
+        response = request_response(messages, **params)
+    if use_cache and response:
+        response_cache.set(key, response)
+    return response
+
+
+def estimate_request_tokens(
+    messages: List[Dict[str, Any]], **params: Any
+) -> int:
+    """Returns the tokens a request is expected to use (prompt and reply)."""
+    reply_tokens = params.get("max_tokens") or RESPONSE_TOKEN_ESTIMATE
+    return num_tokens_from_messages(messages) + int(reply_tokens)
+
+
+def record_usage(estimated_tokens: int, response: Any) -> None:
+    """Corrects the shared token budget with the usage the API reported."""
+    try:
+        used_tokens = int(response["usage"]["total_tokens"])
+    except (KeyError, TypeError, ValueError):
+        return
+    rate_limiter.record_usage(estimated_tokens, used_tokens)
+
+
+def request_response(
+    messages: List[Dict[str, str]],
+    **params: Any,
+) -> str:
+    """Sends request to ChatGPT service and returns response. Waits for the
+    rate limit shared by all processes on the host first."""
+    return retry_request(create_response, messages, **params)
+
+
+def stream_response(
+    messages: List[Dict[str, str]],
+    stop_when: StopPredicate,
+    **params: Any,
+) -> str:
+    """Streams the response to a request until stop_when returns True,
+    retrying like request_response when the request fails"""
+    return retry_request(collect_stream, messages, stop_when, **params)
+
+
+def collect_stream(
+    messages: List[Dict[str, str]],
+    stop_when: StopPredicate,
+    **params: Any,
+) -> str:
+    return "".join(stream_respond(messages, stop_when, **params))
+
+
+def retry_request(
+    create: Callable[..., str],
+    messages: List[Dict[str, str]],
+    *args: Any,
+    **params: Any,
+) -> str:
+    """
+    Calls create for a request, retrying with backoff on API errors
+    Args:
+        create: Sends the request and returns the response content
+        messages: Chat messages to send
+        args: More arguments for create
+        params: Sampling parameters passed through to the API
+
+    Returns:
+        Response content ("" if every try failed)
+    """
+    import openai
+
+    try:
+        return retry_call(
+            create,
+            fargs=[messages, *args],
+            fkwargs=params,
+            exceptions=openai.APIError,
+            tries=RETRY_TRIES,
+            delay=1,
+            backoff=2,
+        )
+    except openai.APIError as ae:
+        logger.error(f"Request failed {RETRY_TRIES} times: {ae}")
+        logger.debug(f" from: {messages}")
+        return ""
+
+
+def create_response(
+    messages: List[Dict[str, str]],
+    **params: Any,
 ) -> str:
-    """Sends request to ChatGPT service and returns response."""
+    import openai
+
     openai.api_key = get_api_key_from_env()
+    estimated_tokens = estimate_request_tokens(messages, **params)
+    rate_limiter.acquire(estimated_tokens)
     try:
         response = openai.ChatCompletion.create(
             model=CHAT_MODEL,
             messages=messages,
+            **params,
         )
+        record_usage(estimated_tokens, response)
         return str(response["choices"][0]["message"]["content"])
+    except openai.APIError:
+        # Retried by request_response
+        raise
     except Exception as e:
         logger.error(e)
         logger.debug(f" from: {messages}")
         return ""
 
 
+def stop_key(stop_when: StopPredicate) -> str:
+    """Returns the name a stop predicate is cached under. Qualified names
+    (and the line of lambdas) keep predicates from different places
+    apart."""
+    module = getattr(stop_when, "__module__", None) or ""
+    name = getattr(stop_when, "__qualname__", None) or repr(stop_when)
+    code = getattr(stop_when, "__code__", None)
+    if "<lambda>" in name and code is not None:
+        name += f":{code.co_firstlineno}"
+    return f"{module}.{name}"
+
+
+def closing_code_fence(text: str) -> bool:
+    """Returns True once text contains a complete fenced code block."""
+    start_idx = text.find("```")
+    if start_idx == -1:
+        return False
+    code_idx = text.find("\n", start_idx)
+    if code_idx == -1:
+        return False
+    return text.find("```", code_idx) != -1
+
+
+def stream_respond(
+    messages: List[Dict[str, str]],
+    stop_when: Optional[StopPredicate] = None,
+    **params: Any,
+) -> Iterator[str]:
+    """
+    Sends request to ChatGPT service and yields the response as it arrives
+    Args:
+        messages: Chat messages to send
+        stop_when: Stops the response once this returns True for the text
+            received so far
+        params: Sampling parameters passed through to the API
+
+    Returns:
+        Pieces of response content
+    """
+    import openai
+
+    openai.api_key = get_api_key_from_env()
+    estimated_tokens = estimate_request_tokens(messages, **params)
+    rate_limiter.acquire(estimated_tokens)
+    text = ""
+    try:
+        for chunk in openai.ChatCompletion.create(
+            model=CHAT_MODEL,
+            messages=messages,
+            stream=True,
+            **params,
+        ):
+            content = chunk["choices"][0]["delta"].get("content")
+            if not content:
+                continue
+            text += content
+            yield content
+            if stop_when is not None and stop_when(text):
+                logger.debug("Stopped response early")
+                break
+    except openai.APIError as ae:
+        if not text:
+            # Nothing was yielded yet, so the request can be retried
+            raise
+        logger.error(f"Response cut short: {ae}")
+        logger.debug(f" from: {messages}")
+    except Exception as e:
+        logger.error(e)
+        logger.debug(f" from: {messages}")
+    finally:
+        # Streamed responses don't report usage
+        rate_limiter.record_usage(
+            estimated_tokens,
+            num_tokens_from_messages(messages) + count_tokens(text),
+        )
+
+
+@asynccontextmanager
+async def pooled_session() -> AsyncIterator["aiohttp.ClientSession"]:
+    """Shares one pooled HTTP session with every async request made inside
+    the context. Reuses the session if one is already active."""
+    import aiohttp
+    import openai
+
+    session = openai.aiosession.get()
+    if session is not None:
+        yield session
+        return
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+
+
+async def acomplete_prompt(prompt: str, **kwargs: Any) -> str:
+    """Async version of complete_prompt."""
+    messages = prompt_to_messages(prompt)
+    return await arespond(messages, **kwargs)
+
+
+async def arespond(
+    messages: List[Dict[str, str]],
+    use_cache: Optional[bool] = None,
+    refresh: Optional[bool] = None,
+    **params: Any,
+) -> str:
+    """Async version of respond. Shares the response cache."""
+    use_cache, refresh = resolve_cache_settings(use_cache, refresh)
+    key = response_cache_key(messages, CHAT_MODEL, **params)
+    if use_cache and not refresh:
+        cached = response_cache.get(key)
+        if cached is not None:
+            logger.debug(f"Using cached response {key}")
+            return str(cached)
+    response = await arequest_response(messages, **params)
+    if use_cache and response:
+        response_cache.set(key, response)
+    return response
+
+
+async def arequest_response(
+    messages: List[Dict[str, str]],
+    **params: Any,
+) -> str:
+    """Sends request to ChatGPT service without blocking the event loop and
+    returns response. Retries API and rate limit errors with backoff."""
+    import openai
+
+    openai.api_key = get_api_key_from_env()
+    estimated_tokens = estimate_request_tokens(messages, **params)
+    delay = 1
+    for _ in range(RETRY_TRIES):
+        await rate_limiter.aacquire(estimated_tokens)
+        try:
+            response = await openai.ChatCompletion.acreate(
+                model=CHAT_MODEL,
+                messages=messages,
+                **params,
+            )
+            record_usage(estimated_tokens, response)
+            return str(response["choices"][0]["message"]["content"])
+        except (openai.APIError, openai.error.RateLimitError) as e:
+            logger.warning(f"{e}. Retrying in {delay}s.")
+            await asyncio.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            logger.error(e)
+            logger.debug(f" from: {messages}")
+            return ""
+    logger.error(f"No response after {RETRY_TRIES} tries.")
+    return ""
+
+
+async def agather_prompts(
+    prompts: List[str],
+    max_concurrency: int = MAX_CONCURRENCY,
+    **kwargs: Any,
+) -> List[str]:
+    """
+    Completes prompts concurrently over one pooled session
+    Args:
+        prompts: Prompts to complete
+        max_concurrency: Maximum number of requests in flight
+        kwargs: Passed through to acomplete_prompt
+
+    Returns:
+        Responses in the same order as prompts
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def complete(prompt: str) -> str:
+        async with semaphore:
+            return await acomplete_prompt(prompt, **kwargs)
+
+    async with pooled_session():
+        return list(await asyncio.gather(*(complete(p) for p in prompts)))
+
+
+def gather_prompts(
+    prompts: List[str],
+    max_concurrency: int = MAX_CONCURRENCY,
+    **kwargs: Any,
+) -> List[str]:
+    """Completes prompts concurrently from synchronous code. Must not be
+    called from a running event loop (use agather_prompts instead)."""
+    if not prompts:
+        return []
+    return asyncio.run(agather_prompts(prompts, max_concurrency, **kwargs))
+
+
+def get_encoding(model=CHAT_MODEL) -> "tiktoken.Encoding":
+    """Returns the tokenizer for model, loading it only once per process."""
+    encoding = encodings.get(model)
+    if encoding is None:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        encodings[model] = encoding
+    return encoding
+
+
+def count_tokens(text: str, model=CHAT_MODEL) -> int:
+    """Returns the number of tokens in text (without message formatting)."""
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+class TokenCounter:
+    """
+    Running token count of text that is built up in parts. Each part is
+    counted once when it's added (or added with a count already known), so
+    the total never needs recounting.
+    """
+
+    def __init__(
+        self,
+        model=CHAT_MODEL,
+        count: Optional[Callable[[str], int]] = None,
+    ):
+        """
+        Starts a count at 0
+        Args:
+            model: Model whose tokenizer counts parts
+            count: Function counting the tokens of a part (defaults to
+                count_tokens with model)
+        """
+        self.model = model
+        self.count = count
+        self.total = 0
+
+    def add(self, text: str, tokens: Optional[int] = None) -> int:
+        """Adds text to the count and returns the tokens in text. Pass
+        tokens if they're already known to skip counting them again."""
+        if tokens is None:
+            if self.count is None:
+                tokens = count_tokens(text, self.model)
+            else:
+                tokens = self.count(text)
+        self.total += tokens
+        return tokens
+
+    def reset(self) -> None:
+        self.total = 0
+
+
 def num_tokens_from_messages(
     messages: List[Dict[str, str]], model=CHAT_MODEL
 ) -> int:
     """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
     if model == CHAT_MODEL:  # note: future models may deviate from this
         num_tokens = 0
         for message in messages:
             num_tokens += 4  # every message follows <im_start>{
             # role/name}\n{content}<im_end>\n
             for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
+                num_tokens += len(
+                    encoding.encode(value, disallowed_special=())
+                )
                 if key == "name":  # if there's a name, the role is omitted
                     num_tokens += -1  # role is always required and always 1
                     # token
@@ -0,0 +1,472 @@
+from typing import (
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+import ast
+import hashlib
+import logging
+import re
+import textwrap
+from dataclasses import dataclass
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+MAIN_GUARD = 'if __name__ == "__main__":'
+# Analyses of module texts kept by content hash
+IMPORT_CACHE_SIZE = 512
+# Fallback for modules that aren't valid python
+IMPORT_LINE_RE = re.compile(r"^\s*(?:import|from)\s")
+
+# Module (None for import x), level, name and alias of an imported name
+ImportKey = Tuple[Optional[str], int, str, Optional[str]]
+ImportNode = Union[ast.Import, ast.ImportFrom]
+FunctionNode = Union[ast.FunctionDef, ast.AsyncFunctionDef]
+# Start line index, end line index (exclusive) and replacement text
+Edit = Tuple[int, int, str]
+
+
+def import_keys(node: ImportNode) -> List[ImportKey]:
+    """Returns a key for each name an import statement imports"""
+    if isinstance(node, ast.Import):
+        return [(None, 0, alias.name, alias.asname) for alias in node.names]
+    return [
+        (node.module, node.level, alias.name, alias.asname)
+        for alias in node.names
+    ]
+
+
+@dataclass(frozen=True)
+class ImportInfo:
+    """
+    The top-level imports of a module. end is the offset just past the last
+    import's line (before its newline) and last_line is that line's number,
+    both 0 if the module has no imports. has_logging is True if the module
+    already imports logging.
+    """
+
+    statements: Tuple[str, ...]
+    keys: FrozenSet[ImportKey]
+    end: int
+    last_line: int
+    has_logging: bool
+
+
+LOGGING_IMPORT: ImportKey = (None, 0, "logging", None)
+
+import_infos: Dict[str, ImportInfo] = {}
+
+
+def tree_imports(text: str, tree: ast.Module) -> ImportInfo:
+    """Reads the imports of a parsed module in one pass over its body"""
+    lines = text.splitlines(keepends=True)
+    statements = []
+    keys: Set[ImportKey] = set()
+    last_line = 0
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            statements.append(
+                "".join(lines[node.lineno - 1 : node.end_lineno]).rstrip()
+            )
+            keys.update(import_keys(node))
+            last_line = node.end_lineno
+    end = 0
+    if last_line:
+        end = sum(len(line) for line in lines[:last_line])
+        end -= len(lines[last_line - 1]) - len(
+            lines[last_line - 1].rstrip("\r\n")
+        )
+    return ImportInfo(
+        tuple(statements),
+        frozenset(keys),
+        end,
+        last_line,
+        LOGGING_IMPORT in keys,
+    )
+
+
+def scan_imports(text: str) -> ImportInfo:
+    """Reads the imports of a module that doesn't parse, line by line"""
+    statements = []
+    end = 0
+    last_line = 0
+    offset = 0
+    for number, line in enumerate(text.splitlines(keepends=True), 1):
+        if IMPORT_LINE_RE.match(line):
+            statements.append(line.strip())
+            end = offset + len(line.rstrip("\r\n"))
+            last_line = number
+        offset += len(line)
+    return ImportInfo(
+        tuple(statements),
+        frozenset(),
+        end,
+        last_line,
+        "import logging" in text,
+    )
+
+
+def analyze_imports(
+    text: str, tree: Optional[ast.Module] = None
+) -> ImportInfo:
+    """
+    Analyzes the imports of a module, caching the result by content hash
+    Args:
+        text: Module source
+        tree: Module already parsed from text (parsed here if None)
+
+    Returns:
+        Imports of the module. Modules that aren't valid python are scanned
+        line by line instead, without import keys.
+    """
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    info = import_infos.get(digest)
+    if info is not None:
+        return info
+    try:
+        info = tree_imports(text, tree or ast.parse(text))
+    except SyntaxError:
+        logger.debug("Module doesn't parse. Scanning its imports as text.")
+        info = scan_imports(text)
+    if len(import_infos) >= IMPORT_CACHE_SIZE:
+        # Forget the oldest analysis
+        del import_infos[next(iter(import_infos))]
+    import_infos[digest] = info
+    return info
+
+
+def is_main_guard(node: ast.stmt) -> bool:
+    """Returns True for if __name__ == "__main__":"""
+    return (
+        isinstance(node, ast.If)
+        and isinstance(node.test, ast.Compare)
+        and isinstance(node.test.left, ast.Name)
+        and node.test.left.id == "__name__"
+        and len(node.test.comparators) == 1
+        and isinstance(node.test.comparators[0], ast.Constant)
+        and node.test.comparators[0].value == "__main__"
+    )
+
+
+def is_docstring(node: ast.stmt) -> bool:
+    return (
+        isinstance(node, ast.Expr)
+        and isinstance(node.value, ast.Constant)
+        and isinstance(node.value.value, str)
+    )
+
+
+def node_start(node: ast.stmt) -> int:
+    """Returns the first line of a statement, including its decorators"""
+    decorators = getattr(node, "decorator_list", [])
+    return min([node.lineno] + [decorator.lineno for decorator in decorators])
+
+
+def node_text(lines: List[str], node: ast.stmt) -> str:
+    """Returns the source lines of a statement"""
+    text = "".join(lines[node_start(node) - 1 : node.end_lineno])
+    return text if text.endswith("\n") else text + "\n"
+
+
+def reindent(text: str, indent: int) -> str:
+    return textwrap.indent(textwrap.dedent(text), " " * indent)
+
+
+def parse_snippet(text: str) -> Optional[Tuple[ast.Module, List[str]]]:
+    """
+    Parses code to merge, dedenting it if it was copied from inside a block
+    Args:
+        text: Code
+
+    Returns:
+        Module and its source lines (None if the code isn't valid python)
+    """
+    for source in (text, textwrap.dedent(text)):
+        try:
+            return ast.parse(source), source.splitlines(keepends=True)
+        except SyntaxError:
+            continue
+    return None
+
+
+def insert_text(module_text: str, text_to_add: str) -> str:
+    """
+    Adds text to module text without parsing either, after the first class
+    or before the main guard. Used when the module isn't valid python.
+    Args:
+        module_text
+        text_to_add
+
+    Returns:
+        Updated module text
+    """
+    class_loc = module_text.find("class ")
+    main_loc = module_text.find(MAIN_GUARD)
+    if class_loc != -1:
+        end_of_class = module_text.find("\n\n\n", class_loc)
+        if end_of_class == -1:
+            # Nothing after last class function
+            module_text += "\n\n" + text_to_add + "\n"
+        else:
+            # Adding text to end of class
+            module_text = (
+                f"{module_text[:end_of_class + 2]}"
+                f"{text_to_add}"
+                f"{module_text[end_of_class + 2:]}"
+            )
+    elif main_loc != -1:
+        # No class, but main function needs to stay at end
+        module_text = (
+            f"{module_text[:main_loc]}"
+            f"{text_to_add}\n\n\n"
+            f"{module_text[main_loc:]}"
+        )
+    else:
+        # No class or main function, just add to end
+        module_text += "\n\n" + text_to_add + "\n"
+    return module_text
+
+
+class ModuleMerger:
+    """
+    Merges code snippets into a module with one parse of the module and one
+    rebuild of its text. Imports are hoisted below the module's imports
+    (skipping names it already imports), functions and methods that exist
+    are replaced, new members of existing classes go at the end of the
+    class, indented code goes in the module's class if it has just one, and
+    everything else goes before the main guard (or at the end).
+    Comments and formatting outside replaced code are kept.
+    """
+
+    def __init__(self, module_text: str):
+        """
+        Parses the module
+        Args:
+            module_text: Module source
+
+        Raises:
+            SyntaxError if the module isn't valid python
+        """
+        tree = ast.parse(module_text)
+        self.lines = module_text.splitlines(keepends=True)
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        imports = analyze_imports(module_text, tree)
+        self.imported: Set[ImportKey] = set(imports.keys)
+        self.functions: Dict[str, FunctionNode] = {}
+        self.classes: Dict[str, ast.ClassDef] = {}
+        self.main_guard: Optional[ast.If] = None
+        # Line index new imports go at
+        self.import_line = 0
+        if tree.body and is_docstring(tree.body[0]):
+            # After the module docstring
+            self.import_line = tree.body[0].end_lineno
+        if imports.last_line:
+            self.import_line = imports.last_line
+        for node in tree.body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                self.functions[node.name] = node
+            elif isinstance(node, ast.ClassDef):
+                self.classes[node.name] = node
+            elif self.main_guard is None and is_main_guard(node):
+                self.main_guard = node
+        self.new_imports: List[str] = []
+        self.replaced: Dict[str, str] = {}
+        # Members to merge by class, keyed by "def <name>" for methods and
+        # by statement dump otherwise
+        self.members: Dict[str, Dict[str, str]] = {}
+        # New top-level code by name (or statement dump), in order
+        self.added: Dict[str, str] = {}
+
+    def add_import(self, node: ImportNode, text: str) -> None:
+        keys = import_keys(node)
+        new_keys = [key for key in keys if key not in self.imported]
+        if not new_keys:
+            return
+        self.imported.update(new_keys)
+        if len(new_keys) < len(keys):
+            # Import just the new names
+            names = [
+                alias
+                for alias, key in zip(node.names, keys)
+                if key in new_keys
+            ]
+            if isinstance(node, ast.Import):
+                node = ast.Import(names=names)
+            else:
+                node = ast.ImportFrom(
+                    module=node.module, names=names, level=node.level
+                )
+            text = ast.unparse(node) + "\n"
+        self.new_imports.append(textwrap.dedent(text))
+
+    def add_if_import(self, node: ast.stmt, lines: List[str]) -> bool:
+        """Adds node if it's an import and returns whether it was"""
+        if not isinstance(node, (ast.Import, ast.ImportFrom)):
+            return False
+        self.add_import(node, node_text(lines, node))
+        return True
+
+    def add_members(
+        self, name: str, members: Sequence[ast.stmt], lines: List[str]
+    ) -> None:
+        """
+        Merges members into a class the module already has. Methods are
+        keyed by name (so they replace methods with that name), other
+        members by their statement dump (so identical ones aren't added
+        twice). Docstrings are left out, the class keeps its own.
+        """
+        class_members = self.members.setdefault(name, {})
+        for member in members:
+            if is_docstring(member):
+                continue
+            if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                class_members[f"def {member.name}"] = node_text(lines, member)
+            else:
+                class_members.setdefault(
+                    ast.dump(member), node_text(lines, member)
+                )
+
+    def add(self, snippet: str) -> None:
+        """
+        Adds a snippet to merge
+        Args:
+            snippet: Python code
+
+        Returns:
+            None
+        """
+        parsed = parse_snippet(snippet)
+        if parsed is None:
+            logger.warning("Code to add isn't valid python. Adding as is.")
+            self.added[f"text {len(self.added)}"] = snippet.strip("\n") + "\n"
+            return
+        tree, lines = parsed
+        if snippet.lstrip("\n")[:1].isspace() and len(self.classes) == 1:
+            # Copied from inside a class, so it belongs in the module's
+            # only class
+            (name,) = self.classes
+            self.add_members(
+                name,
+                [
+                    node
+                    for node in tree.body
+                    if not self.add_if_import(node, lines)
+                ],
+                lines,
+            )
+            return
+        for node in tree.body:
+            if self.add_if_import(node, lines):
+                continue
+            text = node_text(lines, node)
+            if (
+                isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+                and node.name in self.functions
+            ):
+                self.replaced[node.name] = text
+            elif isinstance(node, ast.ClassDef) and node.name in self.classes:
+                self.add_members(node.name, node.body, lines)
+            elif isinstance(
+                node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+            ):
+                self.added[f"def {node.name}"] = text
+            elif not is_main_guard(node) or self.main_guard is None:
+                # Identical statements are only added once
+                self.added.setdefault(ast.dump(node), text)
+
+    def class_edits(self, name: str, members: Dict[str, str]) -> List[Edit]:
+        """Returns the edits replacing and adding members of a class"""
+        node = self.classes[name]
+        indent = node.body[0].col_offset
+        existing: Dict[str, ast.stmt] = {}
+        for member in node.body:
+            if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                existing[f"def {member.name}"] = member
+            else:
+                existing[ast.dump(member)] = member
+        edits = []
+        appended = []
+        for key, text in members.items():
+            member = existing.get(key)
+            if member is None:
+                appended.append("\n" + reindent(text, indent))
+            elif key.startswith("def "):
+                edits.append(
+                    (
+                        node_start(member) - 1,
+                        member.end_lineno,
+                        reindent(text, indent),
+                    )
+                )
+        if appended:
+            edits.append((node.end_lineno, node.end_lineno, "".join(appended)))
+        return edits
+
+    def edits(self) -> List[Edit]:
+        edits = []
+        if self.new_imports:
+            edits.append(
+                (self.import_line, self.import_line, "".join(self.new_imports))
+            )
+        for name, text in self.replaced.items():
+            node = self.functions[name]
+            edits.append((node_start(node) - 1, node.end_lineno, text))
+        for name, members in self.members.items():
+            edits.extend(self.class_edits(name, members))
+        if self.added:
+            blocks = [text.rstrip("\n") for text in self.added.values()]
+            if self.main_guard is not None:
+                # Main guard needs to stay at the end
+                line = node_start(self.main_guard) - 1
+                text = "".join(block + "\n\n\n" for block in blocks)
+            else:
+                line = len(self.lines)
+                text = "".join("\n\n" + block + "\n" for block in blocks)
+            edits.append((line, line, text))
+        return edits
+
+    def text(self) -> str:
+        """Returns the module text with every added snippet merged"""
+        parts = []
+        cursor = 0
+        for start, end, text in sorted(self.edits(), key=lambda e: e[:2]):
+            parts.extend(self.lines[cursor:start])
+            parts.append(text)
+            cursor = max(cursor, end)
+        parts.extend(self.lines[cursor:])
+        return "".join(parts)
+
+
+def merge_snippets(module_text: str, snippets: Sequence[str]) -> str:
+    """
+    Merges code snippets into a module (see ModuleMerger), falling back to
+    inserting them as text if the module isn't valid python
+    Args:
+        module_text: Module source
+        snippets: Code to add
+
+    Returns:
+        Updated module text
+    """
+    try:
+        merger = ModuleMerger(module_text)
+    except SyntaxError as se:
+        logger.warning(f"Unable to parse module, adding code as text: {se}")
+        for snippet in snippets:
+            module_text = insert_text(module_text, snippet)
+        return module_text
+    for snippet in snippets:
+        merger.add(snippet)
+    return merger.text()
@@ -0,0 +1,162 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import logging
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 4
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A step of a pipeline. run is called with the results of the stages it
+    requires as keyword arguments named after them.
+    """
+
+    name: str
+    run: Callable[..., Any]
+    requires: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class StageTiming:
+    name: str
+    started: float
+    seconds: float
+
+
+def check_stages(stages: Iterable[Stage]) -> Dict[str, Stage]:
+    """
+    Indexes stages by name, checking the dependency graph
+    Args:
+        stages
+
+    Returns:
+        Stages by name
+
+    Raises:
+        ValueError for duplicate names, unknown requirements or cycles
+    """
+    by_name: Dict[str, Stage] = {}
+    for stage in stages:
+        if stage.name in by_name:
+            raise ValueError(f"Duplicate stage {stage.name}")
+        by_name[stage.name] = stage
+    for stage in by_name.values():
+        unknown = set(stage.requires) - by_name.keys()
+        if unknown:
+            raise ValueError(
+                f"Stage {stage.name} requires unknown {sorted(unknown)}"
+            )
+    # Kahn's algorithm: every stage must become runnable
+    remaining = {name: set(stage.requires) for name, stage in by_name.items()}
+    while remaining:
+        ready = [name for name, requires in remaining.items() if not requires]
+        if not ready:
+            raise ValueError(f"Stages have a cycle: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for requires in remaining.values():
+            requires.difference_update(ready)
+    return by_name
+
+
+def critical_path(
+    stages: Dict[str, Stage], timings: Dict[str, StageTiming]
+) -> Tuple[List[str], float]:
+    """Returns the longest chain of dependent stages and its duration"""
+    longest: Dict[str, Tuple[float, List[str]]] = {}
+
+    def path_to(name: str) -> Tuple[float, List[str]]:
+        if name not in longest:
+            before = max(
+                (path_to(required) for required in stages[name].requires),
+                default=(0.0, []),
+            )
+            longest[name] = (
+                before[0] + timings[name].seconds,
+                before[1] + [name],
+            )
+        return longest[name]
+
+    seconds, path = max((path_to(name) for name in timings), default=(0.0, []))
+    return path, seconds
+
+
+def run_pipeline(
+    stages: Iterable[Stage], max_workers: Optional[int] = MAX_WORKERS
+) -> Dict[str, Any]:
+    """
+    Runs stages on a thread pool, each as soon as the stages it requires
+    have finished, and logs how long each took
+    Args:
+        stages
+        max_workers: Stages running at once
+
+    Returns:
+        Result of each stage by name
+
+    Raises:
+        The first exception raised by a stage, after running stages finish
+    """
+    by_name = check_stages(stages)
+    results: Dict[str, Any] = {}
+    timings: Dict[str, StageTiming] = {}
+    pending = dict(by_name)
+    running: Dict[Future, str] = {}
+    start = time.perf_counter()
+
+    def timed(stage: Stage, kwargs: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return stage.run(**kwargs)
+        finally:
+            seconds = time.perf_counter() - started
+            timings[stage.name] = StageTiming(
+                stage.name, started - start, seconds
+            )
+            logger.info(f"Stage {stage.name} took {seconds:.2f}s")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if all(required in results for required in stage.requires):
+                    kwargs = {
+                        required: results[required]
+                        for required in stage.requires
+                    }
+                    running[executor.submit(timed, stage, kwargs)] = name
+                    del pending[name]
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logger.error(f"Stage {name} failed: {error}")
+                    # Let running stages finish, but start no more
+                    pending.clear()
+                    wait(running)
+                    raise error
+                results[name] = future.result()
+
+    total = time.perf_counter() - start
+    path, path_seconds = critical_path(by_name, timings)
+    logger.info(
+        f"Pipeline took {total:.2f}s. Critical path "
+        f"{' -> '.join(path)} took {path_seconds:.2f}s"
+    )
+    return results
@@ -1,14 +1,27 @@
-from typing import List
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import logging
+import math
 import re
+from dataclasses import dataclass, field
+from itertools import chain, islice
 from pathlib import Path
 
-import git
-from git import Repo
-
 from pycodegen import llm, todo
 
+if TYPE_CHECKING:
+    from git import Repo
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] %(message)s",
@@ -18,8 +31,78 @@ logger = logging.getLogger(__name__)
 
 github_host = "github.com"
 
+SUMMARY_PROMPT = "Summarize the following: "
+# Leave room in the context window for the summary itself
+SUMMARY_RESPONSE_TOKENS = 512
+# Tokens added by chat message formatting around the prompt
+MESSAGE_FRAMING_TOKENS = 16
+# Chunks summarized per batch, as a multiple of max_concurrency
+SUMMARY_BATCH_FACTOR = 4
+FILE_START_RE = re.compile(r"^diff ")
+HUNK_START_RE = re.compile(r"^@@ ")
+# Paths left out of diffs sent to the LLM (lockfiles and vendored code)
+DIFF_EXCLUDE_PATTERNS = (
+    "**/*.lock",
+    "**/package-lock.json",
+    "**/pnpm-lock.yaml",
+    "**/vendor/**",
+    "**/_vendor/**",
+    "**/third_party/**",
+    "**/node_modules/**",
+)
+# Rough tokens per changed line used to estimate the cost of a diff
+TOKENS_PER_DIFF_LINE = 10
+# Above this estimate, commit messages are written from the --numstat summary
+MAX_DIFF_TOKENS = 500_000
+DIFF_FILE = "file"
+DIFF_HEADER = "header"
+DIFF_HUNK = "hunk"
+DIFF_LINE = "line"
+
+
+@dataclass
+class StageStats:
+    """LLM usage of one summarization stage"""
+
+    name: str
+    calls: int = 0
+    prompt_tokens: int = 0
+    response_tokens: int = 0
+
+
+@dataclass
+class SummaryResult:
+    """Final summaries and the LLM usage of each stage that produced them"""
+
+    summaries: List[str] = field(default_factory=list)
+    stages: List[StageStats] = field(default_factory=list)
+
+    @property
+    def calls(self) -> int:
+        return sum(stage.calls for stage in self.stages)
+
+    @property
+    def tokens(self) -> int:
+        return sum(
+            stage.prompt_tokens + stage.response_tokens
+            for stage in self.stages
+        )
+
+
+@dataclass(frozen=True)
+class FileStat:
+    """Lines added and deleted for a file in a diff (None for binary)"""
+
+    path: str
+    added: Optional[int]
+    deleted: Optional[int]
+
+    @property
+    def binary(self) -> bool:
+        return self.added is None
+
 
-def use_repo(work_dir: Path, repo_name: str, username: str) -> Repo:
+def use_repo(work_dir: Path, repo_name: str, username: str) -> "Repo":
     """
     Gets a reference to a repo if it exists locally, otherwise clones from
     GitHub
@@ -33,6 +116,8 @@ def use_repo(work_dir: Path, repo_name: str, username: str) -> Repo:
     -------
     Repo
     """
+    import git
+
     repo_path = work_dir.joinpath(repo_name)
     if repo_path.exists():
         try:
@@ -53,7 +138,7 @@ def use_repo(work_dir: Path, repo_name: str, username: str) -> Repo:
             logger.warning(f"No remote repo at {repo_url}")
 
 
-def use_branch(repo: Repo, branch_name: str) -> None:
+def use_branch(repo: "Repo", branch_name: str) -> None:
     """
     Creates branch_name if it doesn't exist and switches to it
 
@@ -71,11 +156,11 @@ def use_branch(repo: Repo, branch_name: str) -> None:
     repo.git.checkout(branch_name)
 
 
-def get_active_branch_name(repo: Repo) -> str:
+def get_active_branch_name(repo: "Repo") -> str:
     return repo.active_branch.name
 
 
-def generate_commit_msg(repo: Repo, branch_name: str) -> str:
+def generate_commit_msg(repo: "Repo", branch_name: str) -> str:
     """
     Generates a commit message based on the changes in the index (staging)
     of the provided repo. Run after adding changes to index (e.g. git add .)
@@ -86,14 +171,6 @@ def generate_commit_msg(repo: Repo, branch_name: str) -> str:
     Returns:
         Commit message as a string
     """
-    # Set the --no-pager option for the git command so that we get everything
-    repo.config_writer().set_value("core", "pager", "")
-
-    # Generate a patch from the staged changes
-    diff = repo.git.diff(
-        "--cached",
-    )
-
     commit_limit = 60
     issue_num = todo.issue_num_from_branch_name(branch_name)
     issue_prefix = todo.issue_prefix_from_branch_name(branch_name)
@@ -107,24 +184,37 @@ def generate_commit_msg(repo: Repo, branch_name: str) -> str:
         f"the message to just a one-line summary of less "
         f"then {commit_limit} characters.\n\n"
     )
-    messages = llm.prompt_to_messages(prompt + diff)
+    # Check the size of the staged changes before reading the patch
+    stats = staged_numstat(repo)
+    estimated_tokens = estimate_diff_tokens(stats)
+    logger.info(
+        f"Staged changes in {len(stats)} files. About {estimated_tokens} "
+        f"tokens to summarize."
+    )
+    if estimated_tokens > MAX_DIFF_TOKENS:
+        logger.warning(
+            "Staged diff is too large to summarize. Using file stats."
+        )
+        diff_lines: Iterable[str] = numstat_summary(stats).splitlines(True)
+    else:
+        diff_lines = iter_staged_diff(repo, stats=stats)
+    chunks = chunk_diff(diff_lines, summary_chunk_budget())
+    first_chunks = list(islice(chunks, 2))
     # Simple case. No summarizing needed.
-    token_count = llm.num_tokens_from_messages(messages)
-    if token_count <= llm.CH_MAX_TOKENS:
-        result = llm.respond(messages)
+    if len(first_chunks) <= 1:
+        diff = first_chunks[0][0] if first_chunks else ""
+        result = llm.respond(llm.prompt_to_messages(prompt + diff))
         commit_msg = add_commit_message_info(result, issue_prefix, issue_num)
         return commit_msg
     # Otherwise, summarize the diff
-    summaries = summarize(diff)
-    summary_string = "\n".join(summaries)
-    summary_message = llm.prompt_to_messages(prompt + summary_string)
-    while True:
-        if llm.num_tokens_from_messages(summary_message) <= llm.CH_MAX_TOKENS:
-            break
-        # Summarize the summary
-        summaries = summarize(summary_string)
-        summary_string = "\n".join(summaries)
-        summary_message = llm.prompt_to_messages(prompt + summary_string)
+    prompt_tokens = llm.num_tokens_from_messages(
+        llm.prompt_to_messages(prompt)
+    )
+    summaries = map_reduce_chunks(
+        chain(first_chunks, chunks),
+        target_tokens=llm.CH_MAX_TOKENS - prompt_tokens,
+    ).summaries
+    summary_message = llm.prompt_to_messages(prompt + "\n".join(summaries))
 
     commit_msg = llm.respond(summary_message)
     commit_msg = add_commit_message_info(commit_msg, issue_prefix, issue_num)
@@ -156,67 +246,548 @@ def add_commit_message_info(
     return commit_msg
 
 
-def summarize(text: str, split_re=None) -> List[str]:
-    """Summarize a single diff or set of diff summaries"""
-    if split_re is None:
-        split_re = [
-            r"^(diff )",  # First try to split by diff
-            "^$",  # Then try blank line
-            "\n",  # Then try newline
-        ]
-    prompt = "Summarize the following: "
-    query = prompt + text
-    query_message = llm.prompt_to_messages(query)
-    token_count = llm.num_tokens_from_messages(query_message)
-
-    if token_count <= llm.CH_MAX_TOKENS:
-        return [llm.respond(query_message)]
-
-    summaries = []
-    parts = re.split(split_re[0], text, flags=re.MULTILINE)
-    combined_parts = []
-    # Now go back through and put the split string back together with the next
-    # thing
-    for part in parts:
-        if re.match(split_re[0], part) or not combined_parts:
-            combined_parts.append(part)
+@dataclass(frozen=True)
+class DiffUnit:
+    """A piece of a diff: a whole file diff, a file header, a hunk or a
+    single line, with its token count"""
+
+    kind: str
+    path: str
+    text: str
+    tokens: int
+
+
+class DiffParser:
+    """
+    Incremental diff parser that turns lines into the largest units that fit
+    in max_tokens: whole file diffs, else the file header and its hunks, else
+    single lines. Only one file (at most max_tokens) is buffered at a time.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int,
+        count_tokens: Callable[[str], int] = llm.count_tokens,
+    ):
+        self.max_tokens = max_tokens
+        self.path = ""
+        self.file_parts: List[Tuple[str, List[str], int]] = []
+        # Tokens of the current file and of its current part
+        self.file_tokens = llm.TokenCounter(count=count_tokens)
+        self.whole_file = True
+        self.part_kind = DIFF_HEADER
+        self.part_lines: List[Tuple[str, int]] = []
+        self.part_tokens = llm.TokenCounter(count=count_tokens)
+        self.whole_part = True
+
+    def feed(self, line: str) -> List[DiffUnit]:
+        """Adds a line and returns any units that are complete"""
+        units: List[DiffUnit] = []
+        if FILE_START_RE.match(line):
+            units.extend(self.close())
+            self.path = diff_path(line)
+        elif HUNK_START_RE.match(line):
+            units.extend(self.finish_part())
+            self.part_kind = DIFF_HUNK
+        tokens = self.file_tokens.add(line)
+        if self.whole_part:
+            self.part_lines.append((line, tokens))
+            self.part_tokens.add(line, tokens)
         else:
-            combined_parts[-1] += part
-    parts = combined_parts
+            units.append(DiffUnit(DIFF_LINE, self.path, line, tokens))
+        if self.whole_file:
+            if self.file_tokens.total <= self.max_tokens:
+                return units
+            # File doesn't fit in a chunk. Release it as header and hunks.
+            self.whole_file = False
+            for kind, lines, part_tokens in self.file_parts:
+                units.append(
+                    DiffUnit(kind, self.path, "".join(lines), part_tokens)
+                )
+            self.file_parts = []
+        if self.whole_part and self.part_tokens.total > self.max_tokens:
+            # Part doesn't fit either. Release it line by line.
+            self.whole_part = False
+            units.extend(
+                DiffUnit(DIFF_LINE, self.path, part_line, line_tokens)
+                for part_line, line_tokens in self.part_lines
+            )
+            self.part_lines = []
+            self.part_tokens.reset()
+        return units
+
+    def finish_part(self) -> List[DiffUnit]:
+        units = []
+        if self.part_lines:
+            lines = [part_line for part_line, _ in self.part_lines]
+            if self.whole_file:
+                self.file_parts.append(
+                    (self.part_kind, lines, self.part_tokens.total)
+                )
+            else:
+                units.append(
+                    DiffUnit(
+                        self.part_kind,
+                        self.path,
+                        "".join(lines),
+                        self.part_tokens.total,
+                    )
+                )
+        self.part_lines = []
+        self.part_tokens.reset()
+        self.whole_part = True
+        return units
+
+    def close(self) -> List[DiffUnit]:
+        """Returns the units left for the current file and resets"""
+        units = self.finish_part()
+        if self.whole_file and self.file_parts:
+            text = "".join("".join(lines) for _, lines, _ in self.file_parts)
+            units.append(
+                DiffUnit(DIFF_FILE, self.path, text, self.file_tokens.total)
+            )
+        self.file_parts = []
+        self.file_tokens.reset()
+        self.whole_file = True
+        self.part_kind = DIFF_HEADER
+        return units
+
+
+def diff_path(line: str) -> str:
+    """Returns the file path from a "diff --git a/... b/..." line"""
+    line = line.rstrip("\n")
+    if " b/" in line:
+        return line[line.rfind(" b/") + 3 :]
+    return line[len("diff ") :]
+
+
+def iter_diff_units(
+    lines: Iterable[str],
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> Iterator[DiffUnit]:
+    """
+    Streams diff lines into file, hunk and line units with their token
+    counts, using the largest unit that fits in max_tokens
+    Args:
+        lines: Diff lines (with line endings)
+        max_tokens: Token budget per chunk
+        count_tokens: Function returning the token count of a string
 
-    chunk = [parts[0]]
-    chunk_token_count = llm.num_tokens_from_messages(
-        llm.prompt_to_messages(parts[0])
-    )
-    for part in parts[1:]:
-        part_token_count = llm.num_tokens_from_messages(
-            llm.prompt_to_messages(part)
-        )
-        # print(f">>> {split_re[0]!r}",
-        #      chunk_token_count,
-        #      len(chunk),
-        #      part_token_count,
-        #      max_token_count[args.model])
-
-        if chunk_token_count + part_token_count >= llm.CH_MAX_TOKENS:
-            text = "".join(chunk)
-            text_message = llm.prompt_to_messages(text)
+    Returns:
+        Diff units in diff order
+    """
+    parser = DiffParser(max_tokens, count_tokens)
+    for line in lines:
+        yield from parser.feed(line)
+    yield from parser.close()
+
+
+def pack_diff_chunks(
+    units: Iterable[DiffUnit], max_tokens: int
+) -> Iterator[Tuple[str, int]]:
+    """
+    Greedily packs diff units into chunks of at most max_tokens. A chunk
+    starting partway through a file is prefixed with that file's header when
+    it fits.
+    Args:
+        units: Diff units from iter_diff_units
+        max_tokens: Token budget per chunk
+
+    Returns:
+        Chunk text and its token count
+    """
+    chunk: List[str] = []
+    chunk_tokens = llm.TokenCounter()
+    header: Optional[DiffUnit] = None
+    for unit in units:
+        if unit.kind == DIFF_HEADER:
+            header = unit
+        elif unit.kind == DIFF_FILE:
+            header = None
+        if chunk and chunk_tokens.total + unit.tokens > max_tokens:
+            yield "".join(chunk), chunk_tokens.total
             chunk = []
-            if llm.num_tokens_from_messages(text_message) > llm.CH_MAX_TOKENS:
-                # Need to split using a different regex
-                summaries.extend(summarize(text, split_re=split_re[1:]))
-            else:
-                summaries.append(llm.complete_prompt(prompt + text))
-            chunk_token_count = sum(
-                llm.num_tokens_from_messages(llm.prompt_to_messages(c))
-                for c in chunk
+            chunk_tokens.reset()
+            if (
+                unit.kind in (DIFF_HUNK, DIFF_LINE)
+                and header is not None
+                and header.path == unit.path
+                and header.tokens + unit.tokens <= max_tokens
+            ):
+                chunk.append(header.text)
+                chunk_tokens.add(header.text, header.tokens)
+        if unit.tokens <= max_tokens:
+            chunk.append(unit.text)
+            chunk_tokens.add(unit.text, unit.tokens)
+            continue
+        # A single line over budget (e.g. minified file) gets cut up
+        if chunk:
+            yield "".join(chunk), chunk_tokens.total
+            chunk = []
+            chunk_tokens.reset()
+        num_pieces = math.ceil(unit.tokens / max_tokens)
+        piece_len = math.ceil(len(unit.text) / num_pieces)
+        for start in range(0, len(unit.text), piece_len):
+            yield (
+                unit.text[start : start + piece_len],
+                math.ceil(unit.tokens / num_pieces),
             )
-        chunk.append(part)
-        chunk_token_count += part_token_count
-    return summaries
+    if chunk:
+        yield "".join(chunk), chunk_tokens.total
+
+
+def chunk_diff(
+    lines: Iterable[str],
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> Iterator[Tuple[str, int]]:
+    """Streams diff lines into chunks of at most max_tokens, split on file,
+    then hunk, then line boundaries"""
+    units = iter_diff_units(lines, max_tokens, count_tokens)
+    return pack_diff_chunks(units, max_tokens)
+
+
+def chunk_text(
+    text: str,
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> List[Tuple[str, int]]:
+    """
+    Splits text into chunks of at most max_tokens
+    Args:
+        text: Diff or other text to split
+        max_tokens: Token budget per chunk
+        count_tokens: Function returning the token count of a string
+
+    Returns:
+        List of chunk text and its token count
+    """
+    return list(
+        chunk_diff(text.splitlines(keepends=True), max_tokens, count_tokens)
+    )
+
+
+def iter_diff_lines(repo: "Repo", *args: str) -> Iterator[str]:
+    """
+    Streams the output of git diff line by line instead of reading it into
+    one string
+    Args:
+        repo
+        args: Arguments for git diff
 
+    Returns:
+        Diff lines
+    """
+    proc = repo.git.diff(*args, as_process=True)
+    try:
+        for raw_line in proc.stdout:
+            yield raw_line.decode("utf-8", errors="replace")
+    finally:
+        proc.wait()
+
+
+def staged_numstat(
+    repo: "Repo", exclude_patterns: Iterable[str] = DIFF_EXCLUDE_PATTERNS
+) -> List[FileStat]:
+    """
+    Returns the per-file line counts of the staged changes. This is cheap
+    compared to the full diff and can be used to estimate its size.
+    Args:
+        repo
+        exclude_patterns: Glob patterns of paths to leave out
 
-def add_files(repo: Repo, files: List[str]) -> None:
+    Returns:
+        List of file stats
+    """
+    output = repo.git.diff(
+        "--cached", "--numstat", "-z", *diff_pathspecs(exclude_patterns)
+    )
+    return parse_numstat(output)
+
+
+def parse_numstat(output: str) -> List[FileStat]:
+    """Parses the output of git diff --numstat -z"""
+    stats = []
+    fields = output.split("\0")
+    idx = 0
+    while idx < len(fields):
+        entry = fields[idx]
+        idx += 1
+        if not entry:
+            continue
+        added, deleted, path = entry.split("\t", 2)
+        if not path:
+            # Renames are followed by the old and new paths
+            path = fields[idx + 1]
+            idx += 2
+        stats.append(
+            FileStat(
+                path,
+                None if added == "-" else int(added),
+                None if deleted == "-" else int(deleted),
+            )
+        )
+    return stats
+
+
+def estimate_diff_tokens(stats: Iterable[FileStat]) -> int:
+    """Returns a rough token estimate for the diff of stats"""
+    return sum(
+        (stat.added + stat.deleted) * TOKENS_PER_DIFF_LINE
+        for stat in stats
+        if not stat.binary
+    )
+
+
+def numstat_summary(stats: Iterable[FileStat]) -> str:
+    """Returns a --stat like summary of stats"""
+    return "\n".join(
+        (
+            f"{stat.path} | binary"
+            if stat.binary
+            else f"{stat.path} | +{stat.added} -{stat.deleted}"
+        )
+        for stat in stats
+    )
+
+
+def diff_pathspecs(exclude_patterns: Iterable[str]) -> List[str]:
+    """Returns git pathspec arguments that leave out exclude_patterns"""
+    excludes = [f":(exclude,glob){pattern}" for pattern in exclude_patterns]
+    if not excludes:
+        return []
+    return ["--", "."] + excludes
+
+
+def filter_diff_lines(
+    lines: Iterable[str], skip_paths: Set[str]
+) -> Iterator[str]:
+    """Drops the diffs of files in skip_paths from a stream of diff lines"""
+    skipping = False
+    for line in lines:
+        if FILE_START_RE.match(line):
+            skipping = diff_path(line) in skip_paths
+        if not skipping:
+            yield line
+
+
+def iter_staged_diff(
+    repo: "Repo",
+    exclude_patterns: Iterable[str] = DIFF_EXCLUDE_PATTERNS,
+    stats: Optional[List[FileStat]] = None,
+) -> Iterator[str]:
+    """
+    Streams the staged diff, leaving out lockfiles, vendored paths and
+    binary files so they never reach the tokenizer
+    Args:
+        repo
+        exclude_patterns: Glob patterns of paths to leave out
+        stats: Staged numstat (fetched if not provided)
+
+    Returns:
+        Diff lines
+    """
+    exclude_patterns = list(exclude_patterns)
+    if stats is None:
+        stats = staged_numstat(repo, exclude_patterns)
+    binary_paths = {stat.path for stat in stats if stat.binary}
+    lines = iter_diff_lines(
+        repo, "--cached", *diff_pathspecs(exclude_patterns)
+    )
+    return filter_diff_lines(lines, binary_paths)
+
+
+def summary_chunk_budget(
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> int:
+    """Returns the token budget for the text in one summary request"""
+    prompt_tokens = count_tokens(SUMMARY_PROMPT) + MESSAGE_FRAMING_TOKENS
+    return llm.CH_MAX_TOKENS - SUMMARY_RESPONSE_TOKENS - prompt_tokens
+
+
+def summarize_chunks(
+    chunks: Iterable[Tuple[str, int]],
+    name: str,
+    max_concurrency: int = llm.MAX_CONCURRENCY,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> Tuple[List[str], StageStats]:
+    """
+    Summarizes chunks concurrently, pulling only a few batches of chunks
+    from the iterator at a time
+    Args:
+        chunks: Chunk text and its token count
+        name: Stage name for the stats
+        max_concurrency: Maximum number of LLM requests in flight
+        count_tokens: Function returning the token count of a string
+
+    Returns:
+        Summaries and the stage's LLM usage
+    """
+    prompt_tokens = count_tokens(SUMMARY_PROMPT) + MESSAGE_FRAMING_TOKENS
+    stage = StageStats(name)
+    sent_tokens = llm.TokenCounter(count=count_tokens)
+    response_tokens = llm.TokenCounter(count=count_tokens)
+    summaries: List[str] = []
+    chunk_iter = iter(chunks)
+    while True:
+        batch = list(
+            islice(chunk_iter, max_concurrency * SUMMARY_BATCH_FACTOR)
+        )
+        if not batch:
+            break
+        responses = llm.gather_prompts(
+            [SUMMARY_PROMPT + chunk for chunk, _ in batch],
+            max_concurrency=max_concurrency,
+        )
+        stage.calls += len(batch)
+        for chunk, chunk_tokens in batch:
+            sent_tokens.add(chunk, chunk_tokens + prompt_tokens)
+        for response in responses:
+            if response:
+                summaries.append(response)
+                response_tokens.add(response)
+    stage.prompt_tokens = sent_tokens.total
+    stage.response_tokens = response_tokens.total
+    logger.info(
+        f"Summary stage {name}: {stage.calls} LLM calls, "
+        f"{stage.prompt_tokens} prompt tokens, "
+        f"{stage.response_tokens} response tokens"
+    )
+    return summaries, stage
+
+
+def truncate_summaries(
+    summaries: List[str],
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> List[str]:
+    """
+    Keeps summaries in order while they fit in max_tokens when joined with
+    newlines, cutting the first one that only partly fits
+    Args:
+        summaries
+        max_tokens: Token budget for the joined summaries
+        count_tokens: Function returning the token count of a string
+
+    Returns:
+        Summaries that fit
+    """
+    kept: List[str] = []
+    used = llm.TokenCounter(count=count_tokens)
+    for summary in summaries:
+        # Each summary is followed by a newline when joined
+        tokens = count_tokens(summary) + 1
+        remaining = max_tokens - used.total
+        if tokens <= remaining:
+            kept.append(summary)
+            used.add(summary, tokens)
+            continue
+        piece = summary[: len(summary) * remaining // tokens]
+        while piece and count_tokens(piece) + 1 > remaining:
+            piece = piece[: len(piece) * 9 // 10]
+        if piece:
+            kept.append(piece)
+        break
+    return kept
+
+
+def map_reduce_chunks(
+    chunks: Iterable[Tuple[str, int]],
+    target_tokens: int = llm.CH_MAX_TOKENS,
+    max_concurrency: int = llm.MAX_CONCURRENCY,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> SummaryResult:
+    """
+    Summarizes chunks concurrently (map), then summarizes the summaries
+    (reduce) until they fit in target_tokens
+    Args:
+        chunks: Chunk text and its token count
+        target_tokens: Token budget for the joined summaries
+        max_concurrency: Maximum number of LLM requests in flight
+        count_tokens: Function returning the token count of a string
+
+    Returns:
+        Summaries with LLM calls and tokens used by each stage
+    """
+    prompt_tokens = count_tokens(SUMMARY_PROMPT) + MESSAGE_FRAMING_TOKENS
+    budget = summary_chunk_budget(count_tokens)
+    result = SummaryResult()
+    summaries, stage = summarize_chunks(
+        chunks, "map", max_concurrency, count_tokens
+    )
+    text_tokens = stage.prompt_tokens - stage.calls * prompt_tokens
+    result.stages.append(stage)
+    while True:
+        result.summaries = summaries
+        # Joined with a newline between each summary
+        summary_tokens = stage.response_tokens + len(summaries)
+        if summary_tokens <= target_tokens or len(summaries) <= 1:
+            break
+        if summary_tokens >= text_tokens:
+            logger.warning("Summaries aren't getting shorter. Stopping.")
+            break
+        text_tokens = summary_tokens
+        summary_chunks = chunk_diff(
+            "\n".join(summaries).splitlines(keepends=True),
+            budget,
+            count_tokens,
+        )
+        summaries, stage = summarize_chunks(
+            summary_chunks, "reduce", max_concurrency, count_tokens
+        )
+        result.stages.append(stage)
+    if summary_tokens > target_tokens:
+        logger.warning(
+            f"Summaries have {summary_tokens} tokens, over the "
+            f"{target_tokens} token target. Truncating them."
+        )
+        result.summaries = truncate_summaries(
+            summaries, target_tokens, count_tokens
+        )
+    logger.info(
+        f"Summarized in {len(result.stages)} stages with {result.calls} "
+        f"LLM calls and {result.tokens} tokens"
+    )
+    return result
+
+
+def summarize_diff(
+    diff: Union[str, Iterable[str]],
+    target_tokens: int = llm.CH_MAX_TOKENS,
+    max_concurrency: int = llm.MAX_CONCURRENCY,
+    count_tokens: Callable[[str], int] = llm.count_tokens,
+) -> SummaryResult:
+    """
+    Map-reduce summary of a diff: summarizes token bounded chunks
+    concurrently, then summarizes the summaries until they fit in
+    target_tokens.
+    Args:
+        diff: Diff text or an iterable of diff lines
+        target_tokens: Token budget for the joined summaries
+        max_concurrency: Maximum number of LLM requests in flight
+        count_tokens: Function returning the token count of a string
+
+    Returns:
+        Summaries with LLM calls and tokens used by each stage
+    """
+    lines = diff.splitlines(keepends=True) if isinstance(diff, str) else diff
+    chunks = chunk_diff(
+        lines, summary_chunk_budget(count_tokens), count_tokens
+    )
+    return map_reduce_chunks(
+        chunks, target_tokens, max_concurrency, count_tokens
+    )
+
+
+def summarize(
+    text: str, max_concurrency: int = llm.MAX_CONCURRENCY
+) -> List[str]:
+    """Summarize a single diff or set of diff summaries"""
+    return summarize_diff(text, max_concurrency=max_concurrency).summaries
+
+
+def add_files(repo: "Repo", files: List[str]) -> None:
     """
     Adds specified files to the repo index/staging
 
@@ -236,7 +807,7 @@ def add_files(repo: Repo, files: List[str]) -> None:
         repo.index.add(files)
 
 
-def commit(repo: Repo, commit_msg: str) -> int:
+def commit(repo: "Repo", commit_msg: str) -> int:
     """
     Commits changes to the current branch of the repo
 
@@ -249,6 +820,8 @@ def commit(repo: Repo, commit_msg: str) -> int:
     -------
     Status Code
     """
+    import git
+
     # Commit changes
     try:
         repo.git.commit(m=commit_msg)
@@ -269,7 +842,7 @@ def commit(repo: Repo, commit_msg: str) -> int:
     return 0
 
 
-def safe_merge(repo: Repo, branch_name: str) -> int:
+def safe_merge(repo: "Repo", branch_name: str) -> int:
     """
     Safely merge branch_name into main
 
@@ -282,6 +855,8 @@ def safe_merge(repo: Repo, branch_name: str) -> int:
     -------
     None
     """
+    import git
+
     if repo.active_branch.name != branch_name:
         use_branch(repo, branch_name)
     repo.git.fetch()
@@ -300,7 +875,7 @@ def safe_merge(repo: Repo, branch_name: str) -> int:
     return 0
 
 
-def push_to_origin(repo: Repo) -> int:
+def push_to_origin(repo: "Repo") -> int:
     """
     Pushes main to origin
 
@@ -312,6 +887,8 @@ def push_to_origin(repo: Repo) -> int:
     -------
     None
     """
+    import git
+
     if repo.active_branch.name != "main":
         use_branch(repo, "main")
     try:
@@ -323,7 +900,7 @@ def push_to_origin(repo: Repo) -> int:
         return 0
 
 
-def get_last_commit_msg(repo: Repo) -> str:
+def get_last_commit_msg(repo: "Repo") -> str:
     """
     Get the last commit message
     Parameters
@@ -338,7 +915,7 @@ def get_last_commit_msg(repo: Repo) -> str:
     return head_commit.message
 
 
-def delete_branch(repo: Repo, branch_name: str) -> None:
+def delete_branch(repo: "Repo", branch_name: str) -> None:
     """
     Deletes the indicated branch
     Parameters
@@ -350,13 +927,15 @@ def delete_branch(repo: Repo, branch_name: str) -> None:
     -------
     None
     """
+    import git
+
     try:
         repo.git.branch("-D", branch_name)
     except git.exc.GitCommandError as gce:
         logger.error("Git commit command error: " + str(gce))
 
 
-def undo_changes(repo: Repo) -> None:
+def undo_changes(repo: "Repo") -> None:
     """
     Undoes all uncommitted changes
     Args:
@@ -365,6 +944,8 @@ def undo_changes(repo: Repo) -> None:
     Returns:
         None
     """
+    import git
+
     try:
         branch_name = get_active_branch_name(repo)
         use_branch(repo, "main")
@@ -0,0 +1,141 @@
+from typing import Any, Callable, Dict, Optional
+
+import json
+import logging
+import os
+import socket
+import socketserver
+from pathlib import Path
+
+from pycodegen import cache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s [%(levelname)s] %(message)s",
+)
+
+logger = logging.getLogger(__name__)
+
+SOCKET_ENV = "PYCODEGEN_SOCKET"
+SOCKET_NAME = "coder.sock"
+# Seconds to wait for the server to accept a connection
+CONNECT_TIMEOUT = 1
+
+Request = Dict[str, Any]
+Response = Dict[str, Any]
+Handler = Callable[[Request], Response]
+
+
+def default_socket_path() -> Path:
+    """Returns the Unix socket path used by coder serve"""
+    if os.getenv(SOCKET_ENV):
+        return Path(os.environ[SOCKET_ENV])
+    return cache.default_cache_dir().joinpath(SOCKET_NAME)
+
+
+def send_request(
+    request: Request, path: Optional[Path] = None
+) -> Optional[Response]:
+    """
+    Sends a request to a running coder serve process
+    Args:
+        request: JSON serializable request
+        path: Server socket (defaults to default_socket_path())
+
+    Returns:
+        Server response (None if no server is listening). Once the request
+        has been sent, a dropped connection or partial reply is returned as
+        an error response with rc 1, since the server may have run part of
+        the command and running it again isn't safe.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    if path is None:
+        path = default_socket_path()
+    if not path.exists():
+        return None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(str(path))
+        except OSError as oe:
+            logger.debug(f"No coder server at {path}: {oe}")
+            return None
+        # Commands can take minutes once the server accepts them
+        sock.settimeout(None)
+        try:
+            with sock.makefile("rwb") as stream:
+                stream.write(json.dumps(request).encode("utf-8") + b"\n")
+                stream.flush()
+                line = stream.readline()
+        except OSError as oe:
+            return lost_response(f"Connection to coder server lost: {oe}")
+    if not line:
+        return lost_response("Coder server closed the connection")
+    try:
+        return json.loads(line)
+    except ValueError as ve:
+        return lost_response(f"Invalid reply from coder server: {ve}")
+
+
+def lost_response(error: str) -> Response:
+    """Returns the response for a request the server may have partly run"""
+    return {
+        "rc": 1,
+        "error": f"{error}. The command may have partly run, check the "
+        f"repo before running it again.",
+    }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Reads one JSON request line and writes one JSON response line"""
+
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+        except ValueError as ve:
+            response = {"rc": 1, "error": f"Invalid request: {ve}"}
+        else:
+            response = self.server.handler(request)
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class SessionServer(
+    socketserver.ThreadingMixIn, socketserver.UnixStreamServer
+):
+    """
+    Unix socket server that passes each request to a handler. State kept by
+    the handler (repos, API clients, tokenizers) stays warm between
+    requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler: Handler, path: Optional[Path] = None):
+        """
+        Binds the server socket, replacing a stale one
+        Args:
+            handler: Turns a request into a response
+            path: Socket path (defaults to default_socket_path())
+        """
+        self.handler = handler
+        self.path = path if path is not None else default_socket_path()
+        if self.path.exists():
+            if send_request({"command": "ping"}, self.path) is not None:
+                raise RuntimeError(
+                    f"A server is already running at {self.path}"
+                )
+            self.path.unlink()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(str(self.path), RequestHandler)
+        os.chmod(self.path, 0o600)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
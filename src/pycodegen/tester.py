@@ -1,21 +1,28 @@
-from typing import List, Optional
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
+import ast
+import json
+import keyword
 import logging
+import multiprocessing
 import os
-import subprocess
+import re
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import repeat
 from pathlib import Path
 
-from github.Issue import Issue
-from langchain.chains import LLMChain, SequentialChain
-from langchain.chat_models import ChatOpenAI
-from langchain.memory import SimpleMemory
-from langchain.prompts import PromptTemplate
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-)
-
-from pycodegen import llm
+from pycodegen import chains, llm, todo
 
 logging.basicConfig(
     level=logging.INFO,
@@ -28,6 +35,189 @@ tests_dir = "tests"
 features_dir = "features"
 step_def_dir = "functional"
 unit_dir = "unit"
+STEP_KEYWORDS = ("given", "when", "then")
+# Steps to name with each batched request
+STEP_NAME_BATCH_SIZE = 40
+# Steps that take the type of the step before them
+CONTINUATION_KEYWORDS = ("and", "but", "*")
+SCENARIO_KEYWORDS = (
+    "scenario",
+    "scenario outline",
+    "scenario template",
+    "example",
+)
+EXAMPLES_KEYWORDS = ("examples", "scenarios")
+DOC_STRING_DELIMITERS = ('"""', "```")
+# Gherkin token kinds
+FEATURE_TOKEN = "feature"
+BACKGROUND_TOKEN = "background"
+RULE_TOKEN = "rule"
+SCENARIO_TOKEN = "scenario"
+EXAMPLES_TOKEN = "examples"
+STEP_TOKEN = "step"
+TABLE_ROW_TOKEN = "table_row"
+DOC_STRING_TOKEN = "doc_string"
+TAG_TOKEN = "tag"
+COMMENT_TOKEN = "comment"
+DESCRIPTION_TOKEN = "description"
+EMPTY_TOKEN = "empty"
+# Tokens that end the scenario before them
+BLOCK_TOKENS = (FEATURE_TOKEN, BACKGROUND_TOKEN, RULE_TOKEN, SCENARIO_TOKEN)
+STEP_DEF_IMPORTS = """from pytest_bdd import (
+    given,
+    scenario,
+    then,
+    when,
+)
+"""
+
+UNIT_TEST_ROLE = (
+    "You are a great QA engineer preparing a suite of unit "
+    "tests for Test Driven Development."
+)
+UNIT_TEST_GUIDELINES = (
+    "Good unit tests should be independent, "
+    "deterministic, self-validating, "
+    "isolated, reproducible, and take advantage of the "
+    "features of pytest to make the tests easy to "
+    "write and maintain. Any explanation for the tests should be made "
+    "as comments in python."
+)
+# List test cases, critique and revise them, then write the unit tests
+UNIT_TEST_TURNS = (
+    chains.Turn(
+        "test_cases",
+        "Evaluate the {issue_type} above and return a list of all of the "
+        "test cases that should be tested.",
+        separate_prompt="{role} Evaluate the following {issue_type} and "
+        "return a list of all of the test cases that should be tested.\n"
+        "{context}",
+    ),
+    chains.Turn(
+        "critique",
+        "Compare your list of test cases with the {issue_type}. Which of "
+        "the test cases are redundant, incorrect, or can be simplified?",
+        separate_prompt="{role} Compare the list of test cases with the "
+        "{issue_type}. Which of the test cases are redundant, incorrect, or "
+        "can be simplified?\n{context}\nTest cases:\n{test_cases}",
+    ),
+    chains.Turn(
+        "updated_test_cases",
+        "Write what the test cases should be (if there are no changes "
+        "needed, please repeat the test cases).",
+        separate_prompt="{role}\nFor {context}\n"
+        "You wrote test cases:\n{test_cases}"
+        "You critiqued the test cases:\n{critique}"
+        "Write what the test cases should be (if there are no changes "
+        "needed, please repeat the test cases):\n",
+    ),
+    chains.Turn(
+        "unit_tests",
+        "Write python pytest unit tests for the updated test cases. "
+        + UNIT_TEST_GUIDELINES
+        + " For the module under test use the name '{source_module}' in "
+        "the '{package_name}' package (for example: from {package_name} "
+        "import {source_module}). Return just the python code for the "
+        "unit tests.",
+        # Stop once the code block is done
+        stop_when=llm.closing_code_fence,
+        separate_prompt="{role} Write python pytest unit tests for the "
+        "following test cases:\n{updated_test_cases}\n"
+        + UNIT_TEST_GUIDELINES
+        + " For the module under test use the name '{source_module}' in "
+        "the '{package_name}' package (for example: from {package_name} "
+        "import {source_module}). Return just the python code for the "
+        "unit tests.",
+    ),
+)
+
+
+@dataclass(frozen=True)
+class Token:
+    """
+    A line of Gherkin. keyword is the header or step keyword as written
+    (e.g. Scenario Outline, And) and text what follows it.
+    """
+
+    kind: str
+    line: int
+    keyword: str
+    text: str
+    raw: str
+
+
+@dataclass(frozen=True)
+class Step:
+    type: str
+    text: str
+
+    @property
+    def name(self) -> str:
+        """Step as written in a feature file (e.g. Given a repo)"""
+        return f"{self.type.capitalize()} {self.text}"
+
+
+ScenarioKey = Tuple[str, Tuple[str, ...]]
+
+
+@dataclass(frozen=True)
+class Scenario:
+    name: str
+    steps: Tuple[Step, ...]
+    tags: Tuple[str, ...] = ()
+    # Scenario as written, from its tags to the line before the next block
+    text: str = field(default="", compare=False)
+
+    @property
+    def key(self) -> ScenarioKey:
+        """Identifies the scenario regardless of case and whitespace"""
+        return (
+            " ".join(self.name.lower().split()),
+            tuple(" ".join(step.name.split()) for step in self.steps),
+        )
+
+
+@dataclass(frozen=True)
+class Feature:
+    name: str
+    scenarios: Tuple[Scenario, ...]
+    background: Tuple[Step, ...] = ()
+
+    @property
+    def steps(self) -> List[Step]:
+        """Background and scenario steps in the order they're written"""
+        return list(self.background) + [
+            step for scenario in self.scenarios for step in scenario.steps
+        ]
+
+
+@dataclass
+class StepDefModule:
+    """Scenarios and steps to add to the step def module of a feature"""
+
+    feature: Feature
+    feature_path: Path
+    test_path: Path
+    existing: str
+    # Scenarios with their test function names
+    scenarios: List[Tuple[Scenario, str]]
+    steps: List[Step]
+    # Functions the module will define, apart from steps
+    function_names: Set[str] = field(default_factory=set)
+    # Time spent parsing and writing the module
+    seconds: float = 0.0
+
+
+@dataclass(frozen=True)
+class GeneratedTests:
+    """Feature file and step defs generated for an issue"""
+
+    number: Optional[int]
+    title: str
+    feature_path: Optional[Path]
+    step_def_path: Optional[Path]
+    seconds: float
+    error: str = ""
 
 
 def create_test_dirs(repo_path: Path) -> None:
@@ -46,7 +236,95 @@ def create_test_dirs(repo_path: Path) -> None:
     tests_path.joinpath(unit_dir).mkdir(parents=True, exist_ok=True)
 
 
-def create_feature(repo_path: Path, issue: Issue) -> Path:
+class ScenarioIndex:
+    """
+    Scenarios of the feature files in a directory, by Scenario.key, so
+    checking whether a scenario exists takes one lookup. Only feature files
+    that changed since they were last read are parsed again.
+    """
+
+    def __init__(self, features_path: Path):
+        self.features_path = features_path
+        self.files: Dict[Path, Tuple[int, List[ScenarioKey]]] = {}
+        self.keys: Dict[ScenarioKey, Set[Path]] = {}
+
+    def forget(self, path: Path) -> None:
+        _, keys = self.files.pop(path, (0, []))
+        for key in keys:
+            paths = self.keys.get(key)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.keys[key]
+
+    def update(self, path: Path) -> None:
+        """Reads the scenarios of a feature file again"""
+        self.forget(path)
+        try:
+            mtime = path.stat().st_mtime_ns
+            feature = parse_feature(path.read_text())
+        except (OSError, UnicodeDecodeError) as err:
+            logger.warning(f"Unable to index feature file {path}: {err}")
+            return
+        self.add(path, feature.scenarios, mtime)
+
+    def add(
+        self,
+        path: Path,
+        scenarios: Iterable[Scenario],
+        mtime: Optional[int] = None,
+    ) -> None:
+        """
+        Adds scenarios written to a feature file
+        Args:
+            path: Feature file
+            scenarios: Scenarios added to it
+            mtime: Modification time the scenarios were read at (defaults to
+                the file's current one)
+
+        Returns:
+            None
+        """
+        if mtime is None:
+            mtime = path.stat().st_mtime_ns
+        _, keys = self.files.get(path, (0, []))
+        for scenario in scenarios:
+            keys.append(scenario.key)
+            self.keys.setdefault(scenario.key, set()).add(path)
+        self.files[path] = (mtime, keys)
+
+    def refresh(self) -> None:
+        """Reads feature files that were added or changed"""
+        paths = set(self.features_path.glob("*.feature"))
+        for path in set(self.files) - paths:
+            self.forget(path)
+        for path in paths:
+            try:
+                mtime = path.stat().st_mtime_ns
+            except OSError:
+                continue
+            if path not in self.files or self.files[path][0] != mtime:
+                self.update(path)
+
+    def paths(self, scenario: Scenario) -> Set[Path]:
+        """Returns the feature files that have scenario"""
+        return self.keys.get(scenario.key, set())
+
+
+scenario_indexes: Dict[Path, ScenarioIndex] = {}
+
+
+def get_scenario_index(features_path: Path) -> ScenarioIndex:
+    """Returns the up to date scenario index of a feature directory"""
+    key = features_path.resolve()
+    index = scenario_indexes.get(key)
+    if index is None:
+        index = scenario_indexes[key] = ScenarioIndex(features_path)
+    index.refresh()
+    return index
+
+
+def create_feature(repo_path: Path, issue: todo.IssueLike) -> Path:
     """
     Create feature file from issue
     Args:
@@ -63,28 +341,30 @@ def create_feature(repo_path: Path, issue: Issue) -> Path:
         .joinpath(feature_name)
     )
     indented_issue_body = indent_sub_lines(issue.body)
+    index = get_scenario_index(feature_file_path.parent)
 
     if os.path.exists(feature_file_path):
         logger.warning(
             f"Feature file {feature_file_path} already exists. "
             f"Adding scenario(s)."
         )
-        with open(feature_file_path, "r") as ffp:
-            existing_scenarios = get_scenarios_from_issue_body(ffp.read())
-        scenarios = get_scenarios_from_issue_body(indented_issue_body)
-        for scenario in scenarios:
-            if scenario in existing_scenarios:
-                scenarios.remove(scenario)
+        scenarios: Dict[ScenarioKey, Scenario] = {}
+        for scenario in parse_feature(indented_issue_body).scenarios:
+            if feature_file_path not in index.paths(scenario):
+                scenarios.setdefault(scenario.key, scenario)
         if scenarios:
             with open(feature_file_path, "a") as fp:
-                fp.write("\n\n  ")
-                fp.writelines(scenarios)
+                for scenario in scenarios.values():
+                    fp.write("\n\n  " + scenario.text)
+                fp.write("\n")
+            index.add(feature_file_path, scenarios.values())
         else:
             logger.info("No new scenarios to add.")
     else:
         with open(feature_file_path, "w") as fp:
             fp.write("Feature: " + issue.title + "\n")
             fp.write(indented_issue_body)
+        index.update(feature_file_path)
     return feature_file_path
 
 
@@ -97,20 +377,11 @@ def get_scenarios_from_issue_body(issue_body: str) -> List[str]:
     Returns:
         List of scenarios
     """
-    scenarios = []
-    scenario_loc = issue_body.find("cenario:")
-    if scenario_loc == -1:
-        logger.warning(
-            "No scenarios found in issue body. Looking for " "'cenario:'."
-        )
-        return scenarios
-    scenario_loc -= 1
-    next_scenario_loc = issue_body.find("cenario:", scenario_loc + 9)
-    while next_scenario_loc != -1:
-        next_scenario_loc -= 1
-        scenarios.append(issue_body[scenario_loc:next_scenario_loc])
-        scenario_loc = next_scenario_loc
-    scenarios.append(issue_body[scenario_loc:])
+    scenarios = [
+        scenario.text for scenario in parse_feature(issue_body).scenarios
+    ]
+    if not scenarios:
+        logger.warning("No scenarios found in issue body.")
     return scenarios
 
 
@@ -159,6 +430,342 @@ def indent_sub_lines(issue_body: str) -> str:
     return "".join(issue_lines)
 
 
+def classify_line(stripped: str) -> Tuple[str, str, str]:
+    """
+    Returns the kind, keyword and text of a Gherkin line outside doc strings
+    Args:
+        stripped: Line without surrounding whitespace
+
+    Returns:
+        Token kind, keyword and text
+    """
+    if not stripped:
+        return EMPTY_TOKEN, "", ""
+    if stripped.startswith("#"):
+        return COMMENT_TOKEN, "", stripped[1:].strip()
+    if stripped.startswith("@"):
+        return TAG_TOKEN, "", stripped
+    if stripped.startswith("|"):
+        return TABLE_ROW_TOKEN, "", stripped
+    header, colon, rest = stripped.partition(":")
+    if colon:
+        keyword = " ".join(header.lower().split())
+        if keyword == FEATURE_TOKEN:
+            return FEATURE_TOKEN, header.strip(), rest.strip()
+        if keyword == BACKGROUND_TOKEN:
+            return BACKGROUND_TOKEN, header.strip(), rest.strip()
+        if keyword == RULE_TOKEN:
+            return RULE_TOKEN, header.strip(), rest.strip()
+        if keyword in SCENARIO_KEYWORDS:
+            return SCENARIO_TOKEN, header.strip(), rest.strip()
+        if keyword in EXAMPLES_KEYWORDS:
+            return EXAMPLES_TOKEN, header.strip(), rest.strip()
+    keyword, _, text = stripped.partition(" ")
+    if keyword.lower() in STEP_KEYWORDS + CONTINUATION_KEYWORDS:
+        return STEP_TOKEN, keyword, text.strip()
+    return DESCRIPTION_TOKEN, "", stripped
+
+
+def tokenize_gherkin(text: str) -> List[Token]:
+    """
+    Splits Gherkin into a token for each line
+    Args:
+        text: Feature file or issue body
+
+    Returns:
+        Tokens
+    """
+    tokens = []
+    doc_string = None
+    for line_num, raw in enumerate(text.splitlines()):
+        stripped = raw.strip()
+        if doc_string is not None:
+            # Everything up to the closing delimiter is doc string content
+            if stripped.startswith(doc_string):
+                doc_string = None
+            tokens.append(Token(DOC_STRING_TOKEN, line_num, "", raw, raw))
+            continue
+        if stripped.startswith(DOC_STRING_DELIMITERS):
+            doc_string = stripped[:3]
+            tokens.append(Token(DOC_STRING_TOKEN, line_num, "", raw, raw))
+            continue
+        kind, keyword, line_text = classify_line(stripped)
+        tokens.append(Token(kind, line_num, keyword, line_text, raw))
+    return tokens
+
+
+def parse_feature(feature_text: str) -> Feature:
+    """
+    Reads the scenarios and steps of a feature file
+    Args:
+        feature_text: Gherkin text
+
+    Returns:
+        Feature
+    """
+    tokens = tokenize_gherkin(feature_text)
+    name = ""
+    background: List[Step] = []
+    scenarios: List[Scenario] = []
+    steps: Optional[List[Step]] = None
+    step_type = None
+    # Tags wait for the header after them
+    tags: List[str] = []
+    tags_start = None
+    # First token (tags or header), header, tags and steps of the scenario
+    current: Optional[Tuple[int, Token, List[str], List[Step]]] = None
+
+    def end_scenario(end: int) -> None:
+        if current is None:
+            return
+        start, header, scenario_tags, scenario_steps = current
+        lines = [token.raw for token in tokens[start:end]]
+        lines[0] = lines[0].lstrip()
+        scenarios.append(
+            Scenario(
+                header.text,
+                tuple(scenario_steps),
+                tuple(scenario_tags),
+                "\n".join(lines).rstrip(),
+            )
+        )
+
+    for idx, token in enumerate(tokens):
+        if token.kind == TAG_TOKEN:
+            if tags_start is None:
+                tags_start = idx
+            tags.extend(token.text.split())
+            continue
+        if token.kind in BLOCK_TOKENS:
+            start = idx if tags_start is None else tags_start
+            end_scenario(start)
+            current = None
+            step_type = None
+            if token.kind == SCENARIO_TOKEN:
+                steps = []
+                current = (start, token, tags, steps)
+            elif token.kind == BACKGROUND_TOKEN:
+                steps = background
+            else:
+                steps = None
+                if token.kind == FEATURE_TOKEN:
+                    name = token.text
+        elif token.kind == STEP_TOKEN and steps is not None:
+            keyword = token.keyword.lower()
+            if keyword in STEP_KEYWORDS:
+                step_type = keyword
+            if step_type is not None:
+                steps.append(Step(step_type, token.text))
+        if token.kind not in (EMPTY_TOKEN, COMMENT_TOKEN):
+            # Tags on anything but a header (like Examples) are dropped
+            tags, tags_start = [], None
+    end_scenario(len(tokens))
+    return Feature(name, tuple(scenarios), tuple(background))
+
+
+def python_name(text: str) -> str:
+    """Returns a python name for text the way pytest-bdd makes them"""
+    name = re.sub(r"\W", "", text.replace(" ", "_"))
+    return re.sub(r"^\d+_*", "", name).lower()
+
+
+def python_docstring(text: str) -> str:
+    return '"""{}."""'.format(text.replace('"""', '\\"\\"\\"'))
+
+
+def render_scenario(feature_file: str, scenario: Scenario, name: str) -> str:
+    return (
+        f"@scenario({feature_file!r}, {scenario.name!r})\n"
+        f"def {name}():\n"
+        f"    {python_docstring(scenario.name)}\n"
+    )
+
+
+def render_step(step: Step, name: str) -> str:
+    return (
+        f"@{step.type}({step.text!r})\n"
+        f"def {name}():\n"
+        f"    {python_docstring(step.text)}\n"
+        "    raise NotImplementedError\n"
+    )
+
+
+def plan_step_def_module(
+    feature_path: Path, step_def_path: Path, shared: Set[str]
+) -> Optional[StepDefModule]:
+    """
+    Works out the scenarios and steps a feature's step def module is missing
+    Args:
+        feature_path: Feature file
+        step_def_path: Step def directory
+        shared: Steps defined for every module (in conftest.py)
+
+    Returns:
+        Module plan (None if the feature file can't be read)
+    """
+    started = time.perf_counter()
+    try:
+        feature = parse_feature(feature_path.read_text())
+    except (OSError, UnicodeDecodeError) as err:
+        logger.error(f"Unable to read feature file {feature_path}: {err}")
+        return None
+    test_path = step_def_path.joinpath(
+        "test_" + feature_path.name[: feature_path.name.find(".")] + ".py"
+    )
+    existing = ""
+    defined: Set[str] = set()
+    bound: Set[str] = set()
+    names: Set[str] = set()
+    if test_path.exists():
+        existing = test_path.read_text()
+        tree = read_step_module(test_path)
+        if tree is not None:
+            defined = set(module_step_names(tree))
+            bound = module_scenario_names(tree)
+            names = module_function_names(tree)
+    steps = [
+        step
+        for step in dict.fromkeys(feature.steps)
+        if step.name not in defined and step.name not in shared
+    ]
+    scenarios = []
+    for scenario in feature.scenarios:
+        if scenario.name in bound:
+            continue
+        test_name = "test_" + python_name(scenario.name)
+        suffix = 1
+        while test_name in names:
+            test_name = f"test_{python_name(scenario.name)}_{suffix}"
+            suffix += 1
+        names.add(test_name)
+        scenarios.append((scenario, test_name))
+    return StepDefModule(
+        feature,
+        feature_path,
+        test_path,
+        existing,
+        scenarios,
+        steps,
+        names,
+        time.perf_counter() - started,
+    )
+
+
+def write_step_def_module(
+    module: StepDefModule, step_names: Dict[str, str]
+) -> float:
+    """
+    Writes the missing scenarios and steps of a feature's step def module
+    Args:
+        module: Module plan
+        step_names: Function name by step
+
+    Returns:
+        Seconds taken
+    """
+    started = time.perf_counter()
+    feature_file = Path(
+        os.path.relpath(module.feature_path, module.test_path.parent)
+    ).as_posix()
+    blocks = [
+        render_scenario(feature_file, scenario, test_name)
+        for scenario, test_name in module.scenarios
+    ]
+    blocks += [
+        render_step(step, step_names.get(step.name, "_"))
+        for step in module.steps
+    ]
+    if not blocks:
+        logger.info(f"{module.test_path} already has every step")
+        return time.perf_counter() - started
+    if module.existing:
+        content = module.existing.rstrip("\n") + "\n\n\n"
+    else:
+        title = module.feature.name or module.feature_path.name
+        content = (
+            python_docstring(f"{title} feature tests")
+            + "\n\n"
+            + STEP_DEF_IMPORTS
+            + "\n\n"
+        )
+    with open(module.test_path, "w") as tp:
+        tp.write(content + "\n\n".join(blocks))
+    return time.perf_counter() - started
+
+
+def build_step_defs(
+    feature_paths: List[Path],
+    step_def_path: Path,
+    batch: bool = True,
+    executor: Optional[Executor] = None,
+) -> List[StepDefModule]:
+    """
+    Creates or extends the step def module of each feature file. Scenarios
+    and steps the module already has, and steps shared through conftest.py,
+    are skipped. Steps are named after identical steps in other step def
+    modules, the rest with batched requests for all of the feature files.
+    Args:
+        feature_paths: Feature files
+        step_def_path: Step def directory
+        batch: Name steps in batches (otherwise one request per step)
+        executor: Pool to parse and write modules on (defaults to this
+            thread)
+
+    Returns:
+        Module written for each feature file that could be read
+    """
+    step_def_path.mkdir(parents=True, exist_ok=True)
+    shared: Set[str] = set()
+    conftest = read_step_module(step_def_path.joinpath("conftest.py"))
+    if conftest is not None:
+        shared.update(module_step_names(conftest))
+    known = known_step_names(step_def_path)
+    map_fn = executor.map if executor is not None else map
+    modules = [
+        module
+        for module in map_fn(
+            plan_step_def_module,
+            feature_paths,
+            repeat(step_def_path),
+            repeat(shared),
+        )
+        if module is not None
+    ]
+
+    taken: Set[str] = set()
+    for module in modules:
+        taken.update(module.function_names)
+    step_names = name_steps(
+        [step.name for module in modules for step in module.steps],
+        taken,
+        known,
+        batch,
+    )
+    for module, seconds in zip(
+        modules, map_fn(write_step_def_module, modules, repeat(step_names))
+    ):
+        module.seconds += seconds
+    return modules
+
+
+def write_step_defs(
+    feature_paths: List[Path], step_def_path: Path, batch: bool = True
+) -> List[Path]:
+    """
+    Creates or extends the step def module of each feature file (see
+    build_step_defs)
+    Args:
+        feature_paths: Feature files
+        step_def_path: Step def directory
+        batch: Name steps in batches (otherwise one request per step)
+
+    Returns:
+        Step def file paths
+    """
+    modules = build_step_defs(feature_paths, step_def_path, batch)
+    return [module.test_path for module in modules]
+
+
 def create_step_defs(feature_path: Path) -> Optional[Path]:
     """
     Create definition file from feature file
@@ -168,80 +775,317 @@ def create_step_defs(feature_path: Path) -> Optional[Path]:
     Returns:
         step_def file path
     """
-    feat_file_name = os.path.split(feature_path)[1]
-    feature_name = feat_file_name[: feat_file_name.find(".")]
-    test_filename = "test_" + feature_name + ".py"
-    test_root = feature_path.parent.joinpath("..")
-    test_path = test_root.joinpath(step_def_dir).joinpath(test_filename)
-    try:
-        cp_step_def = subprocess.run(
-            [
-                "pytest-bdd",
-                "generate",
-                f"{feature_path}",
-            ],
-            capture_output=True,
-        )
-        if cp_step_def.returncode == 0:
-            with open(test_path, "w") as tp:
-                test_body = cp_step_def.stdout.decode("UTF-8", errors="ignore")
-                tp.write(test_body.replace("\r", ""))
-            fix_step_def_functions(test_path)
-            return test_path
-        else:
-            logger.error(cp_step_def.stderr)
-    except FileNotFoundError as err:
-        logger.error(err)
+    if not feature_path.exists():
         logger.error(f"Feature file {feature_path} not found.")
+        return None
+    test_paths = write_step_defs(
+        [feature_path], feature_path.parent.parent.joinpath(step_def_dir)
+    )
+    return test_paths[0] if test_paths else None
 
 
-def fix_step_def_functions(test_path: Path) -> None:
+def create_all_step_defs(features_path: Path) -> List[Path]:
     """
-    Write titles for step def functions
+    Create definition files for every feature file in a directory in one
+    pass
     Args:
-        test_path
+        features_path: Features directory
 
     Returns:
-        None
+        step_def file paths
     """
-    with open(test_path, "r") as tp:
-        test_lines = tp.readlines()
-    test_lines[0].lstrip('"').rstrip('"')
-    prompt_base = (
-        "Write just the python function title for the following "
-        "step def:\n "
+    return write_step_defs(
+        sorted(features_path.glob("*.feature")),
+        features_path.parent.joinpath(step_def_dir),
     )
-    for idx, line in enumerate(test_lines):
-        if line.startswith("@scenario('features\\"):
-            test_lines[idx] = line.replace(
-                "@scenario('features\\", "@scenario('../features/"
-            )
-        if line.startswith('@scenario("features\\'):
-            test_lines[idx] = line.replace(
-                '@scenario("features\\', '@scenario("../features/'
+
+
+def generate_tests(
+    repo_path: Path,
+    issues: Sequence[todo.IssueLike],
+    max_workers: Optional[int] = None,
+    batch: bool = True,
+) -> List[GeneratedTests]:
+    """
+    Creates the feature files and step defs for many issues at once.
+    Feature files are written first, then every step def module is parsed
+    and written on a pool of processes, with the steps of all of them named
+    by concurrent batched requests in between.
+    Args:
+        repo_path
+        issues: Issues with Gherkin scenarios in their bodies
+        max_workers: Processes to parse and write step defs on (defaults to
+            the number of CPUs)
+        batch: Name steps in batches (otherwise one request per step)
+
+    Returns:
+        What was generated for each issue, in the same order
+    """
+    create_test_dirs(repo_path)
+    feature_paths: List[Optional[Path]] = []
+    feature_seconds: List[float] = []
+    errors: List[str] = []
+    for issue in issues:
+        started = time.perf_counter()
+        try:
+            feature_paths.append(create_feature(repo_path, issue))
+            errors.append("")
+        except OSError as oe:
+            logger.error(f"Unable to create feature for {issue.title}: {oe}")
+            feature_paths.append(None)
+            errors.append(str(oe))
+        feature_seconds.append(time.perf_counter() - started)
+
+    unique_paths = list(dict.fromkeys(p for p in feature_paths if p))
+    step_def_path = repo_path.joinpath(tests_dir, step_def_dir)
+    started = time.perf_counter()
+    if len(unique_paths) > 1:
+        # Spawn rather than fork: under coder serve other threads may hold
+        # the logging or rate limiter locks, which forked workers would
+        # inherit locked
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            modules = build_step_defs(
+                unique_paths, step_def_path, batch, executor
             )
-        if line.startswith("def _():"):
-            step_def = (
-                test_lines[idx - 1]
-                .replace("@given(", "Given ")
-                .replace("@when(", "When ")
-                .replace("@then(", "Then ")
-                .replace(")", "")
+    else:
+        modules = build_step_defs(unique_paths, step_def_path, batch)
+    logger.info(
+        f"Step defs for {len(unique_paths)} feature file(s) took "
+        f"{time.perf_counter() - started:.2f}s"
+    )
+    by_feature = {module.feature_path: module for module in modules}
+
+    results = []
+    for issue, feature_path, seconds, error in zip(
+        issues, feature_paths, feature_seconds, errors
+    ):
+        module = by_feature.get(feature_path) if feature_path else None
+        if feature_path and module is None and not error:
+            error = "Unable to read feature file"
+        results.append(
+            GeneratedTests(
+                getattr(issue, "number", None),
+                issue.title,
+                feature_path,
+                module.test_path if module else None,
+                seconds + (module.seconds if module else 0.0),
+                error,
             )
-            prompt = prompt_base + step_def
-            response = llm.complete_prompt(prompt=prompt)
-            if response.find(" ") != -1:
-                response = response[response.rfind(" ") + 1 :]
-            if response:
-                response = (
-                    response.replace("def ", "")
-                    .replace("()", "")
-                    .replace(":", "")
-                )
-                test_lines[idx] = line.replace("_", response)
-
-    with open(test_path, "w") as tp:
-        tp.writelines(test_lines)
+        )
+    return results
+
+
+def read_step_module(path: Path) -> Optional[ast.Module]:
+    """Parses a step def module (None if it can't be read or parsed)"""
+    try:
+        return ast.parse(path.read_text())
+    except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+        return None
+
+
+def decorator_text(
+    decorator: ast.expr, names: Tuple[str, ...], arg: int
+) -> Optional[Tuple[str, str]]:
+    """
+    Returns the string argument of a pytest-bdd decorator
+    Args:
+        decorator: Decorator expression
+        names: Decorator names to match (e.g. given, when, then)
+        arg: Position of the string argument
+
+    Returns:
+        Decorator name and string argument (None if it doesn't match)
+    """
+    if not (
+        isinstance(decorator, ast.Call)
+        and isinstance(decorator.func, ast.Name)
+        and decorator.func.id in names
+        and len(decorator.args) > arg
+    ):
+        return None
+    argument = decorator.args[arg]
+    # parsers.parse("...") and the like
+    if isinstance(argument, ast.Call) and argument.args:
+        argument = argument.args[0]
+    if isinstance(argument, ast.Constant) and isinstance(argument.value, str):
+        return decorator.func.id, argument.value
+    return None
+
+
+def module_step_names(tree: ast.Module) -> Dict[str, str]:
+    """
+    Returns the steps a step def module defines
+    Args:
+        tree: Parsed module
+
+    Returns:
+        Function name by step (e.g. Given a repo)
+    """
+    names: Dict[str, str] = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.FunctionDef):
+            continue
+        for decorator in node.decorator_list:
+            found = decorator_text(decorator, STEP_KEYWORDS, 0)
+            if found is not None:
+                step = f"{found[0].capitalize()} {found[1]}"
+                names.setdefault(step, node.name)
+    return names
+
+
+def module_scenario_names(tree: ast.Module) -> Set[str]:
+    """Returns the names of the scenarios a step def module binds"""
+    return {
+        found[1]
+        for node in ast.walk(tree)
+        if isinstance(node, ast.FunctionDef)
+        for found in (
+            decorator_text(decorator, ("scenario",), 1)
+            for decorator in node.decorator_list
+        )
+        if found is not None
+    }
+
+
+def module_function_names(tree: ast.Module) -> Set[str]:
+    return {
+        node.name
+        for node in ast.walk(tree)
+        if isinstance(node, ast.FunctionDef)
+    }
+
+
+def known_step_names(
+    step_def_path: Path, exclude: Optional[Path] = None
+) -> Dict[str, str]:
+    """
+    Returns the function names already given to steps in the step def
+    modules of other feature files
+    Args:
+        step_def_path: Step def directory
+        exclude: Step def module to skip
+
+    Returns:
+        Function name by step (e.g. Given a repo)
+    """
+    names: Dict[str, str] = {}
+    for path in sorted(step_def_path.glob("*.py")):
+        if exclude is not None and exclude.exists() and path.samefile(exclude):
+            continue
+        tree = read_step_module(path)
+        if tree is None:
+            continue
+        for step, name in module_step_names(tree).items():
+            if name != "_":
+                names.setdefault(step, name)
+    return names
+
+
+def is_valid_step_name(name: Any, taken: Set[str]) -> bool:
+    """Returns True if name can be used for another function in a module
+    that already defines taken"""
+    return (
+        isinstance(name, str)
+        and name.isidentifier()
+        and not keyword.iskeyword(name)
+        and name != "_"
+        and name not in taken
+    )
+
+
+def clean_step_name(response: str) -> str:
+    """Returns the function name from a response with a function title"""
+    if response.find(" ") != -1:
+        response = response[response.rfind(" ") + 1 :]
+    return response.replace("def ", "").replace("()", "").replace(":", "")
+
+
+def name_steps(
+    steps: List[str],
+    taken: Set[str],
+    known: Dict[str, str],
+    batch: bool = True,
+) -> Dict[str, str]:
+    """
+    Names step def functions, reusing known names, then asking for all
+    other names with one request per STEP_NAME_BATCH_SIZE steps, then asking
+    for each name the batched responses left out or got wrong
+    Args:
+        steps: Steps to name (e.g. Given a repo)
+        taken: Names already defined in the step def module
+        known: Names given to steps in other step def modules
+        batch: Ask for names in batches (otherwise one request per step)
+
+    Returns:
+        Function name by step (steps that couldn't be named are left out)
+    """
+    if not steps:
+        return {}
+    taken = set(taken)
+    names: Dict[str, str] = {}
+
+    def use(step: str, name: Any) -> bool:
+        if not is_valid_step_name(name, taken):
+            return False
+        names[step] = name
+        taken.add(name)
+        return True
+
+    steps = list(dict.fromkeys(steps))
+    for step in steps:
+        if step in known:
+            use(step, known[step])
+    unnamed = [step for step in steps if step not in names]
+    reused = len(steps) - len(unnamed)
+
+    if batch and unnamed:
+        chunks = [
+            unnamed[start : start + STEP_NAME_BATCH_SIZE]
+            for start in range(0, len(unnamed), STEP_NAME_BATCH_SIZE)
+        ]
+        # Batches are independent so ask for all of them at once
+        responses = llm.gather_prompts(
+            [
+                "Write a python function name for each of the following "
+                "pytest-bdd step defs, a different snake_case name for "
+                "each. Respond with just a JSON object mapping each step "
+                "def, exactly as written, to its function name:\n"
+                + json.dumps(chunk, indent=2)
+                for chunk in chunks
+            ]
+        )
+        for chunk, response in zip(chunks, responses):
+            batch_names = chains.parse_json_object(response) or {}
+            for step in chunk:
+                name = batch_names.get(step)
+                use(step, name.strip() if isinstance(name, str) else name)
+        unnamed = [step for step in unnamed if step not in names]
+
+    if unnamed:
+        if batch:
+            logger.info(f"Naming {len(unnamed)} step(s) one at a time")
+        # Step prompts are independent so ask for all of them at once
+        responses = llm.gather_prompts(
+            [
+                "Write just the python function title for the following "
+                f"step def:\n {step}"
+                for step in unnamed
+            ]
+        )
+        for step, response in zip(unnamed, responses):
+            name = clean_step_name(response)
+            suffix = 2
+            while name.isidentifier() and name in taken:
+                name = f"{clean_step_name(response)}_{suffix}"
+                suffix += 1
+            if not use(step, name):
+                logger.warning(f"No valid function name for step {step}")
+
+    logger.info(f"Named {len(names)} of {len(steps)} steps ({reused} reused)")
+    return names
 
 
 def create_unit_tests(
@@ -262,113 +1106,31 @@ def create_unit_tests(
         unit test file path
     """
     source_module = src_file_name[: src_file_name.find(".")]
-    chat = ChatOpenAI(model_name=llm.CHAT_MODEL)
-    role_template = (
-        "You are a great QA engineer preparing a suite of unit "
-        "tests for Test Driven Development."
-    )
-    # Create test cases
-    test_case_template = (
-        "{role} Evaluate the following {issue_type} and "
-        "return a list of all of the test cases that "
-        "should be tested.\nIssue: {issue_body}"
-    )
-    test_case_prompt = HumanMessagePromptTemplate(
-        prompt=PromptTemplate.from_template(test_case_template)
-    )
-    test_case_chat = ChatPromptTemplate.from_messages([test_case_prompt])
-    test_case_chain = LLMChain(
-        llm=chat,
-        prompt=test_case_chat,
-        output_key="test_cases",
-    )
-    # Critique test cases
-    critique_template = (
-        "{role} Compare the list of test cases with the "
-        "{issue_type}. Which of the test "
-        "cases are redundant, incorrect, or can be "
-        "simplified?\nIssue: {issue_body}\n"
-        "Test cases:\n{test_cases}"
-    )
-    critique_prompt = HumanMessagePromptTemplate(
-        prompt=PromptTemplate.from_template(critique_template)
-    )
-    critique_chat = ChatPromptTemplate.from_messages([critique_prompt])
-    critique_chain = LLMChain(
-        llm=chat,
-        prompt=critique_chat,
-        output_key="critique",
-    )
-    # Write updated test cases
-    update_template = (
-        "{role}\n"
-        "For {issue_type}: {issue_body}\n"
-        "You wrote test cases:\n{test_cases}"
-        "You critiqued the test cases:\n{critique}"
-        "Write what the test cases should be (if there are no "
-        "changes needed, please repeat the test cases):\n"
-    )
-    update_prompt = HumanMessagePromptTemplate(
-        prompt=PromptTemplate.from_template(update_template)
-    )
-    update_chat = ChatPromptTemplate.from_messages([update_prompt])
-    update_chain = LLMChain(
-        llm=chat,
-        prompt=update_chat,
-        output_key="updated_test_cases",
-    )
-    # Write unit tests
-    unit_test_template = (
-        "{role} Write python pytest unit tests for the "
-        "following test cases:\n{updated_test_cases}\n"
-        "Good unit tests should be independent, "
-        "deterministic, self-validating, "
-        "isolated, reproducible, and take advantage of the "
-        "features of pytest to make the tests easy to "
-        "write and maintain. Any explanation for the tests should be made "
-        "as comments in python. For the module under test use the name "
-        "'{source_module}' in the '{package_name}' package (for example: "
-        "from {package_name} import {source_module}). Return just the "
-        "python code for the unit tests."
-    )
-    unit_test_prompt = HumanMessagePromptTemplate(
-        prompt=PromptTemplate.from_template(unit_test_template)
-    )
-    unit_test_chat = ChatPromptTemplate.from_messages([unit_test_prompt])
-    unit_test_chain = LLMChain(
-        llm=chat,
-        prompt=unit_test_chat,
-        output_key="unit_tests",
-    )
-    create_tests_chain = SequentialChain(
-        memory=SimpleMemory(memories={"role": role_template}),
-        chains=[
-            test_case_chain,
-            critique_chain,
-            update_chain,
-            unit_test_chain,
-        ],
-        input_variables=[
-            "issue_body",
-            "issue_type",
-            "source_module",
-            "package_name",
-        ],
-        output_variables=[
-            "test_cases",
-            "critique",
-            "updated_test_cases",
-            "unit_tests",
-        ],
-        verbose=True,
-    )
-    result = create_tests_chain(
+    context = f"{issue_type}: {issue_body}"
+    mode = chains.choose_chain_mode(issue_type, context)
+    if mode == chains.CHAIN_COMPACT:
+        result = chains.run_compact_chain(
+            UNIT_TEST_ROLE,
+            (
+                f"python pytest unit tests. {UNIT_TEST_GUIDELINES} For the "
+                f"module under test use the name '{source_module}' in the "
+                f"'{package_name}' package (for example: from {package_name} "
+                f"import {source_module})"
+            ),
+            f"Evaluate the following {issue_type}.\n{context}",
+            "test cases",
+        )
+        return result["code"]
+    result = chains.run_conversation(
+        "Unit tests",
+        UNIT_TEST_ROLE,
+        context,
+        UNIT_TEST_TURNS,
         {
-            "issue_body": issue_body,
             "issue_type": issue_type,
             "source_module": source_module,
             "package_name": package_name,
-        }
+        },
     )
     return result["unit_tests"]
 
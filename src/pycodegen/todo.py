@@ -1,13 +1,33 @@
-from typing import List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+import json
 import logging
 import os
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+from pycodegen import cache
 
-from github import Github
-from github.GithubException import GithubException
-from github.Issue import Issue
-from github.IssueComment import IssueComment
-from github.Repository import Repository
+if TYPE_CHECKING:
+    from github import Github
+    from github.Issue import Issue
+    from github.IssueComment import IssueComment
+    from github.Label import Label
+    from github.Repository import Repository
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,6 +45,72 @@ docs_type = "docs"
 chore_branch_prefix = "chore"
 chore_type = "chore"
 
+# Labels that mark each issue type, in order of precedence
+issue_type_labels = (
+    (feature_type, frozenset({"enhancement"})),
+    (bug_type, frozenset({"bug"})),
+    (docs_type, frozenset({"documentation"})),
+)
+
+# Issue queue priority scoring
+issue_type_priority = {
+    bug_type: 30,
+    feature_type: 20,
+    docs_type: 10,
+    chore_type: 5,
+}
+priority_labels = frozenset(
+    {"priority", "high priority", "priority: high", "urgent", "critical"}
+)
+PRIORITY_LABEL_SCORE = 50
+AGE_SCORE_PER_DAY = 0.5
+MAX_AGE_SCORE = 30
+MILESTONE_SCORE = 15
+REACTION_SCORE = 2
+MAX_REACTION_SCORE = 40
+ISSUE_QUEUE_SIZE = 10
+ISSUE_QUEUE_TTL = 10 * 60
+
+issue_queue_cache = cache.DiskCache("issues", ttl=ISSUE_QUEUE_TTL)
+
+# Seconds before a cached GitHub object is revalidated with a conditional
+# request (If-None-Match/If-Modified-Since). 304 responses don't count
+# against the rate limit.
+REVALIDATE_AFTER = 60
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+GRAPHQL_TIMEOUT = 30
+GRAPHQL_PAGE_SIZE = 100
+ISSUE_SNAPSHOT_QUERY = """
+query(
+  $owner: String!, $name: String!, $number: Int!, $first: Int!, $after: String
+) {
+  repository(owner: $owner, name: $name) {
+    issue(number: $number) {
+      number
+      title
+      body
+      state
+      labels(first: $first) {
+        nodes { name }
+      }
+      comments(first: $first, after: $after) {
+        pageInfo { hasNextPage endCursor }
+        nodes { databaseId body }
+      }
+    }
+  }
+}
+"""
+
+T = TypeVar("T")
+# Sends a GraphQL query with variables and returns the decoded response
+Transport = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+
+clients: Dict[str, "Github"] = {}
+github_objects: Dict[Hashable, Tuple[Any, float]] = {}
+comment_stores: Dict[str, "CommentStore"] = {}
+
 
 def get_gh_token_from_env() -> Optional[str]:
     """Returns Github Token if available as environment variable."""
@@ -36,16 +122,226 @@ def get_gh_token_from_env() -> Optional[str]:
     return os.getenv("GH_TOKEN")
 
 
-def get_repo(repo_owner: str, repo_name: str) -> Optional[Repository]:
+def get_client(token: str) -> "Github":
+    """Returns the GitHub client for token, creating it on first use"""
+    from github import Github
+
+    client = clients.get(token)
+    if client is None:
+        client = Github(token)
+        clients[token] = client
+    return client
+
+
+def revalidate(github_object: Any) -> bool:
+    """
+    Refreshes a GitHub object with a conditional request
+    Args:
+        github_object
+
+    Returns:
+        True if the object changed since it was fetched
+    """
+    from github.GithubException import GithubException
+
+    try:
+        return bool(github_object.update())
+    except GithubException as ge:
+        logger.warning(f"Unable to revalidate {github_object}: {ge}")
+        return False
+
+
+def cached_github_object(key: Hashable, fetch: Callable[[], T]) -> T:
+    """
+    Returns the GitHub object cached under key, fetching it on first use and
+    revalidating it once it's older than REVALIDATE_AFTER seconds
+    Args:
+        key: Cache key
+        fetch: Function that gets the object from GitHub
+
+    Returns:
+        GitHub object
+    """
+    now = time.monotonic()
+    entry = github_objects.get(key)
+    if entry is None:
+        github_object = fetch()
+    else:
+        github_object, checked = entry
+        if now - checked < REVALIDATE_AFTER:
+            return github_object
+        if revalidate(github_object):
+            logger.debug(f"{key} changed on GitHub")
+    github_objects[key] = (github_object, now)
+    return github_object
+
+
+def clear_github_cache() -> None:
+    clients.clear()
+    github_objects.clear()
+    comment_stores.clear()
+
+
+def get_repo(repo_owner: str, repo_name: str) -> Optional["Repository"]:
     token = get_gh_token_from_env()
     if not token:
         return None
 
-    g = Github(token)
-    return g.get_repo(f"{repo_owner}/{repo_name}")
+    full_name = f"{repo_owner}/{repo_name}"
+    return cached_github_object(
+        ("repo", token, full_name),
+        lambda: get_client(token).get_repo(full_name),
+    )
+
 
+def get_org_repo_names(org_name: str) -> List[str]:
+    """
+    Lists the repos of a GitHub organization
+    Args:
+        org_name
 
-def get_next_issue(repo_owner: str, repo_name: str) -> Optional[Issue]:
+    Returns:
+        Full names (owner/repo) of the org's unarchived repos
+    """
+    from github.GithubException import GithubException
+
+    token = get_gh_token_from_env()
+    if not token:
+        return []
+    try:
+        org = get_client(token).get_organization(org_name)
+        return [
+            repo.full_name for repo in org.get_repos() if not repo.archived
+        ]
+    except GithubException as ge:
+        logger.error(ge)
+        return []
+
+
+def score_issue(issue: "Issue", now: Optional[datetime] = None) -> float:
+    """
+    Scores an open issue for priority from its labels, age, milestone and
+    reactions (higher is more important)
+    Args:
+        issue
+        now: Time to measure age from (defaults to now)
+
+    Returns:
+        Priority score
+    """
+    if now is None:
+        now = datetime.now(timezone.utc)
+    label_names = {label.name.lower() for label in issue.labels}
+    score = float(issue_type_priority.get(classify_labels(label_names), 0))
+    if label_names & priority_labels:
+        score += PRIORITY_LABEL_SCORE
+    created_at = issue.created_at
+    if created_at is not None:
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        age_days = max(0.0, (now - created_at).total_seconds() / 86400)
+        score += min(age_days * AGE_SCORE_PER_DAY, MAX_AGE_SCORE)
+    if issue.milestone is not None:
+        score += MILESTONE_SCORE
+    reactions = getattr(issue, "reactions", None) or {}
+    score += min(
+        reactions.get("total_count", 0) * REACTION_SCORE, MAX_REACTION_SCORE
+    )
+    return score
+
+
+def rank_issues(issues: Iterable["Issue"]) -> List[Tuple["Issue", float]]:
+    """Returns issues with their scores, highest score (then oldest) first"""
+    now = datetime.now(timezone.utc)
+    scored = [(issue, score_issue(issue, now)) for issue in issues]
+    scored.sort(
+        key=lambda scored_issue: (-scored_issue[1], scored_issue[0].number)
+    )
+    return scored
+
+
+def get_issue_queue(
+    repo_owner: str,
+    repo_name: str,
+    k: int = ISSUE_QUEUE_SIZE,
+    refresh=False,
+    owner_only=True,
+) -> List[int]:
+    """
+    Returns the numbers of the top k open issues by priority. Issues are read
+    in one paginated pass with no writes, and the ranking is cached between
+    runs for ISSUE_QUEUE_TTL seconds.
+    Args:
+        repo_owner
+        repo_name
+        k: Number of issues to return
+        refresh: Ignore the cached ranking
+        owner_only: Only rank issues created by repo_owner (turn off for
+            organization repos, since organizations don't create issues)
+
+    Returns:
+        Issue numbers, highest priority first
+    """
+    key = cache.hash_key("issue_queue", repo_owner, repo_name, k, owner_only)
+    if not refresh:
+        cached_queue = issue_queue_cache.get(key)
+        if cached_queue is not None:
+            return [int(number) for number in cached_queue]
+    repo = get_repo(repo_owner, repo_name)
+    if not repo:
+        return []
+    if owner_only:
+        open_issues = repo.get_issues(
+            state="open", direction="asc", creator=repo_owner
+        )
+    else:
+        open_issues = repo.get_issues(state="open", direction="asc")
+    # The issues endpoint also lists pull requests
+    ranked = rank_issues(
+        issue for issue in open_issues if issue.pull_request is None
+    )
+    queue = [issue.number for issue, _ in ranked[:k]]
+    for issue, score in ranked[:k]:
+        logger.debug(f"Issue #{issue.number} score {score:.1f}: {issue.title}")
+    issue_queue_cache.set(key, queue)
+    return queue
+
+
+def get_open_issue_numbers(
+    repo_owner: str, repo_name: str, issue_type: str
+) -> List[int]:
+    """
+    Returns the numbers of the open issues of a type, oldest first
+    Args:
+        repo_owner
+        repo_name
+        issue_type: e.g. feature_type (issues labeled enhancement)
+
+    Returns:
+        Issue numbers
+    """
+    repo = get_repo(repo_owner, repo_name)
+    if not repo:
+        return []
+    numbers = set()
+    for type_name, type_labels in issue_type_labels:
+        if type_name != issue_type:
+            continue
+        for label_name in type_labels:
+            label = get_label(repo, label_name)
+            if label is None:
+                continue
+            numbers.update(
+                issue.number
+                for issue in repo.get_issues(
+                    state="open", labels=[label], direction="asc"
+                )
+                if issue.pull_request is None
+            )
+    return sorted(numbers)
+
+
+def get_next_issue(repo_owner: str, repo_name: str) -> Optional["Issue"]:
     """
     Get the next task for repo
 
@@ -59,21 +355,19 @@ def get_next_issue(repo_owner: str, repo_name: str) -> Optional[Issue]:
     repo = get_repo(repo_owner, repo_name)
     if not repo:
         return None
-    open_issues = repo.get_issues(
-        state="open", direction="asc", creator=repo_owner
-    )
-    if not open_issues:
-        logger.info(f"No open issues for repo: {repo_owner}/{repo_name}")
-        return None
-    for issue in open_issues:
-        issue.edit(state="open")
-    # TODO: Add logic to determine which open issue is highest priority
-    # Currently getting the oldest open issue
-    next_open_issue = open_issues[0]
-    return next_open_issue
+    for refresh in (False, True):
+        for issue_num in get_issue_queue(
+            repo_owner, repo_name, refresh=refresh
+        ):
+            issue = get_issue(repo, issue_num)
+            # Cached queue may include issues closed since it was ranked
+            if issue and issue.state == "open":
+                return issue
+    logger.info(f"No open issues for repo: {repo_owner}/{repo_name}")
+    return None
 
 
-def get_issue(repo: Repository, issue_num: int) -> Optional[Issue]:
+def get_issue(repo: "Repository", issue_num: int) -> Optional["Issue"]:
     """
     Get a specific task to do for repo
 
@@ -85,16 +379,221 @@ def get_issue(repo: Repository, issue_num: int) -> Optional[Issue]:
         GitHub Issue representing the issue specified (None if no issue with
         that number)
     """
+    from github.GithubException import GithubException
+
     if not repo:
         return None
     try:
-        return repo.get_issue(issue_num)
+        return cached_github_object(
+            ("issue", repo.full_name, issue_num),
+            lambda: repo.get_issue(issue_num),
+        )
     except GithubException as ge:
         logger.error(ge)
         return None
 
 
-def get_issue_type(repo: Repository, issue: Issue) -> Optional[str]:
+@dataclass(frozen=True)
+class IssueSnapshot:
+    """
+    Immutable copy of an issue with its labels and comments, fetched in one
+    GraphQL round trip. Has the same number, title and body attributes as a
+    PyGithub Issue for code that only reads those.
+    """
+
+    number: int
+    title: str
+    body: str
+    state: str
+    labels: Tuple[str, ...]
+    comments: Tuple[str, ...]
+    comment_ids: Tuple[int, ...]
+
+    @property
+    def issue_type(self) -> Optional[str]:
+        return classify_labels(self.labels)
+
+
+IssueLike = Union["Issue", IssueSnapshot]
+
+
+def graphql_transport(token: str) -> Transport:
+    """Returns a transport that posts queries to the GitHub GraphQL API"""
+    import requests
+
+    session = requests.Session()
+    session.headers["Authorization"] = f"bearer {token}"
+
+    def send(query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        response = session.post(
+            GRAPHQL_URL,
+            json={"query": query, "variables": variables},
+            timeout=GRAPHQL_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    return send
+
+
+class RecordedTransport:
+    """
+    Transport that replays recorded GraphQL responses in order, as a local
+    stand-in for the GitHub API
+    """
+
+    def __init__(self, responses: List[Dict[str, Any]]):
+        self.responses = list(responses)
+        self.requests: List[Tuple[str, Dict[str, Any]]] = []
+
+    @classmethod
+    def from_file(cls, path: Path) -> "RecordedTransport":
+        """Loads a recorded response, or a list of them, from a JSON file"""
+        with open(path, "r", encoding="utf-8") as fp:
+            recorded = json.load(fp)
+        if isinstance(recorded, dict):
+            recorded = [recorded]
+        return cls(recorded)
+
+    def __call__(
+        self, query: str, variables: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        self.requests.append((query, dict(variables)))
+        if not self.responses:
+            raise LookupError("No more recorded responses")
+        return self.responses.pop(0)
+
+
+def fetch_issue_snapshot(
+    repo_owner: str,
+    repo_name: str,
+    issue_num: int,
+    transport: Optional[Transport] = None,
+) -> Optional[IssueSnapshot]:
+    """
+    Fetches an issue body, labels and comments with one GraphQL query
+    (more only for issues with over GRAPHQL_PAGE_SIZE comments)
+    Args:
+        repo_owner
+        repo_name
+        issue_num
+        transport: Sends the query (defaults to the GitHub GraphQL API)
+
+    Returns:
+        IssueSnapshot (None if the issue couldn't be fetched)
+    """
+    if transport is None:
+        token = get_gh_token_from_env()
+        if not token:
+            return None
+        transport = graphql_transport(token)
+    variables: Dict[str, Any] = {
+        "owner": repo_owner,
+        "name": repo_name,
+        "number": issue_num,
+        "first": GRAPHQL_PAGE_SIZE,
+        "after": None,
+    }
+    comments: List[str] = []
+    comment_ids: List[int] = []
+    while True:
+        try:
+            response = transport(ISSUE_SNAPSHOT_QUERY, variables)
+        # requests.RequestException is an OSError
+        except (OSError, LookupError, ValueError) as e:
+            logger.error(f"Unable to fetch issue #{issue_num}: {e}")
+            return None
+        if response.get("errors"):
+            logger.error(
+                f"Unable to fetch issue #{issue_num}: {response['errors']}"
+            )
+            return None
+        issue = ((response.get("data") or {}).get("repository") or {}).get(
+            "issue"
+        )
+        if not issue:
+            logger.error(f"Issue #{issue_num} not found")
+            return None
+        page = issue["comments"]
+        for comment in page["nodes"]:
+            comment_ids.append(comment["databaseId"])
+            comments.append(comment["body"])
+        if not page["pageInfo"]["hasNextPage"]:
+            break
+        variables["after"] = page["pageInfo"]["endCursor"]
+    return IssueSnapshot(
+        number=issue["number"],
+        title=issue["title"],
+        body=issue["body"] or "",
+        state=issue["state"].lower(),
+        labels=tuple(label["name"] for label in issue["labels"]["nodes"]),
+        comments=tuple(comments),
+        comment_ids=tuple(comment_ids),
+    )
+
+
+class LabelIndex:
+    """
+    Labels of a repository by lowercase name, fetched with one paginated
+    request and then looked up locally
+    """
+
+    def __init__(self, repo: "Repository"):
+        self.repo = repo
+        self.labels: Dict[str, "Label"] = {}
+        self.update()
+
+    def update(self) -> bool:
+        """Refetches the labels and returns True if they changed"""
+        labels = {
+            label.name.lower(): label for label in self.repo.get_labels()
+        }
+        changed = labels.keys() != self.labels.keys()
+        self.labels = labels
+        return changed
+
+    def get(self, name: str) -> Optional["Label"]:
+        return self.labels.get(name.lower())
+
+    def __contains__(self, name: str) -> bool:
+        return name.lower() in self.labels
+
+    def classify(self, label_names: Iterable[str]) -> Optional[str]:
+        """Returns the issue type for label names that exist in the repo"""
+        return classify_labels(name for name in label_names if name in self)
+
+
+def classify_labels(label_names: Iterable[str]) -> Optional[str]:
+    """
+    Maps a set of label names to an issue type
+    Args:
+        label_names
+
+    Returns:
+        Issue type (str), None if there are no labels
+    """
+    names = {name.lower() for name in label_names}
+    if not names:
+        return None
+    for issue_type, type_labels in issue_type_labels:
+        if names & type_labels:
+            return issue_type
+    return chore_type
+
+
+def get_label_index(repo: "Repository") -> LabelIndex:
+    """Returns the label index for repo, cached between calls"""
+    return cached_github_object(
+        ("labels", repo.full_name), lambda: LabelIndex(repo)
+    )
+
+
+def get_label(repo: "Repository", name: str) -> Optional["Label"]:
+    """Returns a repo label by name"""
+    return get_label_index(repo).get(name)
+
+
+def get_issue_type(repo: "Repository", issue: "Issue") -> Optional[str]:
     """
     Determine the issue type from the labels
 
@@ -105,30 +604,27 @@ def get_issue_type(repo: Repository, issue: Issue) -> Optional[str]:
     Returns:
         Issue type (str)
     """
-    if issue.labels:
-        if repo.get_label("enhancement") in issue.labels:
-            return feature_type
-        elif repo.get_label("bug") in issue.labels:
-            return bug_type
-        elif repo.get_label("documentation") in issue.labels:
-            return docs_type
-        else:
-            return chore_type
-    else:
+    if not issue.labels:
         return None
+    label_index = get_label_index(repo)
+    return label_index.classify(label.name for label in issue.labels)
 
 
-def issue_title_to_branch_name(repo: Repository, issue: Issue) -> str:
+def issue_title_to_branch_name(
+    repo: "Repository", issue: "Issue", issue_type: Optional[str] = None
+) -> str:
     """
     Provide a branch name based on naming conventions for an issue
     Args:
         repo
         issue
+        issue_type: Issue type if already known
 
     Returns:
         branch_name (str)
     """
-    issue_type = get_issue_type(repo, issue)
+    if issue_type is None:
+        issue_type = get_issue_type(repo, issue)
     if issue_type == feature_type:
         branch_name = feature_branch_prefix
     elif issue_type == bug_type:
@@ -189,29 +685,104 @@ def get_issue_type_from_prefix(issue_prefix: str) -> str:
         return chore_type
 
 
-def get_issue_comments(issue: Issue) -> Optional[List[str]]:
+class CommentStore:
+    """
+    Comments of an issue by id. After the first full fetch, refreshes only
+    request comments created or edited since the newest one seen.
+
+    Comments deleted outside this process aren't noticed by a refresh.
+    """
+
+    def __init__(self, issue: "Issue"):
+        self.issue = issue
+        self.comments: Dict[int, "IssueComment"] = {}
+        self.synced = False
+
+    def refresh(self) -> int:
+        """Fetches new and edited comments and returns how many there were"""
+        if self.synced and self.comments:
+            since = max(
+                comment.updated_at for comment in self.comments.values()
+            )
+            page = self.issue.get_comments(since=since)
+        else:
+            page = self.issue.get_comments()
+        count = 0
+        for comment in page:
+            self.comments[comment.id] = comment
+            count += 1
+        self.synced = True
+        return count
+
+    def ordered(self) -> List["IssueComment"]:
+        # Comment ids increase in the order comments are created
+        return [self.comments[key] for key in sorted(self.comments)]
+
+    def bodies(self) -> List[str]:
+        return [comment.body for comment in self.ordered()]
+
+    def add(self, comment: "IssueComment") -> None:
+        self.comments[comment.id] = comment
+
+    def remove(self, comment_id: int) -> None:
+        self.comments.pop(comment_id, None)
+
+    def last(self) -> Optional["IssueComment"]:
+        """
+        Returns the most recent comment, from the store once it's synced,
+        otherwise from the last page of comments without paging through the
+        rest
+        """
+        if self.synced:
+            self.refresh()
+            comments = self.ordered()
+            return comments[-1] if comments else None
+        for comment in self.issue.get_comments().reversed:
+            return comment
+        return None
+
+
+def get_comment_store(issue: "Issue") -> CommentStore:
+    """Returns the comment store for an issue, kept between calls"""
+    store = comment_stores.get(issue.url)
+    if store is None:
+        store = CommentStore(issue)
+        comment_stores[issue.url] = store
+    return store
+
+
+def get_issue_comments(issue: IssueLike) -> Optional[List[str]]:
     """Returns a list of comments for an issue"""
     if not issue:
         return None
-    comments = [comment.body for comment in issue.get_comments()]
-    return comments
+    if isinstance(issue, IssueSnapshot):
+        return list(issue.comments)
+    store = get_comment_store(issue)
+    store.refresh()
+    return store.bodies()
 
 
-def write_issue_comment(issue: Issue, comment: str) -> Optional[IssueComment]:
+def write_issue_comment(
+    issue: "Issue", comment: str
+) -> Optional["IssueComment"]:
     """Writes a comment to an issue"""
     if not issue:
         return None
-    return issue.create_comment(comment)
+    issue_comment = issue.create_comment(comment)
+    store = get_comment_store(issue)
+    if store.synced:
+        store.add(issue_comment)
+    return issue_comment
 
 
-def delete_last_issue_comment(issue: Issue) -> Optional[IssueComment]:
+def delete_last_issue_comment(issue: "Issue") -> Optional["IssueComment"]:
     """Deletes the last comment on an issue"""
     if not issue:
         return None
-    comments = issue.get_comments()
-    if not comments:
+    store = get_comment_store(issue)
+    last_comment = store.last()
+    if last_comment is None:
         return None
-    num_comments = comments.totalCount
-    last_comment = comments[num_comments - 1]
     last_comment.delete()
+    store.remove(last_comment.id)
     return last_comment
@@ -0,0 +1,86 @@
+"""Micro-benchmark for token counting on a large diff.
+
+Compares counting each diff part the way summarize used to (building a
+message list and looking up the tokenizer on every call) with the cached
+llm.count_tokens and the incremental llm.TokenCounter.
+
+Run with: python tests/benchmarks/bench_tokens.py [size in MB]
+"""
+
+import sys
+import time
+
+import tiktoken
+
+from pycodegen import llm
+
+DEFAULT_SIZE_MB = 5
+
+
+def make_diff(size_bytes: int) -> str:
+    """Builds a synthetic diff of about size_bytes"""
+    parts = []
+    size = 0
+    file_num = 0
+    while size < size_bytes:
+        lines = [
+            f"diff --git a/src/module_{file_num}.py "
+            f"b/src/module_{file_num}.py\n",
+            f"--- a/src/module_{file_num}.py\n",
+            f"+++ b/src/module_{file_num}.py\n",
+            "@@ -1,40 +1,40 @@\n",
+        ]
+        for line_num in range(40):
+            lines.append(
+                f"+    value_{line_num} = compute(item, index={line_num})\n"
+            )
+        part = "".join(lines)
+        parts.append(part)
+        size += len(part)
+        file_num += 1
+    return "".join(parts)
+
+
+def legacy_count(lines):
+    """Token counting as done before the encoding cache"""
+    total = 0
+    for line in lines:
+        encoding = tiktoken.encoding_for_model(llm.CHAT_MODEL)
+        messages = llm.prompt_to_messages(line)
+        for message in messages:
+            total += 4
+            for value in message.values():
+                total += len(encoding.encode(value, disallowed_special=()))
+        total += 2
+    return total
+
+
+def cached_count(lines):
+    return sum(llm.count_tokens(line) for line in lines)
+
+
+def incremental_count(lines):
+    counter = llm.TokenCounter()
+    for line in lines:
+        counter.add(line)
+    return counter.total
+
+
+def main(size_mb: float = DEFAULT_SIZE_MB) -> None:
+    diff = make_diff(int(size_mb * 1024 * 1024))
+    lines = diff.splitlines(keepends=True)
+    llm.get_encoding()  # Load the tokenizer outside of the timings
+    print(f"Diff: {len(diff) / 1024 / 1024:.1f} MB, {len(lines)} lines")
+    for name, count in (
+        ("legacy", legacy_count),
+        ("count_tokens", cached_count),
+        ("TokenCounter", incremental_count),
+    ):
+        start = time.perf_counter()
+        tokens = count(lines)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>14}: {elapsed:7.3f}s ({tokens} tokens)")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB)
@@ -1,7 +1,7 @@
 import os
 from pathlib import Path
 
-from pycodegen import sc, tester, todo
+from pycodegen import sc, todo
 from pycodegen.coder import Coder
 
 work_dir = Path("C:\\Users\\myron\\PycharmProjects")
@@ -69,21 +69,6 @@ def test_code_stop() -> None:
     assert not coder.repo.is_dirty(untracked_files=True)
 
 
-def test_fix_step_def_functions() -> None:
-    """
-    Test fixing step def functions
-    """
-    test_path = (
-        work_dir.joinpath(test_repo)
-        .joinpath("tests")
-        .joinpath("functional")
-        .joinpath("test_Test_an_issue.py")
-    )
-    tester.fix_step_def_functions(test_path)
-    with open(test_path) as tp:
-        assert tp.read().find("_():") == -1
-
-
 def test_open_issue() -> None:
     """
     Test opening an issue
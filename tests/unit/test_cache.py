@@ -0,0 +1,36 @@
+import os
+
+from pycodegen import cache
+
+
+def test_hash_key_stable():
+    assert cache.hash_key("m", [{"a": 1, "b": 2}]) == cache.hash_key(
+        "m", [{"b": 2, "a": 1}]
+    )
+    assert cache.hash_key("m", "x") != cache.hash_key("m", "y")
+
+
+def test_get_set(tmp_path):
+    disk_cache = cache.DiskCache("test", root=tmp_path)
+    assert disk_cache.get("abc") is None
+    disk_cache.set("abc", {"value": [1, 2]})
+    assert disk_cache.get("abc") == {"value": [1, 2]}
+
+
+def test_expired_entry(tmp_path):
+    disk_cache = cache.DiskCache("test", ttl=-1, root=tmp_path)
+    disk_cache.set("abc", "value")
+    assert disk_cache.get("abc") is None
+    assert not disk_cache.path_for("abc").exists()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    disk_cache = cache.DiskCache("test", root=tmp_path)
+    disk_cache.set("aaa", "x" * 100)
+    disk_cache.set("bbb", "x" * 100)
+    os.utime(disk_cache.path_for("aaa"), (1, 1))
+    entry_size = disk_cache.path_for("bbb").stat().st_size
+    disk_cache.max_bytes = entry_size
+    disk_cache.evict()
+    assert disk_cache.get("aaa") is None
+    assert disk_cache.get("bbb") == "x" * 100
@@ -0,0 +1,198 @@
+import json
+
+import pytest
+
+from pycodegen import chains, llm, todo
+
+
+@pytest.fixture(autouse=True)
+def auto_mode(monkeypatch):
+    monkeypatch.delenv(chains.CHAIN_MODE_ENV, raising=False)
+    chains.set_chain_mode(None)
+    yield
+    chains.set_chain_mode(None)
+
+
+def test_parse_compact_response_reads_json_in_text():
+    response = 'Sure:\n{"plan": ["a"], "critique": "", "code": "x = 1"}\n'
+    result = chains.parse_compact_response(response)
+    assert result["code"] == "x = 1"
+    assert result["plan"] == ["a"]
+
+
+@pytest.mark.parametrize(
+    "response", ["no json here", "{not json}", '{"plan": []}', "[1, 2]"]
+)
+def test_parse_compact_response_rejects_invalid(response):
+    assert chains.parse_compact_response(response) is None
+
+
+@pytest.mark.parametrize("issue_type", [None, todo.chore_type, todo.docs_type])
+def test_choose_chain_mode_compact_for_small_issue_types(issue_type):
+    assert chains.choose_chain_mode(issue_type, "") == chains.CHAIN_COMPACT
+
+
+def test_choose_chain_mode_by_context_tokens(monkeypatch):
+    tokens = {"short": 10, "long": chains.FULL_CHAIN_TOKEN_BUDGET}
+    monkeypatch.setattr(llm, "count_tokens", lambda text: tokens[text])
+    assert chains.choose_chain_mode(todo.feature_type, "short") == (
+        chains.CHAIN_FULL
+    )
+    assert chains.choose_chain_mode(todo.feature_type, "long") == (
+        chains.CHAIN_COMPACT
+    )
+
+
+def test_choose_chain_mode_override(monkeypatch):
+    monkeypatch.setenv(chains.CHAIN_MODE_ENV, chains.CHAIN_FULL)
+    assert chains.choose_chain_mode(None, "") == chains.CHAIN_FULL
+    chains.set_chain_mode(chains.CHAIN_COMPACT)
+    assert chains.choose_chain_mode(todo.feature_type, "") == (
+        chains.CHAIN_COMPACT
+    )
+    with pytest.raises(ValueError):
+        chains.set_chain_mode("fast")
+
+
+def test_run_compact_chain_makes_one_request(monkeypatch):
+    prompts = []
+    response = {
+        "plan": ["a", "b"],
+        "critique": "b is redundant",
+        "revised_plan": ["a"],
+        "code": "def a():\n    pass\n",
+    }
+
+    def complete_prompt(prompt):
+        prompts.append(prompt)
+        return f"```json\n{json.dumps(response)}\n```"
+
+    monkeypatch.setattr(llm, "complete_prompt", complete_prompt)
+    result = chains.run_compact_chain("role", "code", "issue", "steps")
+    assert result == response
+    assert len(prompts) == 1
+    assert "issue" in prompts[0]
+
+
+def test_run_compact_chain_falls_back_to_response(monkeypatch):
+    monkeypatch.setattr(llm, "complete_prompt", lambda prompt: "x = 1")
+    result = chains.run_compact_chain("role", "code", "issue", "steps")
+    assert result["code"] == "x = 1"
+
+
+def test_run_conversation_sends_context_once(monkeypatch):
+    requests = []
+    usages = []
+
+    def respond(messages, stop_when=None):
+        requests.append(messages)
+        return f"reply {len(requests)}"
+
+    monkeypatch.setattr(llm, "respond", respond)
+    monkeypatch.setattr(llm, "count_tokens", lambda text: len(text.split()))
+    chains.add_usage_hook(usages.append)
+    try:
+        result = chains.run_conversation(
+            "test",
+            "role",
+            "long issue context",
+            [
+                chains.Turn("plan", "Plan the {issue_type}."),
+                chains.Turn("code", "Write code using {libs}."),
+            ],
+            {"issue_type": "feature", "libs": "click"},
+        )
+    finally:
+        chains.remove_usage_hook(usages.append)
+    assert result["plan"] == "reply 1"
+    assert result["code"] == "reply 2"
+    # Each request extends the previous one
+    assert requests[1][: len(requests[0])] == requests[0]
+    assert requests[1][-1]["content"] == "Write code using click."
+    contents = [message["content"] for message in requests[1]]
+    assert contents.count("long issue context") == 1
+    (usage,) = usages
+    assert usage.requests == 2
+    assert usage.context_tokens == 3 + chains.MESSAGE_OVERHEAD_TOKENS
+    # Separate requests: role, context and prompt each time
+    role_tokens = 1 + chains.MESSAGE_OVERHEAD_TOKENS
+    assert usage.separate_tokens == 2 * (
+        role_tokens + usage.context_tokens
+    ) + (3 + 4 + 2 * chains.MESSAGE_OVERHEAD_TOKENS)
+    assert usage.saved_tokens == usage.separate_tokens - usage.prompt_tokens
+    assert usage.prefix_tokens > usage.context_tokens
+
+
+def test_run_conversation_drops_old_turns_over_budget(monkeypatch):
+    requests = []
+
+    def respond(messages, stop_when=None):
+        requests.append(messages)
+        return "long " * 40
+
+    monkeypatch.setattr(llm, "respond", respond)
+    monkeypatch.setattr(llm, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(chains, "CONVERSATION_TOKEN_BUDGET", 100)
+    chains.run_conversation(
+        "test",
+        "role",
+        "context",
+        [
+            chains.Turn("steps", "Steps."),
+            chains.Turn("critique", "Critique."),
+            chains.Turn("code", "Code."),
+        ],
+        {},
+    )
+    contents = [[m["content"] for m in request] for request in requests]
+    assert contents[1] == [
+        "role",
+        "context",
+        "Steps.",
+        "long " * 40,
+        "Critique.",
+    ]
+    # The steps turn no longer fits, the critique turn is kept
+    assert contents[2] == [
+        "role",
+        "context",
+        "Critique.",
+        "long " * 40,
+        "Code.",
+    ]
+
+
+def test_conversation_usage_compares_with_separate_templates(monkeypatch):
+    replies = iter(["reply one", "reply two"])
+    usages = []
+    monkeypatch.setattr(
+        llm, "respond", lambda messages, stop_when=None: next(replies)
+    )
+    monkeypatch.setattr(llm, "count_tokens", lambda text: len(text.split()))
+    chains.add_usage_hook(usages.append)
+    try:
+        chains.run_conversation(
+            "test",
+            "role",
+            "issue " * 20,
+            [
+                chains.Turn(
+                    "plan", "Plan.", separate_prompt="{role} Plan.\n{context}"
+                ),
+                chains.Turn(
+                    "code",
+                    "Code.",
+                    separate_prompt="{role} Code:\n{plan}\n{context}",
+                ),
+            ],
+            {},
+        )
+    finally:
+        chains.remove_usage_hook(usages.append)
+    (usage,) = usages
+    # Messages: role 1, context 20, prompts 1, replies 2 (+4 overhead each)
+    assert usage.prompt_tokens == (5 + 24 + 5) + (5 + 24 + 5 + 6 + 5)
+    # Old templates: role, prompt and context, then also the plan reply
+    assert usage.separate_tokens == (22 + 4) + (24 + 4)
+    # Resending the plan and the extra messages costs more than it saves
+    assert usage.saved_tokens == -25
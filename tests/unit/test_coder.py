@@ -1,4 +1,4 @@
-from pycodegen import coder
+from pycodegen import coder, todo
 
 
 def test_just_the_code_non_code_response():
@@ -172,3 +172,64 @@ def test_logging_already_added():
     )
     mod_content = coder.add_logging(script_content)
     assert mod_content == script_content
+
+
+def test_comments_status():
+    assert coder.comments_status([]) is None
+    assert coder.comments_status(["Please add X"]) is None
+    assert coder.comments_status(["AI: Which X?"]) == coder.ISSUE_WAITING
+    assert coder.comments_status(["AI: Which X?", "Y"]) == coder.ISSUE_READY
+    assert coder.comments_status(["AI: No questions."]) == coder.ISSUE_READY
+
+
+def snapshot(number, comments):
+    return todo.IssueSnapshot(
+        number=number,
+        title=f"Issue {number}",
+        body="",
+        state="open",
+        labels=(),
+        comments=tuple(comments),
+        comment_ids=tuple(range(len(comments))),
+    )
+
+
+def test_triage_repos(monkeypatch):
+    repo_issues = {
+        "owner/one": [snapshot(1, ["AI: Why?"]), snapshot(2, [])],
+        "owner/two": [snapshot(3, ["AI: Why?", "Because"])],
+    }
+    monkeypatch.setattr(
+        coder, "candidate_issues", lambda name, per_repo: repo_issues[name]
+    )
+    monkeypatch.setattr(
+        coder.llm, "gather_prompts", lambda prompts: ["What is X?"]
+    )
+    monkeypatch.setattr(coder.todo, "get_repo", lambda owner, name: None)
+    monkeypatch.setattr(coder.todo, "get_issue", lambda repo, num: object())
+    monkeypatch.setattr(
+        coder.todo, "write_issue_comment", lambda issue, comment: comment
+    )
+    results = coder.triage_repos(["owner/one", "owner/two"])
+    assert [(r.repo, r.number, r.status) for r in results] == [
+        ("owner/one", 1, coder.ISSUE_WAITING),
+        ("owner/one", 2, coder.ISSUE_WAITING),
+        ("owner/two", 3, coder.ISSUE_READY),
+    ]
+    table = coder.format_triage_table(results).splitlines()
+    assert table[0].split() == ["REPO", "ISSUE", "STATUS", "TITLE"]
+    assert table[3].split() == ["owner/two", "#3", "ready", "Issue", "3"]
+
+
+def test_add_logging_after_multiline_import():
+    script_content = "from os import (\n    path,\n)\nprint('Hello, world!')"
+    mod_content = coder.add_logging(script_content)
+    assert mod_content.startswith(
+        "from os import (\n    path,\n)" + coder.LOGGER_CODE
+    )
+    assert coder.add_logging(mod_content) == mod_content
+
+
+def test_format_table_aligns_all_but_last_column():
+    table = coder.format_table(("A", "BB", "C"), [("aaa", "b", "c c")])
+    assert table.splitlines() == ["A    BB  C", "aaa  b   c c"]
@@ -0,0 +1,105 @@
+from pycodegen import cache, envs
+
+PYPROJECT = '[project]\nname = "proj"\nrequires-python = ">=3.9"\n'
+
+
+def make_repo(path, lock="lock v1"):
+    path.mkdir()
+    path.joinpath("pyproject.toml").write_text(PYPROJECT)
+    path.joinpath("pdm.lock").write_text(lock)
+    return path
+
+
+def fake_steps(builds, succeed=True):
+    def run_steps(repo_path, python_version):
+        builds.append(repo_path)
+        venv_path = repo_path.joinpath(envs.VENV_DIR)
+        bin_path = venv_path.joinpath("bin")
+        bin_path.mkdir(parents=True)
+        bin_path.joinpath("tool").write_text(
+            f"#!{venv_path.joinpath('bin', 'python')}\n"
+        )
+        site_packages = venv_path.joinpath("lib", "python3.9", "site-packages")
+        site_packages.mkdir(parents=True)
+        site_packages.joinpath("proj.pth").write_text(
+            str(repo_path.joinpath("src"))
+        )
+        return succeed
+
+    return run_steps
+
+
+def test_venv_key_tracks_lock_and_python(tmp_path):
+    repo_path = make_repo(tmp_path.joinpath("repo"))
+    key = envs.venv_key(repo_path, "3.9")
+    assert key == envs.venv_key(repo_path, "3.9")
+    assert key != envs.venv_key(repo_path, "3.10")
+    repo_path.joinpath("pdm.lock").write_text("lock v2")
+    assert key != envs.venv_key(repo_path, "3.9")
+
+
+def test_venv_key_ignores_version_bump(tmp_path):
+    repo_path = make_repo(tmp_path.joinpath("repo"))
+    key = envs.venv_key(repo_path, "3.9")
+    pyproject = repo_path.joinpath("pyproject.toml")
+    pyproject.write_text(PYPROJECT + 'version = "0.2.0"\n')
+    assert key == envs.venv_key(repo_path, "3.9")
+    pyproject.write_text(PYPROJECT + 'dependencies = ["click"]\n')
+    assert key != envs.venv_key(repo_path, "3.9")
+
+
+def test_provision_venv_reuses_cached_venv(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path.joinpath("cache")))
+    builds = []
+    monkeypatch.setattr(envs, "run_steps", fake_steps(builds))
+    first = make_repo(tmp_path.joinpath("first"))
+    second = make_repo(tmp_path.joinpath("second"))
+
+    assert envs.provision_venv(first)
+    assert envs.provision_venv(first)
+    assert envs.provision_venv(second)
+    assert builds == [first]
+
+    venv_path = second.joinpath(envs.VENV_DIR)
+    tool = venv_path.joinpath("bin", "tool").read_text()
+    assert tool == f"#!{venv_path.joinpath('bin', 'python')}\n"
+    pth = venv_path.joinpath("lib", "python3.9", "site-packages", "proj.pth")
+    assert pth.read_text() == str(second.joinpath("src"))
+    # The first repo's venv is untouched by relocating the copy
+    first_tool = first.joinpath(envs.VENV_DIR, "bin", "tool").read_text()
+    assert str(first) in first_tool
+
+
+def test_provision_venv_failed_build_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path.joinpath("cache")))
+    builds = []
+    monkeypatch.setattr(envs, "run_steps", fake_steps(builds, False))
+    repo_path = make_repo(tmp_path.joinpath("repo"))
+    assert not envs.provision_venv(repo_path)
+    assert not repo_path.joinpath(envs.VENV_DIR).exists()
+    monkeypatch.setattr(envs, "run_steps", fake_steps(builds))
+    assert envs.provision_venv(repo_path)
+    assert len(builds) == 2
+
+
+def test_provision_venv_keeps_existing_venv(tmp_path, monkeypatch):
+    monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path.joinpath("cache")))
+    builds = []
+    syncs = []
+    monkeypatch.setattr(envs, "run_steps", fake_steps(builds))
+
+    def sync_venv(repo_path):
+        syncs.append(repo_path)
+        return True
+
+    monkeypatch.setattr(envs, "sync_venv", sync_venv)
+    repo_path = make_repo(tmp_path.joinpath("repo"))
+    user_file = repo_path.joinpath(envs.VENV_DIR, "bin", "python")
+    user_file.parent.mkdir(parents=True)
+    user_file.write_text("python")
+
+    assert envs.provision_venv(repo_path)
+    assert envs.provision_venv(repo_path)
+    assert user_file.read_text() == "python"
+    assert syncs == [repo_path]
+    assert builds == []
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+# Dependencies that take most of the startup time and are only needed once
+# a command talks to GitHub, git or an LLM
+HEAVY_MODULES = (
+    "aiohttp",
+    "git",
+    "github",
+    "openai",
+    "requests",
+    "tiktoken",
+)
+
+
+def imported_modules(module: str) -> set:
+    """Returns the modules loaded by importing module in a new interpreter"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {
+        line.rsplit("|", 1)[1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "|" in line
+    }
+
+
+def test_coder_import_defers_heavy_modules():
+    modules = imported_modules("pycodegen.coder")
+    assert "pycodegen.coder" in modules
+    loaded = sorted(
+        name for name in modules if name.split(".")[0] in HEAVY_MODULES
+    )
+    assert loaded == []
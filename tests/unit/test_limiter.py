@@ -0,0 +1,41 @@
+from pycodegen import limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_limiter(tmp_path, clock, requests=2, tokens=100):
+    return limiter.TokenBucketLimiter(
+        "test",
+        requests,
+        tokens,
+        db_path=tmp_path.joinpath("limits.sqlite3"),
+        clock=clock,
+    )
+
+
+def test_request_budget_shared_between_limiters(tmp_path):
+    clock = FakeClock()
+    first = make_limiter(tmp_path, clock)
+    second = make_limiter(tmp_path, clock)
+    assert first.try_acquire(10) == 0
+    assert second.try_acquire(10) == 0
+    # Both requests are used up, so wait for one to refill (30s at 2/min)
+    assert first.try_acquire(10) == 30
+    clock.now += 30
+    assert second.try_acquire(10) == 0
+
+
+def test_token_budget(tmp_path):
+    clock = FakeClock()
+    tokens_limiter = make_limiter(tmp_path, clock, requests=100)
+    assert tokens_limiter.try_acquire(80) == 0
+    # 40 more tokens are needed, which refill in 24s at 100/min
+    assert tokens_limiter.try_acquire(60) == 24
+    tokens_limiter.record_usage(80, 20)
+    assert tokens_limiter.try_acquire(60) == 0
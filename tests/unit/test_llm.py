@@ -0,0 +1,122 @@
+import asyncio
+
+import openai
+
+from pycodegen import cache, limiter, llm
+
+
+def test_respond_uses_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        llm, "response_cache", cache.DiskCache("llm", root=tmp_path)
+    )
+    calls = []
+
+    def fake_request(messages, **params):
+        calls.append(messages)
+        return f"response {len(calls)}"
+
+    monkeypatch.setattr(llm, "request_response", fake_request)
+    messages = llm.prompt_to_messages("Hello")
+    assert llm.respond(messages) == "response 1"
+    assert llm.respond(messages) == "response 1"
+    assert len(calls) == 1
+    assert llm.respond(messages, refresh=True) == "response 2"
+    assert llm.respond(messages) == "response 2"
+    assert llm.respond(messages, use_cache=False) == "response 3"
+    assert len(calls) == 3
+
+
+def test_gather_prompts_keeps_order_and_bounds_concurrency(monkeypatch):
+    in_flight = []
+    max_in_flight = []
+
+    async def fake_request(messages, **params):
+        in_flight.append(1)
+        max_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return messages[-1]["content"].upper()
+
+    monkeypatch.setattr(llm, "arequest_response", fake_request)
+    prompts = [f"prompt {i}" for i in range(6)]
+    responses = llm.gather_prompts(prompts, max_concurrency=2, use_cache=False)
+    assert responses == [p.upper() for p in prompts]
+    assert max(max_in_flight) == 2
+
+
+class FakeEncoding:
+    def encode(self, text, disallowed_special=()):
+        return text.split()
+
+
+def test_token_counter_adds_parts(monkeypatch):
+    monkeypatch.setitem(llm.encodings, "fake-model", FakeEncoding())
+    counter = llm.TokenCounter("fake-model")
+    assert counter.add("one two") == 2
+    assert counter.add("three") == 1
+    # Known counts aren't counted again
+    assert counter.add("four five", 7) == 7
+    assert counter.total == 10
+    counter.reset()
+    assert counter.total == 0
+    assert llm.count_tokens("one two three four", "fake-model") == 4
+
+
+def test_closing_code_fence():
+    assert not llm.closing_code_fence("Here is the code:\n```python\nx = 1\n")
+    assert llm.closing_code_fence("```python\nx = 1\n```")
+
+
+def test_stream_respond_stops_early(tmp_path, monkeypatch):
+    monkeypatch.setitem(llm.encodings, llm.CHAT_MODEL, FakeEncoding())
+    monkeypatch.setattr(
+        llm,
+        "rate_limiter",
+        limiter.TokenBucketLimiter(
+            "test", 10, 10_000, db_path=tmp_path.joinpath("limits.sqlite3")
+        ),
+    )
+    pieces = ["Sure:\n```python\n", "x = 1\n", "```", "\nHope this helps"]
+
+    def fake_create(**kwargs):
+        assert kwargs["stream"]
+        for piece in pieces:
+            yield {"choices": [{"delta": {"content": piece}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", fake_create)
+    messages = llm.prompt_to_messages("Write code")
+    streamed = list(llm.stream_respond(messages, llm.closing_code_fence))
+    assert streamed == pieces[:3]
+
+
+def test_respond_retries_streamed_requests(tmp_path, monkeypatch):
+    monkeypatch.setitem(llm.encodings, llm.CHAT_MODEL, FakeEncoding())
+    monkeypatch.setattr(
+        llm,
+        "rate_limiter",
+        limiter.TokenBucketLimiter(
+            "test", 10, 10_000, db_path=tmp_path.joinpath("limits.sqlite3")
+        ),
+    )
+    monkeypatch.setattr(
+        llm, "response_cache", cache.DiskCache("llm", root=tmp_path)
+    )
+    monkeypatch.setattr("reretry.api.time.sleep", lambda seconds: None)
+    calls = []
+
+    def fake_create(**kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise openai.APIError("Server error")
+        yield {"choices": [{"delta": {"content": "```\nx = 1\n```"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", fake_create)
+    messages = llm.prompt_to_messages("Write code")
+    response = llm.respond(messages, stop_when=llm.closing_code_fence)
+    assert response == "```\nx = 1\n```"
+    assert len(calls) == 2
+    # Predicates with the same name don't share cached responses
+    first = lambda text: True  # noqa: E731
+    second = lambda text: False  # noqa: E731
+    assert llm.stop_key(first) != llm.stop_key(llm.closing_code_fence)
+    assert llm.stop_key(first) != llm.stop_key(second)
@@ -0,0 +1,148 @@
+import ast
+
+from pycodegen import merge
+
+module_text = '''"""Module docstring."""
+import os
+from typing import List
+
+
+class Calculator:
+    # Adds numbers
+    def add(self, a, b):
+        return a + b
+
+
+def helper():
+    return 1
+
+
+if __name__ == "__main__":
+    helper()
+'''
+
+
+def test_merge_snippets_hoists_and_dedupes_imports():
+    merged = merge.merge_snippets(
+        module_text,
+        ["import os\nfrom typing import Dict, List\nimport re\n\nx = 1\n"],
+    )
+    assert merged.count("import os") == 1
+    assert "from typing import Dict\nimport re\n\n\nclass" in merged
+    assert merged.index("x = 1") < merged.index(merge.MAIN_GUARD)
+    ast.parse(merged)
+
+
+def test_merge_snippets_replaces_existing_function():
+    merged = merge.merge_snippets(
+        module_text, ["def helper():\n    return 2\n"]
+    )
+    assert merged.count("def helper") == 1
+    assert "return 2" in merged
+    assert "return 1" not in merged
+    assert merged.endswith('if __name__ == "__main__":\n    helper()\n')
+
+
+def test_merge_snippets_merges_class_methods():
+    merged = merge.merge_snippets(
+        module_text,
+        [
+            "class Calculator:\n"
+            "  def add(self, a, b):\n"
+            "    return b + a\n"
+            "  def sub(self, a, b):\n"
+            "    return a - b\n"
+        ],
+    )
+    assert merged.count("class Calculator") == 1
+    assert "    def add(self, a, b):\n" in merged
+    assert "return a + b" not in merged
+    assert "\n    def sub(self, a, b):\n" in merged
+    # Comments outside replaced code are kept
+    assert "# Adds numbers" in merged
+    tree = ast.parse(merged)
+    calculator = next(
+        node for node in tree.body if isinstance(node, ast.ClassDef)
+    )
+    assert [method.name for method in calculator.body] == ["add", "sub"]
+
+
+def test_merge_snippets_applies_several_snippets():
+    merged = merge.merge_snippets(
+        module_text,
+        [
+            "import json\n\ndef first():\n    pass\n",
+            "import json\n\ndef second():\n    pass\n",
+            "def first():\n    return 'again'\n",
+        ],
+    )
+    assert merged.count("import json") == 1
+    assert merged.count("def first") == 1
+    assert "return 'again'" in merged
+    assert merged.index("def first") < merged.index("def second")
+    ast.parse(merged)
+
+
+def test_merge_snippets_falls_back_for_invalid_module():
+    merged = merge.merge_snippets(
+        "def broken(:\n", ["def helper():\n    pass"]
+    )
+    assert merged == "def broken(:\n\n\ndef helper():\n    pass\n"
+
+
+def test_analyze_imports():
+    text = (
+        '"""Doc"""\n'
+        "import os\n"
+        "from typing import (\n"
+        "    List,\n"
+        ")  # names\n"
+        "\n"
+        "def f():\n"
+        "    import logging\n"
+    )
+    info = merge.analyze_imports(text)
+    assert info.statements == (
+        "import os",
+        "from typing import (\n    List,\n)  # names",
+    )
+    assert (None, 0, "os", None) in info.keys
+    assert info.last_line == 5
+    assert text[: info.end].endswith(")  # names")
+    assert not info.has_logging
+    assert merge.analyze_imports(text) is info
+
+
+def test_analyze_imports_invalid_module():
+    info = merge.analyze_imports("import logging\nimport os\ndef f(:\n")
+    assert info.statements == ("import logging", "import os")
+    assert info.last_line == 2
+    assert info.end == len("import logging\nimport os")
+    assert info.has_logging
+
+
+def test_merge_snippets_adds_indented_code_to_only_class():
+    merged = merge.merge_snippets(
+        module_text,
+        ["    import math\n\n    def root(self, a):\n        return a**0.5\n"],
+    )
+    tree = ast.parse(merged)
+    calculator = next(
+        node for node in tree.body if isinstance(node, ast.ClassDef)
+    )
+    assert [method.name for method in calculator.body] == ["add", "root"]
+    assert "\nimport math\n" in merged
+
+
+def test_merge_snippets_keeps_class_attributes():
+    merged = merge.merge_snippets(
+        module_text,
+        ['class Calculator:\n    """New doc"""\n    precision = 2\n'],
+    )
+    tree = ast.parse(merged)
+    calculator = next(
+        node for node in tree.body if isinstance(node, ast.ClassDef)
+    )
+    assert isinstance(calculator.body[-1], ast.Assign)
+    assert "New doc" not in merged
+    assert merge.merge_snippets(merged, ["    precision = 2\n"]) == merged
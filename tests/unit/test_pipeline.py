@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from pycodegen import pipeline
+
+
+def test_run_pipeline_passes_results():
+    results = pipeline.run_pipeline(
+        [
+            pipeline.Stage("total", lambda a, b: a + b, ("a", "b")),
+            pipeline.Stage("a", lambda: 1),
+            pipeline.Stage("b", lambda a: a + 1, ("a",)),
+        ]
+    )
+    assert results == {"a": 1, "b": 2, "total": 3}
+
+
+def test_run_pipeline_runs_independent_stages_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    start = time.perf_counter()
+    # Each stage waits for the other, so they only finish if run together
+    results = pipeline.run_pipeline(
+        [
+            pipeline.Stage("one", barrier.wait),
+            pipeline.Stage("two", barrier.wait),
+        ]
+    )
+    assert set(results) == {"one", "two"}
+    assert time.perf_counter() - start < 5
+
+
+def test_run_pipeline_rejects_cycles():
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline(
+            [
+                pipeline.Stage("a", lambda b: b, ("b",)),
+                pipeline.Stage("b", lambda a: a, ("a",)),
+            ]
+        )
+
+
+def test_run_pipeline_stops_after_failure():
+    ran = []
+
+    def fail():
+        raise RuntimeError("failed")
+
+    with pytest.raises(RuntimeError):
+        pipeline.run_pipeline(
+            [
+                pipeline.Stage("fail", fail),
+                pipeline.Stage("after", lambda fail: ran.append(1), ("fail",)),
+            ]
+        )
+    assert ran == []
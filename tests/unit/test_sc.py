@@ -0,0 +1,120 @@
+from pycodegen import llm, sc
+
+test_diff = (
+    "diff --git a/one.py b/one.py\n"
+    "+one two\n"
+    "+three four\n"
+    "diff --git a/two.py b/two.py\n"
+    "+five six seven\n"
+)
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def test_chunk_text_keeps_file_diffs_together():
+    chunks = sc.chunk_text(test_diff, 8, count_words)
+    assert [text for text, _ in chunks] == [
+        "diff --git a/one.py b/one.py\n+one two\n+three four\n",
+        "diff --git a/two.py b/two.py\n+five six seven\n",
+    ]
+    assert [tokens for _, tokens in chunks] == [8, 7]
+
+
+def test_chunk_text_splits_large_file_diff_by_line():
+    chunks = sc.chunk_text(test_diff, 5, count_words)
+    assert "".join(text for text, _ in chunks) == test_diff
+    assert all(tokens <= 5 for _, tokens in chunks)
+    assert len(chunks) == 4
+
+
+def test_summarize_diff_reduces_until_it_fits(monkeypatch):
+    prompts_per_stage = []
+
+    def fake_gather(prompts, max_concurrency=llm.MAX_CONCURRENCY, **kwargs):
+        prompts_per_stage.append(prompts)
+        return ["short summary"] * len(prompts)
+
+    monkeypatch.setattr(llm, "gather_prompts", fake_gather)
+    monkeypatch.setattr(llm, "CH_MAX_TOKENS", sc.SUMMARY_RESPONSE_TOKENS + 30)
+    big_diff = test_diff * 20
+    result = sc.summarize_diff(
+        big_diff, target_tokens=3, count_tokens=count_words
+    )
+    assert result.summaries == ["short summary"]
+    assert len(result.stages) > 1
+    assert result.stages[0].name == "map"
+    assert result.stages[-1].name == "reduce"
+    assert result.calls == sum(len(p) for p in prompts_per_stage)
+
+
+def test_summarize_diff_truncates_summaries_that_dont_shrink(monkeypatch):
+    def fake_gather(prompts, max_concurrency=llm.MAX_CONCURRENCY, **kwargs):
+        return ["a summary as long as the chunk it summarizes"] * len(prompts)
+
+    monkeypatch.setattr(llm, "gather_prompts", fake_gather)
+    monkeypatch.setattr(llm, "CH_MAX_TOKENS", sc.SUMMARY_RESPONSE_TOKENS + 30)
+    result = sc.summarize_diff(
+        test_diff * 20, target_tokens=20, count_tokens=count_words
+    )
+    joined = "\n".join(result.summaries)
+    assert count_words(joined) + len(result.summaries) <= 20
+    assert (
+        result.summaries[0] == "a summary as long as the chunk it summarizes"
+    )
+
+
+hunk_diff = (
+    "diff --git a/one.py b/one.py\n"
+    "@@ -1 +1 @@\n"
+    "+one two\n"
+    "@@ -5 +5 @@\n"
+    "+three four five\n"
+)
+
+
+def test_iter_diff_units_uses_largest_unit_that_fits():
+    units = list(
+        sc.iter_diff_units(hunk_diff.splitlines(True), 20, count_words)
+    )
+    assert [unit.kind for unit in units] == ["file"]
+    units = list(
+        sc.iter_diff_units(hunk_diff.splitlines(True), 8, count_words)
+    )
+    assert [(unit.kind, unit.tokens) for unit in units] == [
+        ("header", 4),
+        ("hunk", 6),
+        ("hunk", 7),
+    ]
+    assert all(unit.path == "one.py" for unit in units)
+    units = list(
+        sc.iter_diff_units(hunk_diff.splitlines(True), 6, count_words)
+    )
+    assert [unit.kind for unit in units][-3:] == ["hunk", "line", "line"]
+    assert "".join(unit.text for unit in units) == hunk_diff
+
+
+def test_pack_diff_chunks_repeats_file_header():
+    units = sc.iter_diff_units(hunk_diff.splitlines(True), 12, count_words)
+    chunks = list(sc.pack_diff_chunks(units, 12))
+    assert chunks == [
+        ("diff --git a/one.py b/one.py\n@@ -1 +1 @@\n+one two\n", 10),
+        ("diff --git a/one.py b/one.py\n@@ -5 +5 @@\n+three four five\n", 11),
+    ]
+
+
+def test_parse_numstat():
+    stats = sc.parse_numstat("1\t2\t\0old.py\0new.py\0-\t-\timage.png\0")
+    assert stats == [
+        sc.FileStat("new.py", 1, 2),
+        sc.FileStat("image.png", None, None),
+    ]
+    assert stats[1].binary
+    assert sc.estimate_diff_tokens(stats) == 3 * sc.TOKENS_PER_DIFF_LINE
+
+
+def test_filter_diff_lines_skips_paths():
+    diff = test_diff + "diff --git a/image.png b/image.png\nBinary files\n"
+    lines = sc.filter_diff_lines(diff.splitlines(True), {"image.png"})
+    assert "".join(lines) == test_diff
@@ -0,0 +1,85 @@
+import socket
+import threading
+
+from pycodegen import coder, session
+
+
+def test_send_request_without_server(tmp_path):
+    assert session.send_request({}, tmp_path.joinpath("none.sock")) is None
+
+
+def test_session_server_round_trip(tmp_path):
+    socket_path = tmp_path.joinpath("coder.sock")
+    # Leftover socket file from a server that didn't shut down cleanly
+    socket_path.touch()
+    server = session.SessionServer(
+        lambda request: {"rc": 0, "output": request["command"]}, socket_path
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        response = session.send_request({"command": "code"}, socket_path)
+        assert response == {"rc": 0, "output": "code"}
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert not socket_path.exists()
+
+
+def test_handle_session_request_captures_output(monkeypatch):
+    def run_coder_command(command, repo_owner, repo_name, argument):
+        print(f"{command} {repo_owner}/{repo_name} {argument}")
+        return 0
+
+    monkeypatch.setattr(coder, "run_coder_command", run_coder_command)
+    response = coder.handle_session_request(
+        {
+            "command": "start",
+            "repo_owner": "owner",
+            "repo_name": "repo",
+            "argument": 3,
+            "llm_cache": "off",
+        }
+    )
+    assert response == {"rc": 0, "output": "start owner/repo 3\n"}
+    assert coder.llm.cache_mode is None
+
+
+def test_send_request_reports_dropped_connection(tmp_path):
+    socket_path = tmp_path.joinpath("coder.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(socket_path))
+    listener.listen(1)
+
+    def drop():
+        # Reads the request and closes without a reply, as if the server
+        # died mid-command
+        conn, _ = listener.accept()
+        with conn:
+            conn.makefile("rb").readline()
+
+    thread = threading.Thread(target=drop, daemon=True)
+    thread.start()
+    try:
+        response = session.send_request({"command": "finish"}, socket_path)
+    finally:
+        thread.join()
+        listener.close()
+    assert response["rc"] == 1
+    assert "closed the connection" in response["error"]
+
+
+def test_dispatch_runs_locally_only_without_server(monkeypatch):
+    local = []
+    monkeypatch.setattr(
+        coder,
+        "run_coder_command",
+        lambda *args: local.append(args) or 0,
+    )
+    monkeypatch.setattr(
+        session, "send_request", lambda request: session.lost_response("x")
+    )
+    assert coder.dispatch({}, "finish", "owner", "repo", "msg") == 1
+    monkeypatch.setattr(session, "send_request", lambda request: None)
+    assert coder.dispatch({}, "finish", "owner", "repo", "msg") == 0
+    assert local == [("finish", "owner", "repo", "msg")]
@@ -1,4 +1,6 @@
-from pycodegen import tester
+from types import SimpleNamespace
+
+from pycodegen import llm, tester
 
 test_issue_body = """As a development lead,
 I want a functional test created for each feature request,
@@ -32,3 +34,173 @@ def test_indent_sub_lines():
     Then a functional test is created to test the feature.
 """
     assert tester.indent_sub_lines(test_issue_body) == indented_body
+
+
+def fake_llm(monkeypatch, batch_response, step_response=""):
+    """Answers batched step naming prompts with batch_response and single
+    step prompts with step_response. Returns the batched prompts."""
+    batch_prompts = []
+
+    def gather_prompts(prompts):
+        responses = []
+        for prompt in prompts:
+            if "JSON object" in prompt:
+                batch_prompts.append(prompt)
+                responses.append(batch_response)
+            else:
+                responses.append(step_response)
+        return responses
+
+    monkeypatch.setattr(llm, "gather_prompts", gather_prompts)
+    return batch_prompts
+
+
+def test_name_steps_keeps_names_unique(monkeypatch):
+    fake_llm(monkeypatch, '{"Given a": "test_a", "Given b": "class"}', "step")
+    names = tester.name_steps(["Given a", "Given b"], {"test_a"}, {})
+    assert names == {"Given a": "step", "Given b": "step_2"}
+
+
+def test_parse_feature():
+    feature = tester.parse_feature(
+        "@tag\nFeature: Coding\n  Some description\n\n"
+        "  Background:\n    Given a repo\n\n"
+        "  Scenario: Start\n    Given an issue\n    And a label: bug\n"
+        '    When coding starts\n      """\n      Then ignored\n      """\n'
+        "    Then code exists\n    But no tests fail\n\n"
+        "  Scenario Outline: Many\n    Given <count> issues\n"
+        "    Examples:\n      | count |\n      | 2 |\n"
+    )
+    assert feature.name == "Coding"
+    assert feature.background == (tester.Step("given", "a repo"),)
+    assert [scenario.name for scenario in feature.scenarios] == [
+        "Start",
+        "Many",
+    ]
+    assert [step.name for step in feature.scenarios[0].steps] == [
+        "Given an issue",
+        "Given a label: bug",
+        "When coding starts",
+        "Then code exists",
+        "Then no tests fail",
+    ]
+    assert feature.scenarios[1].steps == (
+        tester.Step("given", "<count> issues"),
+    )
+
+
+def test_create_all_step_defs(tmp_path, monkeypatch):
+    features_path = tmp_path.joinpath("features")
+    features_path.mkdir()
+    features_path.joinpath("A.feature").write_text(
+        "Feature: A\n  Scenario: One\n    Given a repo\n    Then it's done\n"
+    )
+    features_path.joinpath("B.feature").write_text(
+        "Feature: B\n  Scenario: Two\n    Given a repo\n    When shared\n"
+    )
+    step_def_path = tmp_path.joinpath(tester.step_def_dir)
+    step_def_path.mkdir()
+    step_def_path.joinpath("conftest.py").write_text(
+        "@when('shared')\ndef shared():\n    pass\n"
+    )
+    prompts = fake_llm(
+        monkeypatch, '{"Given a repo": "get_repo", "Then it\'s done": "done"}'
+    )
+    test_paths = tester.create_all_step_defs(features_path)
+    assert [path.name for path in test_paths] == ["test_A.py", "test_B.py"]
+    a_steps = test_paths[0].read_text()
+    assert "@scenario('../features/A.feature', 'One')" in a_steps
+    assert "def test_one():" in a_steps
+    assert "def done():" in a_steps
+    b_steps = test_paths[1].read_text()
+    assert "def get_repo():" in b_steps
+    assert "@when" not in b_steps
+    # One request names the steps of every feature
+    assert len(prompts) == 1
+    compile(a_steps, "test_A.py", "exec")
+
+    # Only new scenarios and steps are added to existing modules
+    features_path.joinpath("A.feature").write_text(
+        "Feature: A\n  Scenario: One\n    Given a repo\n    Then it's done\n"
+        "  Scenario: Three\n    Given a repo\n    Then more\n"
+    )
+    fake_llm(monkeypatch, '{"Then more": "more"}')
+    tester.create_all_step_defs(features_path)
+    updated = test_paths[0].read_text()
+    assert updated.startswith(a_steps.rstrip("\n"))
+    assert updated.count("def get_repo():") == 1
+    assert "def test_three():" in updated
+    assert "def more():" in updated
+
+
+def test_tokenize_gherkin():
+    tokens = tester.tokenize_gherkin(
+        'Feature: F\n  @slow\n  Scenario Outline: S\n    Given a\n    """\n'
+        '    Scenario: not a header\n    """\n    | x |\n  # note\n'
+    )
+    assert [token.kind for token in tokens] == [
+        tester.FEATURE_TOKEN,
+        tester.TAG_TOKEN,
+        tester.SCENARIO_TOKEN,
+        tester.STEP_TOKEN,
+        tester.DOC_STRING_TOKEN,
+        tester.DOC_STRING_TOKEN,
+        tester.DOC_STRING_TOKEN,
+        tester.TABLE_ROW_TOKEN,
+        tester.COMMENT_TOKEN,
+    ]
+    assert tokens[2].keyword == "Scenario Outline"
+    assert tokens[2].text == "S"
+
+
+def test_get_scenarios_from_issue_body_splits_scenarios():
+    scenarios = tester.get_scenarios_from_issue_body(
+        "Intro\n\nScenario: One\nGiven a\n\n@tag\n"
+        "Scenario Outline: Two\nGiven <b>\nExamples:\n| b |\n| 1 |\n"
+    )
+    assert scenarios == [
+        "Scenario: One\nGiven a",
+        "@tag\nScenario Outline: Two\nGiven <b>\nExamples:\n| b |\n| 1 |",
+    ]
+    assert tester.get_scenarios_from_issue_body("No scenarios") == []
+
+
+def test_create_feature_adds_only_new_scenarios(tmp_path):
+    tester.create_test_dirs(tmp_path)
+    issue = SimpleNamespace(
+        title="Coding",
+        body="Scenario: One\nGiven a\nThen b",
+    )
+    feature_path = tester.create_feature(tmp_path, issue)
+    issue.body = (
+        "Scenario: One\nGiven  a\nThen b\n\n"
+        "Scenario: Two\nGiven c\n\nScenario: Two\nGiven c"
+    )
+    assert tester.create_feature(tmp_path, issue) == feature_path
+    feature = tester.parse_feature(feature_path.read_text())
+    assert [scenario.name for scenario in feature.scenarios] == [
+        "One",
+        "Two",
+    ]
+    index = tester.get_scenario_index(feature_path.parent)
+    assert index.paths(feature.scenarios[1]) == {feature_path}
+
+
+def test_generate_tests_for_many_issues(tmp_path, monkeypatch):
+    fake_llm(monkeypatch, "{}", "step")
+    issues = [
+        SimpleNamespace(
+            number=number,
+            title=f"Feature {number}",
+            body=f"Scenario: Run {number}\nGiven issue {number}\n",
+        )
+        for number in (1, 2)
+    ] + [SimpleNamespace(number=3, title="Feature 1", body="Scenario: X")]
+    results = tester.generate_tests(tmp_path, issues, max_workers=2)
+    assert [result.number for result in results] == [1, 2, 3]
+    assert all(not result.error for result in results)
+    assert results[0].step_def_path == results[2].step_def_path
+    step_defs = results[1].step_def_path.read_text()
+    assert "def test_run_2():" in step_defs
+    assert "def step" in step_defs
+    assert all(result.seconds > 0 for result in results)
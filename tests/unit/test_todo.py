@@ -1,3 +1,5 @@
+from datetime import datetime, timedelta, timezone
+
 from pycodegen import todo
 
 
@@ -10,3 +12,235 @@ def test_issue_num_from_branch_name():
     branch_name = "feat/3/test_Test_an_issue"
     issue_num = todo.issue_num_from_branch_name(branch_name)
     assert issue_num == "3"
+
+
+class FakeGithubObject:
+    def __init__(self, name):
+        self.name = name
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+        return False
+
+
+def test_cached_github_object(monkeypatch):
+    todo.clear_github_cache()
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return FakeGithubObject("repo")
+
+    repo = todo.cached_github_object(("repo", "owner/name"), fetch)
+    assert todo.cached_github_object(("repo", "owner/name"), fetch) is repo
+    assert len(fetches) == 1
+    assert repo.updates == 0
+    # Once stale, the cached object is revalidated instead of refetched
+    monkeypatch.setattr(todo, "REVALIDATE_AFTER", 0)
+    assert todo.cached_github_object(("repo", "owner/name"), fetch) is repo
+    assert len(fetches) == 1
+    assert repo.updates == 1
+    todo.clear_github_cache()
+
+
+def test_classify_labels():
+    assert todo.classify_labels([]) is None
+    assert todo.classify_labels(["bug", "Enhancement"]) == todo.feature_type
+    assert todo.classify_labels(["bug"]) == todo.bug_type
+    assert todo.classify_labels(["documentation"]) == todo.docs_type
+    assert todo.classify_labels(["question"]) == todo.chore_type
+
+
+class FakeLabel:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeRepo:
+    full_name = "owner/name"
+
+    def __init__(self, label_names):
+        self.label_names = label_names
+        self.label_fetches = 0
+
+    def get_labels(self):
+        self.label_fetches += 1
+        return [FakeLabel(name) for name in self.label_names]
+
+
+class FakeIssue:
+    def __init__(self, label_names):
+        self.labels = [FakeLabel(name) for name in label_names]
+
+
+def test_get_issue_type_uses_one_label_fetch():
+    todo.clear_github_cache()
+    repo = FakeRepo(["bug", "enhancement", "documentation"])
+    issues = [FakeIssue(["bug"]), FakeIssue(["enhancement"]), FakeIssue([])]
+    issue_types = [todo.get_issue_type(repo, issue) for issue in issues]
+    assert issue_types == [todo.bug_type, todo.feature_type, None]
+    assert repo.label_fetches == 1
+    assert todo.get_label(repo, "Bug").name == "bug"
+    todo.clear_github_cache()
+
+
+class FakeQueueIssue(FakeIssue):
+    def __init__(self, number, label_names, days_old, reactions=0):
+        super().__init__(label_names)
+        self.number = number
+        self.created_at = datetime.now(timezone.utc) - timedelta(days=days_old)
+        self.milestone = None
+        self.reactions = {"total_count": reactions}
+
+
+def test_rank_issues():
+    issues = [
+        FakeQueueIssue(1, ["documentation"], 30),
+        FakeQueueIssue(2, ["bug"], 1),
+        FakeQueueIssue(3, ["enhancement"], 1, reactions=10),
+        FakeQueueIssue(4, ["enhancement", "urgent"], 0),
+    ]
+    ranked = todo.rank_issues(issues)
+    assert [issue.number for issue, _ in ranked] == [4, 3, 2, 1]
+
+
+def test_get_issue_queue_creator_filter(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        todo,
+        "issue_queue_cache",
+        todo.cache.DiskCache("issues", root=tmp_path),
+    )
+    queries = []
+
+    class FakeQueueRepo:
+        def get_issues(self, **kwargs):
+            queries.append(kwargs)
+            issue = FakeQueueIssue(1, ["bug"], 1)
+            issue.pull_request = None
+            issue.title = "Bug"
+            return [issue]
+
+    monkeypatch.setattr(todo, "get_repo", lambda owner, name: FakeQueueRepo())
+    assert todo.get_issue_queue("org", "repo", owner_only=False) == [1]
+    assert todo.get_issue_queue("org", "repo") == [1]
+    assert "creator" not in queries[0]
+    assert queries[1]["creator"] == "org"
+
+
+def issue_page(comments, has_next_page, end_cursor=None):
+    return {
+        "data": {
+            "repository": {
+                "issue": {
+                    "number": 7,
+                    "title": "Add a thing",
+                    "body": "Scenario: thing",
+                    "state": "OPEN",
+                    "labels": {"nodes": [{"name": "enhancement"}]},
+                    "comments": {
+                        "pageInfo": {
+                            "hasNextPage": has_next_page,
+                            "endCursor": end_cursor,
+                        },
+                        "nodes": [
+                            {"databaseId": comment_id, "body": body}
+                            for comment_id, body in comments
+                        ],
+                    },
+                }
+            }
+        }
+    }
+
+
+def test_fetch_issue_snapshot():
+    transport = todo.RecordedTransport(
+        [
+            issue_page([(1, "first")], True, "c1"),
+            issue_page([(2, "AI: second")], False),
+        ]
+    )
+    snapshot = todo.fetch_issue_snapshot("owner", "repo", 7, transport)
+    assert snapshot.number == 7
+    assert snapshot.state == "open"
+    assert snapshot.issue_type == todo.feature_type
+    assert snapshot.comments == ("first", "AI: second")
+    assert snapshot.comment_ids == (1, 2)
+    assert todo.get_issue_comments(snapshot) == ["first", "AI: second"]
+    assert [variables["after"] for _, variables in transport.requests] == [
+        None,
+        "c1",
+    ]
+
+
+def test_fetch_issue_snapshot_not_found():
+    transport = todo.RecordedTransport(
+        [{"data": {"repository": {"issue": None}}}]
+    )
+    assert todo.fetch_issue_snapshot("owner", "repo", 7, transport) is None
+
+
+class FakeComment:
+    def __init__(self, comment_id, body, updated_at):
+        self.id = comment_id
+        self.body = body
+        self.updated_at = updated_at
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class FakeCommentPage(list):
+    @property
+    def reversed(self):
+        return list(reversed(self))
+
+
+class FakeCommentIssue:
+    url = "https://api.github.com/repos/owner/repo/issues/1"
+
+    def __init__(self, bodies):
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        self.thread = [
+            FakeComment(idx + 1, body, start + timedelta(minutes=idx))
+            for idx, body in enumerate(bodies)
+        ]
+        self.since_args = []
+
+    def get_comments(self, since=None):
+        self.since_args.append(since)
+        return FakeCommentPage(
+            comment
+            for comment in self.thread
+            if since is None or comment.updated_at >= since
+        )
+
+    def create_comment(self, body):
+        comment = FakeComment(
+            len(self.thread) + 1,
+            body,
+            self.thread[-1].updated_at + timedelta(minutes=1),
+        )
+        self.thread.append(comment)
+        return comment
+
+
+def test_comment_store_refreshes_incrementally():
+    todo.clear_github_cache()
+    issue = FakeCommentIssue(["one", "two"])
+    assert todo.get_issue_comments(issue) == ["one", "two"]
+    todo.write_issue_comment(issue, "three")
+    assert todo.get_issue_comments(issue) == ["one", "two", "three"]
+    assert issue.since_args == [None, issue.thread[-1].updated_at]
+    todo.clear_github_cache()
+
+
+def test_delete_last_issue_comment_without_paging():
+    todo.clear_github_cache()
+    issue = FakeCommentIssue(["one", "two"])
+    last_comment = todo.delete_last_issue_comment(issue)
+    assert last_comment.body == "two"
+    assert last_comment.deleted
+    todo.clear_github_cache()